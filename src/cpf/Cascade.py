@@ -131,7 +131,8 @@ def execute(
     :param fit_parameters:
     :param fit_settings:
     :param setting_file:
-    :param parallel:
+    :param parallel: if True the chunks of each subpattern are fitted by a pool of
+        processes
     :param report:
     :param mode:
     :param track:
@@ -182,14 +183,25 @@ def execute(
         plt.show()
         plt.close()
 
-    # if parallel processing start the pool
-    # if parallel is True:
-    #     p = mp.Pool(processes=mp.cpu_count())
-    # p = mp.Pool()
+    # if parallel processing start the pool.
+    # The chunks of each subpattern are fitted concurrently by the pool. It is started
+    # with the same worker settings as execute, so that the two share one pool.
+    if parallel is True and mode != "set-range":
+        p = XRD_FitPattern.get_pool(
+            worker_settings=XRD_FitPattern._worker_settings_for(settings_for_fit)
+        )
+    else:
+        p = None
 
     # restrict to sub-patterns listed
     settings_for_fit.set_subpatterns(subpatterns=subpattern)
 
+    # Index of the data in each subpattern, made once for all the images.
+    subpattern_index = [
+        new_data.limits_index(range_bounds=orders["range"])
+        for orders in settings_for_fit.fit_orders
+    ]
+
     # Process the diffraction patterns #
     for j in range(settings_for_fit.image_number):
         logger.info(
@@ -329,9 +341,9 @@ def execute(
 
                     # re-get settings for current subpattern
                     settings_for_fit.set_subpattern(j, i)
+                    subpattern_index[i] = new_data.limits_index(range_bounds=tth_range)
 
-            sub_data = new_data.duplicate()
-            sub_data.set_limits(range_bounds=tth_range)
+            sub_data = new_data.subpattern(subpattern_index[i])
 
             # Mask the subpattern by intensity if called for
             if (
@@ -370,6 +382,7 @@ def execute(
                     mode=mode,
                     histogram_type=settings_for_fit.cascade_histogram_type,
                     histogram_bins=settings_for_fit.cascade_histogram_bins,
+                    executor=p,
                 )
                 all_fitted_chunks.append(tmp[0])
                 all_chunk_positions.append(tmp[1])
@@ -407,8 +420,7 @@ def execute(
                     default=json_numpy_serializer,
                 )
 
-    # if parallel is True:
-    #     p.close()
+    # the pool is persistent, so it is not closed here and is reused by later fits.
 
     # plot the fits
     plot_cascade_chunks(
@@ -8,11 +8,14 @@ Created on Tue Jul  6 05:44:13 2021
 import logging
 import os
 import re
+import tempfile
 from copy import deepcopy
+from pathlib import Path
 
 import numpy as np
 
 # from cpf.XRD_FitPattern import logger
+from cpf.image_index import ImageIndex
 from cpf.logger_functions import logger
 
 
@@ -68,10 +71,44 @@ def json_numpy_serializer(o):
         )
 
 
+def cache_directory():
+    """
+    Default directory for the cached detector geometries and masks.
+    :return: Path of the directory
+    """
+    if os.environ.get("XDG_CACHE_HOME"):
+        return Path(os.environ["XDG_CACHE_HOME"]) / "cpf"
+    return Path.home() / ".cache" / "cpf"
+
+
+def save_cache_array(filename, array):
+    """
+    Save an array as a .npy file in a cache. The array is written to a temporary file
+    first, which is then renamed, so that a partly written file is never read (e.g. by
+    another process).
+    :param filename: name of the file
+    :param array: array to save
+    :return: None. Raises OSError if the file cannot be written.
+    """
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    handle, temporary_file = tempfile.mkstemp(
+        dir=filename.parent, prefix=filename.stem + "_", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(handle, "wb") as f:
+            np.save(f, array)
+        os.replace(temporary_file, filename)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+
+
 def image_list(fit_parameters, fit_settings):
     """
     From the Settings make a list of all the data images to be processed.
     If the images are h5 type files a list of files is made first then the list is expanded for the images in the h5 files.
+    For h5 files the list is an ImageIndex, which makes the entries for the images when they are asked for.
 
     #FIXME: This function is called by the output writing scripts to make sure the file names are called consistently.
 
@@ -132,6 +169,7 @@ def image_list(fit_parameters, fit_settings):
             h5_data = "iterate"
         # h5_data      = fit_settings.h5_data
 
+        image_list = ImageIndex()
         for i in range(n_diff_files):
             h5_list = h5_functions.get_image_keys(
                 diff_files[i],
@@ -141,11 +179,13 @@ def image_list(fit_parameters, fit_settings):
                 key_end=deepcopy(h5_key_end),
                 key_step=h5_key_step,
                 bottom_level=h5_data,
+                lazy=True,
             )
             # N.B. deepcopying of h5_key_end is needed otherwise it is reset for subsequent h5 files.
 
-            for j in range(len(h5_list)):
-                image_list.append([diff_files[i], h5_list[j]])
+            # the frames of each dataset are added to the index without listing them.
+            for keys in h5_list:
+                image_list.append(diff_files[i], keys)
 
     else:
         image_list = diff_files
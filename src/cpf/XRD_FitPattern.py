@@ -2,17 +2,23 @@
 
 __all__ = ["execute", "write_output"]
 
+import atexit
+import hashlib
 import json
 import logging
 import os
 import sys
+from copy import copy, deepcopy
 from importlib import import_module
+from multiprocessing import resource_tracker, shared_memory
 from pathlib import Path
 from types import ModuleType
 from typing import Optional, Union
 
+import dill
 import matplotlib.pyplot as plt
 import numpy as np
+import numpy.ma as ma
 import pathos.pools as mp
 import proglog
 from pathos.multiprocessing import cpu_count
@@ -21,6 +27,7 @@ import cpf.logger_functions as lg
 from cpf import output_formatters
 from cpf.BrightSpots import SpotProcess
 from cpf.data_preprocess import remove_cosmics as cosmicsimage_preprocess
+from cpf.fit_profile import profile_rows, write_profile_report
 from cpf.IO_functions import (
     any_terms_null,
     json_numpy_serializer,
@@ -29,6 +36,8 @@ from cpf.IO_functions import (
     title_file_names,
 )
 from cpf.logger_functions import logger
+from cpf.prefetch import ImagePrefetcher
+from cpf.results_store import ResultsStore, fit_filename, store_filename
 from cpf.settings import settings
 from cpf.XRD_FitSubpattern import fit_sub_pattern
 
@@ -605,22 +614,64 @@ def execute(
         plt.show()
         plt.close()
 
-    # if parallel processing start the pool
+    # Index of the data in each subpattern. The positions of the data are the same for
+    # every image, so each image is cut directly into the subpatterns. Only the
+    # index of a subpattern whose range is moved by tracking the peak is remade.
+    subpattern_index = [
+        new_data.limits_index(range_bounds=orders["range"])
+        for orders in settings_for_fit.fit_orders
+    ]
+
+    # if parallel processing get the (persistent) pool.
+    # The calibration, detector and settings are sent to each worker once, when it
+    # starts. Each fit is then sent only the data of its subpattern.
     if parallel is True:
-        # p = mp.Pool(processes=mp.cpu_count())
-        p = mp.ParallelPool(nodes=cpu_count())
-        # p = mp.Pool()
-
-        # Since we may have already closed the pool, try to restart it
-        try:
-            p.restart()
-        except AssertionError:
-            pass
+        p = get_pool(worker_settings=_worker_settings_for(settings_for_fit))
+        # limit the number of fits waiting in the pool, so that the images are not
+        # all read into memory at once.
+        max_pending = 2 * p.ncpus
+
+    # Fits that are running or have not been written yet, as {image number: [results]}.
+    # The images are pipelined: the next image is read and its subpatterns are sent to
+    # the pool while the fits of the previous images are still running.
+    # If the fits are propagated, each subpattern is a chain of fits through the images
+    # and it only waits for its own fit to the previous image.
+    pending = {}
+    previous_fit = None
+    # rows of the profile of the fits, if it is recorded.
+    profile = [] if settings_for_fit.fit_profile else None
+    # the results store the fits are added to, if they are not written as JSON files.
+    store = None
+    if mode == "fit" and settings_for_fit.output_store == "hdf5":
+        store = ResultsStore(store_filename(settings_for_fit), mode="a")
+    chain = [None] * len(settings_for_fit.fit_orders)
+    # read the next images in the background while the current one is fitted.
+    prefetch = None
+    if settings_for_fit.datafile_prefetch > 0 and hasattr(new_data, "read_image"):
+        max_memory = settings_for_fit.datafile_prefetch_memory
+        prefetch = ImagePrefetcher(
+            new_data.read_image,
+            settings_for_fit.image_list,
+            depth=settings_for_fit.datafile_prefetch,
+            max_memory=None if max_memory is None else max_memory * 1024**2,
+        )
 
     # Process the diffraction patterns
     # for j in range(settings_for_fit.image_number):
     progress = proglog.default_bar_logger("bar")  # shorthand to generate a bar logger
     for j in progress.iter_bar(iteration=range(settings_for_fit.image_number)):
+        if parallel is True and mode in ["fit", "search"]:
+            # wait for space in the pool and write the finished fits.
+            while sum(len(v) for v in pending.values()) >= max_pending:
+                _write_completed_fits(
+                    settings_for_fit,
+                    pending,
+                    mode,
+                    temporary_data_file,
+                    wait=1,
+                    profile=profile,
+                    store=store,
+                )
         logger.info(
             " ".join(
                 map(
@@ -638,7 +689,12 @@ def execute(
         )
 
         # Get diffraction pattern to process.
-        new_data.import_image(settings_for_fit.image_list[j], debug=debug)
+        if prefetch is not None:
+            new_data.import_image(
+                settings_for_fit.image_list[j], image=prefetch.get(j), debug=debug
+            )
+        else:
+            new_data.import_image(settings_for_fit.image_list[j], debug=debug)
 
         if settings_for_fit.datafile_preprocess is not None:
             # needed because image preprocessing adds to the mask and is different for each image.
@@ -660,10 +716,13 @@ def execute(
             plt.show()
             plt.close()
 
-        # Get previous fit (if it exists and is required)
+        # Get previous fit from the checkpoint of an earlier run (if it exists and is
+        # required). The fits to the previous images are taken from the chains below.
         if (
-            os.path.isfile(temporary_data_file)
+            j == 0
+            and os.path.isfile(temporary_data_file)
             and settings_for_fit.fit_propagate is True
+            and settings_for_fit.fit_checkpoint_interval is not None
             and mode == "fit"
         ):
             # Read JSON data from file
@@ -686,7 +745,27 @@ def execute(
                 # if the previous_fit is not the same size as fit_orders the inout file must have been changed.
                 # so discard the previous fit and start again.
                 if len(previous_fit) != len(settings_for_fit.fit_orders):
-                    del previous_fit
+                    previous_fit = None
+        elif (
+            j == 0
+            and os.path.isfile(temporary_data_file)
+            and settings_for_fit.fit_propagate is True
+            and mode == "fit"
+        ):
+            # the checkpoint is only read if fit_checkpoint_interval is set.
+            logger.warning(  # type: ignore
+                " ".join(
+                    map(
+                        str,
+                        [
+                            (
+                                "%s exists but is not read because 'fit_checkpoint_interval' is not set; set it to restart from the checkpoint."
+                                % temporary_data_file
+                            )
+                        ],
+                    )
+                )
+            )
 
         # Switch to save the first fit in each sequence.
         if j == 0 or save_all is True:
@@ -695,15 +774,26 @@ def execute(
             save_figs = 0
 
         # Pass each sub-pattern to Fit_Subpattern for fitting in turn.
-        fitted_param = []
-        lmfit_models = []
-        parallel_pile = []
-
-        for i in range(len(settings_for_fit.fit_orders)):
+        # If propagating, each subpattern waits for its fit to the previous image.
+        image_fits = []
+        for i in _ready_order(
+            chain, wait=settings_for_fit.fit_propagate is True and mode == "fit"
+        ):
             # get settings for current subpattern
             settings_for_fit.set_subpattern(j, i)
 
-            if "previous_fit" in locals() and mode == "fit":
+            if (
+                chain[i] is not None
+                and settings_for_fit.fit_propagate is True
+                and mode == "fit"
+            ):
+                if previous_fit is None:
+                    previous_fit = [None] * len(settings_for_fit.fit_orders)
+                # a copy, so that the fit to the previous image is not changed before
+                # it is written.
+                previous_fit[i] = deepcopy(chain[i].get())
+
+            if previous_fit is not None and mode == "fit":
                 params = previous_fit[i]
             else:
                 params = []
@@ -712,7 +802,7 @@ def execute(
             # FIXME: This is crude - the range doesn't change width. so can't account for massive change in stress.
             # But does it need to?
             tth_range = np.array(settings_for_fit.subfit_orders["range"])
-            if settings_for_fit.fit_track is True and "previous_fit" in locals():
+            if settings_for_fit.fit_track is True and previous_fit is not None:
                 clean = any_terms_null(params, val_to_find=None)
                 if clean == 0:
                     # the previous fit has problems so discard it
@@ -777,9 +867,9 @@ def execute(
 
                     # re-get settings for current subpattern
                     settings_for_fit.set_subpattern(j, i)
+                    subpattern_index[i] = new_data.limits_index(range_bounds=tth_range)
 
-            sub_data = new_data.duplicate()
-            sub_data.set_limits(range_bounds=tth_range)
+            sub_data = new_data.subpattern(subpattern_index[i])
 
             # Mask the subpattern by intensity if called for
             if (
@@ -857,9 +947,12 @@ def execute(
                         "iterations": iterations,
                         "min_data_intensity": settings_for_fit.fit_min_data_intensity,
                         "min_peak_intensity": settings_for_fit.fit_min_peak_intensity,
+                        "fit_method": fit_method,
                     }
-                    arg = (sub_data, settings_for_fit.duplicate())
-                    parallel_pile.append((arg, kwargs))
+                    task = _SubpatternTask(sub_data, settings_for_fit, j)
+                    chain[i] = _PooledFit(
+                        p.apipe(parallel_processing, (task, kwargs)), task
+                    )
 
                 else:  # non-parallel version
                     tmp = fit_sub_pattern(
@@ -874,30 +967,111 @@ def execute(
                         min_peak_intensity=settings_for_fit.fit_min_peak_intensity,
                         fit_method=fit_method,
                     )
-                    fitted_param.append(tmp[0])
-                    lmfit_models.append(tmp[1])
+                    chain[i] = _Completed(tmp[0])
+                image_fits.append((i, chain[i]))
 
         # write output files
         if mode == "fit" or mode == "search":
-            if parallel is True:
-                tmp = p.map(parallel_processing, parallel_pile)
-                for i in range(len(settings_for_fit.fit_orders)):
-                    fitted_param.append(tmp[i][0])
-                    lmfit_models.append(tmp[i][1])
-
-            # store the fit parameters' information as a JSON file.
-            if mode == "search":
-                additional_text = settings_for_fit.file_label
-            else:
-                additional_text = None
+            # keep the fits in subpattern order.
+            pending[j] = [fit for i, fit in sorted(image_fits, key=lambda x: x[0])]
+            _write_completed_fits(
+                settings_for_fit,
+                pending,
+                mode,
+                temporary_data_file,
+                wait=0,
+                profile=profile,
+                store=store,
+            )
 
-            filename = make_outfile_name(
-                settings_for_fit.subfit_filename,
+    if prefetch is not None:
+        prefetch.close()
+
+    # wait for the last of the fits and write them.
+    _write_completed_fits(
+        settings_for_fit,
+        pending,
+        mode,
+        temporary_data_file,
+        wait=2,
+        profile=profile,
+        store=store,
+    )
+    if store is not None:
+        store.close()
+
+    if profile is not None:
+        # write the times and function evaluations of every stage of the fits.
+        report_name = settings_for_fit.settings_file or "cpf"
+        write_profile_report(
+            profile,
+            make_outfile_name(
+                str(report_name),
+                directory=settings_for_fit.output_directory,
+                additional_text="profile",
+                extension=".csv",
+                overwrite=True,
+            ),
+            make_outfile_name(
+                str(report_name),
                 directory=settings_for_fit.output_directory,
-                additional_text=additional_text,
+                additional_text="profile",
                 extension=".json",
                 overwrite=True,
-            )
+            ),
+        )
+
+    if mode == "fit":
+        # Write the output files.
+        write_output(
+            setting_file=setting_file, setting_class=settings_for_fit, debug=debug
+        )
+
+
+def _write_completed_fits(
+    settings_for_fit,
+    pending,
+    mode,
+    temporary_data_file,
+    wait=0,
+    profile=None,
+    store=None,
+):
+    """
+    Write the fits to each image, in image order, once all its subpatterns are fitted.
+    :param settings_for_fit: settings class
+    :param pending: dict of {image number: list of fit results for each subpattern}
+    :param mode: mode of execute, "fit" or "search"
+    :param temporary_data_file: checkpoint file of the latest fits
+    :param wait: 0 - write the images that are finished; 1 - wait for at least one
+        image; 2 - wait for all the images.
+    :param profile: list to add the rows of the profiles of the fits to, or None
+    :param store: ResultsStore to add the fits to, instead of writing JSON files, or
+        None
+    :return: None
+    """
+    waited = False
+    for j in sorted(pending.keys()):
+        if not all(fit.ready() for fit in pending[j]):
+            if wait == 0 or (wait == 1 and waited):
+                break
+            waited = True
+        fitted_param = [fit.get() for fit in pending.pop(j)]
+        if profile is not None:
+            # the profiles are returned from the workers in the FitProperties.
+            profile.extend(profile_rows(fitted_param, j))
+
+        # store the fit parameters' information as a JSON file.
+        if mode == "search":
+            additional_text = settings_for_fit.file_label
+        else:
+            additional_text = None
+
+        filename = fit_filename(settings_for_fit, j, additional_text=additional_text)
+        if store is not None:
+            # or add them to the results store.
+            store.append(filename, fitted_param)
+        else:
             with open(filename, "w") as TempFile:
                 # Write a JSON string into the file.
                 json.dump(
@@ -908,31 +1082,281 @@ def execute(
                     default=json_numpy_serializer,
                 )
 
-            # if propagating the fits write them to a temporary file
-            if settings_for_fit.fit_propagate:
-                with open(temporary_data_file, "w") as TempFile:
-                    # Write a JSON string into the file.
-                    json.dump(
-                        fitted_param,
-                        TempFile,
-                        sort_keys=True,
-                        indent=2,
-                        default=json_numpy_serializer,
-                    )
+        # The fits are propagated in memory. If asked for, write them to a checkpoint
+        # file every few images (and after the last), from which the fits can be
+        # restarted.
+        interval = settings_for_fit.fit_checkpoint_interval
+        if (
+            settings_for_fit.fit_propagate
+            and interval is not None
+            and ((j + 1) % interval == 0 or j == settings_for_fit.image_number - 1)
+        ):
+            with open(temporary_data_file, "w") as TempFile:
+                # Write a JSON string into the file.
+                json.dump(fitted_param, TempFile, default=json_numpy_serializer)
 
-    if mode == "fit":
-        # Write the output files.
-        write_output(
-            setting_file=setting_file, setting_class=settings_for_fit, debug=debug
+
+def _ready_order(chain, wait=False):
+    """
+    Yield the subpattern numbers in the order that they are ready to be fitted.
+    :param chain: list of the latest fit result for each subpattern, or None
+    :param wait: if True a subpattern is not ready until its latest fit has finished
+    :return: generator of subpattern numbers
+    """
+    remaining = list(range(len(chain)))
+    while remaining:
+        for i in remaining:
+            if not wait or chain[i] is None or chain[i].ready():
+                remaining.remove(i)
+                yield i
+                break
+        else:
+            # none is ready, so wait for the first of them to finish and look again.
+            chain[remaining[0]].wait()
+
+
+class _Completed:
+    """
+    Result of a fit made without the pool, with the interface of the pool's results.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def wait(self):
+        pass
+
+    def get(self):
+        return self.value
+
+
+# The worker pool is kept between images and between calls to execute, so that the
+# workers are only started once. It is restarted if the settings it was started with
+# change, and closed when python exits.
+_pool = None
+_pool_key = None
+# Settings (including the data class, without the data) of a worker process, set by
+# _init_worker when the worker starts.
+_worker_settings = None
+
+
+def get_pool(nodes=None, worker_settings=None):
+    """
+    Get the persistent pool of worker processes used to fit the subpatterns.
+    :param nodes: number of worker processes, defaults to the number of cpus
+    :param worker_settings: settings class given to each worker when it starts. Its
+        data class should contain the calibration and detector but not the data.
+    :return: pathos ProcessPool
+    """
+    global _pool, _pool_key
+    if nodes is None:
+        nodes = cpu_count()
+    if worker_settings is None:
+        key = None
+    else:
+        key = hashlib.sha1(dill.dumps(worker_settings)).hexdigest()
+    if _pool is None or _pool.ncpus != nodes or _pool_key != key:
+        close_pool()
+        _pool = mp.ProcessPool(
+            nodes=nodes,
+            id="cpf_fit_pool",
+            initializer=_init_worker,
+            initargs=(worker_settings,),
         )
+        _pool_key = key
+    # Since we may have already closed the pool, try to restart it
+    try:
+        _pool.restart()
+    except AssertionError:
+        pass
+    return _pool
 
-    if parallel is True:
-        p.clear()
+
+def close_pool():
+    """
+    Close the persistent pool of worker processes, if it exists.
+    :return: None
+    """
+    global _pool, _pool_key
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool.clear()
+        _pool = None
+        _pool_key = None
+
+
+atexit.register(close_pool)
+
+
+def _init_worker(worker_settings):
+    """
+    Store the static settings in a worker process, when it starts.
+    :param worker_settings: settings class, with a data class without the data
+    :return: None
+    """
+    global _worker_settings
+    _worker_settings = worker_settings
+
+
+def _worker_settings_for(settings_for_fit):
+    """
+    Copy of the settings to send to the workers. The data class keeps the calibration
+    and detector but not the data arrays, which are sent with each subpattern.
+    :param settings_for_fit: settings class
+    :return: settings class
+    """
+    data_class = copy(settings_for_fit.data_class)
+    for name in _SubpatternTask.arrays + ["original_mask"]:
+        if getattr(data_class, name, None) is not None:
+            setattr(data_class, name, None)
+    worker_settings = settings_for_fit.duplicate()
+    worker_settings.data_class = data_class
+    return worker_settings
+
+
+class _SubpatternTask:
+    """
+    Data of one subpattern and its position in the fit, sent to a worker to fit.
+
+    The data arrays are put in a block of shared memory so that they are not pickled
+    with the task. If shared memory is not available they are sent with the task.
+    The block is made and removed by the main process; the workers only read it.
+    """
+
+    # data arrays that are cut to the subpattern by set_limits.
+    arrays = ["intensity", "tth", "azm", "dspace", "x", "y", "z"]
+
+    def __init__(self, sub_data, settings_for_fit, image_number):
+        """
+        :param sub_data: data class cut to the subpattern
+        :param settings_for_fit: settings class, set for the subpattern
+        :param image_number: position of the image in the image list
+        """
+        self.image_number = image_number
+        self.subpattern = settings_for_fit.subfit_order_position
+        # the orders are sent because tracking the peaks may change the range.
+        self.orders = deepcopy(settings_for_fit.subfit_orders)
+
+        # layout of the arrays: (name, masked, dtype, shape, offset)
+        self.layout = []
+        values = []
+        size = 0
+        for name in self.arrays:
+            array = getattr(sub_data, name, None)
+            if array is None:
+                continue
+            parts = [np.asarray(ma.getdata(array))]
+            if isinstance(array, ma.MaskedArray):
+                parts.append(ma.getmaskarray(array))
+            for k, part in enumerate(parts):
+                self.layout.append((name, k == 1, part.dtype.str, part.shape, size))
+                values.append(part)
+                size = size + part.nbytes
+
+        self.shared_name = None
+        self.values = None
+        self._shared = None
+        try:
+            self._shared = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        except OSError:
+            self.values = values
+        else:
+            for (name, masked, dtype, shape, offset), part in zip(self.layout, values):
+                np.ndarray(shape, dtype, buffer=self._shared.buf, offset=offset)[
+                    ...
+                ] = part
+            self.shared_name = self._shared.name
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shared"] = None
+        return state
+
+    def unpack(self, worker_settings):
+        """
+        Make the data and settings classes for the fit, in the worker.
+        :param worker_settings: settings class given to the worker when it started
+        :return: data class and settings class of the subpattern
+        """
+        if self.shared_name is not None:
+            shared = shared_memory.SharedMemory(name=self.shared_name)
+            # the block belongs to the main process; do not let this process remove it.
+            try:
+                resource_tracker.unregister(shared._name, "shared_memory")
+            except Exception:
+                pass
+            values = [
+                np.ndarray(shape, dtype, buffer=shared.buf, offset=offset).copy()
+                for name, masked, dtype, shape, offset in self.layout
+            ]
+            shared.close()
+        else:
+            values = self.values
+
+        sub_data = copy(worker_settings.data_class)
+        parts = {}
+        for (name, masked, dtype, shape, offset), value in zip(self.layout, values):
+            parts.setdefault(name, [None, None])[int(masked)] = value
+        for name, (data, mask) in parts.items():
+            if mask is None:
+                setattr(sub_data, name, data)
+            else:
+                setattr(sub_data, name, ma.array(data, mask=mask))
+
+        settings_for_fit = worker_settings.duplicate()
+        settings_for_fit.data_class = sub_data
+        settings_for_fit.fit_orders = list(settings_for_fit.fit_orders)
+        settings_for_fit.fit_orders[self.subpattern] = self.orders
+        settings_for_fit.set_subpattern(self.image_number, self.subpattern)
+        return sub_data, settings_for_fit
+
+    def release(self):
+        """
+        Remove the shared memory block, in the main process, once the fit is finished.
+        :return: None
+        """
+        if self._shared is not None:
+            self._shared.close()
+            try:
+                self._shared.unlink()
+            except FileNotFoundError:
+                pass
+            self._shared = None
+
+
+class _PooledFit:
+    """
+    Result of a fit made by the pool, which releases the data sent to the worker once
+    the fit is finished.
+    """
+
+    def __init__(self, result, task):
+        self.result = result
+        self.task = task
+
+    def ready(self):
+        return self.result.ready()
+
+    def wait(self):
+        self.result.wait()
+
+    def get(self):
+        try:
+            return self.result.get()
+        finally:
+            self.task.release()
 
 
 def parallel_processing(p):
-    a, kw = p
-    return fit_sub_pattern(*a, **kw)
+    task, kw = p
+    sub_data, settings_for_fit = task.unpack(_worker_settings)
+    # only the fitted parameters are returned; the lmfit model result is not needed
+    # and is expensive (and not always possible) to send back.
+    return fit_sub_pattern(sub_data, settings_for_fit, **kw)[0]
 
 
 if __name__ == "__main__":
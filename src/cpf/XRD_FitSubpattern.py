@@ -8,6 +8,7 @@ __all__ = ["fit_sub_pattern"]
 import json
 import sys
 import time
+from copy import deepcopy
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -19,10 +20,13 @@ import cpf.lmfit_model as lmm
 import cpf.logger_functions as lg
 import cpf.peak_functions as pf
 import cpf.series_functions as sf
+from cpf.compiled_model import CompiledModel
+from cpf.fit_profile import FitProfile
 from cpf.fitsubpattern_chunks import fit_chunks, fit_series
 
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
+from cpf.refine_schedule import RefineSchedule
 
 np.set_printoptions(threshold=sys.maxsize)
 
@@ -205,6 +209,72 @@ def check_num_azimuths(peeks, azimu, orders):
         raise ValueError(err_str)
 
 
+def decimate_data(data_as_class, factor):
+    """
+    Reduced copy of the data of a subpattern, for the coarse fits of multi-resolution
+    fitting. One in every factor positions is kept, in the order the data are stored
+    (the order of the detector pixels), so the reduced data are spread evenly over the
+    subpattern and are the same for every image.
+    :param data_as_class: data class of the subpattern
+    :param factor: keep one in this many positions
+    :return: data class of the reduced data
+    """
+    keep = np.arange(np.size(data_as_class.intensity)) % int(factor) == 0
+    return data_as_class.subpattern(
+        np.nonzero(keep.reshape(np.shape(data_as_class.intensity)))
+    )
+
+
+def full_chisq(compiled_model, data_as_class, params):
+    """
+    Chi-squared of the parameters against all the data of the subpattern, as fit_model
+    computes it, to compare the coarse fits of multi-resolution fitting.
+    :param compiled_model: CompiledModel made for the data
+    :param data_as_class: data class of the subpattern
+    :param params: lmfit Parameter class
+    :return: chi-squared
+    """
+    model = compiled_model.evaluate(compiled_model.vector(params)).flatten()
+    residual = np.ma.getdata(data_as_class.intensity).flatten() - model
+    return float(np.sum(residual**2))
+
+
+def vary_all_params(master_params, orders):
+    """
+    Set all the parameters to vary, except those that are fixed in the orders.
+    :param master_params: lmfit Parameter class
+    :param orders: orders dictionary of the subpattern
+    :return: lmfit Parameter class
+    """
+    for k in range(len(orders["background"])):
+        param_str = "bg_c" + str(k)
+        comp = "f"
+        # set these parameters to vary
+        master_params = lmm.vary_params(master_params, param_str, comp)
+        # set part of these parameters to not vary
+
+    comp_list, comp_names = pf.peak_components(include_profile=True)
+    for k in range(len(orders["peak"])):
+        param_str = "peak_" + str(k)
+
+        for cp in range(len(comp_list)):
+            comp = comp_list[cp]
+            if comp_names[cp] + "_fixed" in orders["peak"][k]:
+                # set compenent not to vary
+                master_params = lmm.un_vary_this_params(master_params, param_str, comp)
+            else:
+                master_params = lmm.vary_params(master_params, param_str, comp)
+                # set part of these parameters to not vary
+                if isinstance(orders["peak"][k][comp_names[cp]], list):
+                    master_params = lmm.un_vary_part_params(
+                        master_params,
+                        param_str,
+                        comp,
+                        orders["peak"][k][comp_names[cp]],
+                    )
+    return master_params
+
+
 def fit_sub_pattern(
     data_as_class=None,
     settings_as_class=None,
@@ -221,6 +291,7 @@ def fit_sub_pattern(
     min_data_intensity=1,
     min_peak_intensity="0.25*std",
     large_errors=300,
+    executor=None,
 ):
     """
     Perform the various fitting stages to the data
@@ -236,6 +307,7 @@ def fit_sub_pattern(
     :param debug:
     :param refine:
     :param iterations:
+    :param executor: pool used to fit the azimuthal chunks concurrently, or None
     :return:
     """
 
@@ -246,6 +318,10 @@ def fit_sub_pattern(
     # Measure the elapsed time during fitting.
     # To help decide what is bad fit or if over fitting the data.
     t_start = time.time()
+    # decides which refinement stages are run, if fit_refine_tolerance is set.
+    refine_schedule = None
+    # times and function evaluations of each stage of the fit.
+    profile = FitProfile()
 
     # set data type for the intensity data.
     # This is needed for saving the fits using save_modelresult/ load_modelresult.
@@ -372,6 +448,21 @@ def fit_sub_pattern(
                 values=previous_params,
                 debug=debug,
             )
+            # make the design matrices of the model once for all the fits to this data.
+            compiled_model = CompiledModel(
+                master_params,
+                data_as_class.tth,
+                data_as_class.azm,
+                data_class=data_as_class,
+                orders=settings_as_class.subfit_orders,
+                start_end=[data_as_class.azm_start, data_as_class.azm_end],
+                window=settings_as_class.fit_peak_window,
+            )
+            # the parameters are propagated from the previous fit, rather than made by
+            # fitting chunks of the data. The refinement schedule is made anew for
+            # the new model.
+            propagated = bool(previous_params)
+            refine_schedule = None
 
             # check if the data intensity is above threshold.
             if np.max(data_as_class.intensity) <= min_data_intensity:
@@ -396,6 +487,7 @@ def fit_sub_pattern(
             if step >= 0 and not previous_params:
                 # There is no previous fit -- Fit data in azimuthal chunks
                 # using manual guesses ("PeakPositionSelection") if they exist.
+                stage = profile.start("chunks")
                 chunk_fits, chunk_positions = fit_chunks(
                     data_as_class,
                     settings_as_class,
@@ -404,7 +496,9 @@ def fit_sub_pattern(
                     histogram_bins=histogram_bins,
                     debug=debug,
                     fit_method=fit_method,
+                    executor=executor,
                 )
+                profile.stop(stage, n_data=np.ma.count(data_as_class.intensity))
 
                 if mode != "fit":  # cascade==True:
                     # some cascade option. so exit returning values.
@@ -417,6 +511,7 @@ def fit_sub_pattern(
 
                 # fit the chunk values with fourier/spline series.
                 # iterate over each parameter in turn
+                stage = profile.start("series")
                 master_params = fit_series(
                     master_params,
                     (chunk_fits, chunk_positions),
@@ -425,6 +520,11 @@ def fit_sub_pattern(
                     debug=debug,
                     save_fit=save_fit,
                 )
+                profile.stop(
+                    stage,
+                    n_data=np.size(chunk_positions),
+                    n_variables=len(master_params),
+                )
 
                 # check if peak intensity is above threshold
                 ave_intensity = []
@@ -512,8 +612,39 @@ def fit_sub_pattern(
                         )
                     )
                 )
+                background_steps = range(
+                    len(settings_as_class.subfit_orders["background"])
+                )
+                if settings_as_class.fit_varpro:
+                    # the height coefficients are solved for within every fit, so
+                    # only d, w and p are refined. The background is refined on its
+                    # own, as without variable projection, so that the heights are not
+                    # traded for background before the check of the peak intensity.
+                    linear_free = [
+                        name
+                        for name, par in vary_all_params(
+                            deepcopy(master_params), settings_as_class.subfit_orders
+                        ).items()
+                        if name in compiled_model.linear_names
+                        and par.vary
+                        and not name.startswith("bg_")
+                    ]
+                else:
+                    linear_free = None
+                if (
+                    settings_as_class.fit_refine_tolerance is not None
+                    and refine_schedule is None
+                ):
+                    refine_schedule = RefineSchedule(
+                        compiled_model,
+                        data_as_class.intensity,
+                        propagated=propagated,
+                        tolerance=settings_as_class.fit_refine_tolerance,
+                    )
                 for j in range(iterations):
-                    for k in range(len(settings_as_class.subfit_orders["background"])):
+                    if refine_schedule is not None:
+                        refine_schedule.start_iteration(j)
+                    for k in background_steps:
                         param_str = "bg_c" + str(k)
                         comp = "f"
                         # set other parameters to not vary
@@ -525,6 +656,16 @@ def fit_sub_pattern(
                         # set part of these parameters to not vary
                         # master_params = ff.un_vary_part_params(master_params, param_str, comp,
                         # orders['background'][k])
+                        refine_max_f_eval = default_max_f_eval
+                        if refine_schedule is not None:
+                            if not refine_schedule.run(
+                                param_str + "_" + comp, master_params
+                            ):
+                                continue
+                            refine_max_f_eval = refine_schedule.max_f_eval(
+                                param_str + "_" + comp, refine_max_f_eval
+                            )
+                        stage = profile.start("refine", param_str + "_" + comp)
                         fout = lmm.fit_model(
                             data_as_class,
                             settings_as_class.subfit_orders,
@@ -532,9 +673,17 @@ def fit_sub_pattern(
                             start_end=[data_as_class.azm_start, data_as_class.azm_end],
                             fit_method=None,
                             weights=None,
-                            max_n_fev=default_max_f_eval,
+                            max_n_fev=refine_max_f_eval,
+                            jacobian=settings_as_class.fit_jacobian,
+                            backend=settings_as_class.fit_backend,
+                            compiled_model=compiled_model,
                         )
+                        profile.stop(stage, fout)
                         master_params = fout.params
+                        if refine_schedule is not None:
+                            refine_schedule.record(
+                                param_str + "_" + comp, fout, refine_max_f_eval
+                            )
 
                     # iterate over the peak components in order of size (height)
                     # get mean height of peak from parameters
@@ -559,7 +708,9 @@ def fit_sub_pattern(
                             k = peak_order[l]
                             param_str = "peak_" + str(k)
 
-                            if not (
+                            if settings_as_class.fit_varpro and comp == "h":
+                                pass
+                            elif not (
                                 comp_names[cp] + "_fixed"
                                 in settings_as_class.subfit_orders["peak"][k]
                             ):
@@ -590,19 +741,54 @@ def fit_sub_pattern(
                                     refine_max_f_eval = 5 * peeks * default_max_f_eval
                                 else:
                                     refine_max_f_eval = default_max_f_eval
-                                fout = lmm.fit_model(
-                                    data_as_class,
-                                    settings_as_class.subfit_orders,
-                                    master_params,
-                                    start_end=[
-                                        data_as_class.azm_start,
-                                        data_as_class.azm_end,
-                                    ],
-                                    fit_method=None,
-                                    weights=None,
-                                    max_n_fev=refine_max_f_eval,
-                                )
+                                if refine_schedule is not None:
+                                    if not refine_schedule.run(
+                                        param_str + "_" + comp,
+                                        master_params,
+                                        also=linear_free,
+                                    ):
+                                        continue
+                                    refine_max_f_eval = refine_schedule.max_f_eval(
+                                        param_str + "_" + comp, refine_max_f_eval
+                                    )
+                                stage = profile.start("refine", param_str + "_" + comp)
+                                if settings_as_class.fit_varpro:
+                                    fout = lmm.fit_model_varpro(
+                                        data_as_class,
+                                        settings_as_class.subfit_orders,
+                                        master_params,
+                                        start_end=[
+                                            data_as_class.azm_start,
+                                            data_as_class.azm_end,
+                                        ],
+                                        linear=linear_free,
+                                        max_n_fev=refine_max_f_eval,
+                                        jacobian=settings_as_class.fit_jacobian,
+                                        backend=settings_as_class.fit_backend,
+                                        compiled_model=compiled_model,
+                                    )
+                                else:
+                                    fout = lmm.fit_model(
+                                        data_as_class,
+                                        settings_as_class.subfit_orders,
+                                        master_params,
+                                        start_end=[
+                                            data_as_class.azm_start,
+                                            data_as_class.azm_end,
+                                        ],
+                                        fit_method=None,
+                                        weights=None,
+                                        max_n_fev=refine_max_f_eval,
+                                        jacobian=settings_as_class.fit_jacobian,
+                                        backend=settings_as_class.fit_backend,
+                                        compiled_model=compiled_model,
+                                    )
+                                profile.stop(stage, fout)
                                 master_params = fout.params
+                                if refine_schedule is not None:
+                                    refine_schedule.record(
+                                        param_str + "_" + comp, fout, refine_max_f_eval
+                                    )
 
                     logger.effusive(
                         " ".join(
@@ -620,6 +806,10 @@ def fit_sub_pattern(
                     # master_params.pretty_print()
                     lg.pretty_print_to_logger(master_params, level="EFFUSIVE")
 
+                    if refine_schedule is not None and refine_schedule.converged():
+                        # no stage changed the fit, so further iterations would not.
+                        break
+
                 step = step + 10
 
                 # get mean height of chunked peaks and check if it is greater than threshold
@@ -691,53 +881,87 @@ def fit_sub_pattern(
                 raise ValueError("The value of step here is not possible. Oops.")
 
             # set all parameters to vary
-            for k in range(len(settings_as_class.subfit_orders["background"])):
-                param_str = "bg_c" + str(k)
-                comp = "f"
-                # set these parameters to vary
-                master_params = lmm.vary_params(master_params, param_str, comp)
-                # set part of these parameters to not vary
-
-            comp_list, comp_names = pf.peak_components(include_profile=True)
-            for k in range(peeks):
-                param_str = "peak_" + str(k)
-
-                for cp in range(len(comp_list)):
-                    comp = comp_list[cp]
-                    if (
-                        comp_names[cp] + "_fixed"
-                        in settings_as_class.subfit_orders["peak"][k]
-                    ):
-                        # set compenent not to vary
-                        master_params = lmm.un_vary_this_params(
-                            master_params, param_str, comp
-                        )
-                    else:
-                        master_params = lmm.vary_params(master_params, param_str, comp)
-                        # set part of these parameters to not vary
-                        if isinstance(
-                            settings_as_class.subfit_orders["peak"][k][comp_names[cp]],
-                            list,
-                        ):
-                            master_params = lmm.un_vary_part_params(
-                                master_params,
-                                param_str,
-                                comp,
-                                settings_as_class.subfit_orders["peak"][k][
-                                    comp_names[cp]
-                                ],
-                            )
-
-            fout = lmm.fit_model(
-                data_as_class,
-                settings_as_class.subfit_orders,
-                master_params,
-                start_end=[data_as_class.azm_start, data_as_class.azm_end],
-                fit_method=None,
-                weights=None,
-                max_n_fev=max_n_f_eval,
+            master_params = vary_all_params(
+                master_params, settings_as_class.subfit_orders
             )
-            master_params = fout.params
+
+            # In multi-resolution fitting, reduced copies of the data are fitted first,
+            # each starting from the last, and then all the data are fitted starting
+            # from the coarse solution. The coarse fits have at most the default
+            # number of function evaluations. A coarse fit is only used if it
+            # converges and is a better fit to all the data than its start, so that
+            # the fit to all the data never starts from a worse place.
+            levels = [
+                (factor, decimate_data(data_as_class, factor))
+                for factor in settings_as_class.fit_resolution_levels or []
+            ]
+            levels.append((1, data_as_class))
+            resolution_stats = []
+            if len(levels) > 1:
+                start_chisq = full_chisq(compiled_model, data_as_class, master_params)
+            for factor, level_data in levels:
+                level_start = time.time()
+                stage = profile.start(
+                    "final", None if factor == 1 else "1/" + str(factor)
+                )
+                if factor == 1:
+                    level_model = compiled_model
+                    level_max_f_eval = max_n_f_eval
+                else:
+                    level_max_f_eval = min(max_n_f_eval, default_max_f_eval)
+                    level_model = CompiledModel(
+                        master_params,
+                        level_data.tth,
+                        level_data.azm,
+                        data_class=level_data,
+                        orders=settings_as_class.subfit_orders,
+                        start_end=[level_data.azm_start, level_data.azm_end],
+                        window=settings_as_class.fit_peak_window,
+                    )
+                if settings_as_class.fit_varpro:
+                    fout = lmm.fit_model_varpro(
+                        level_data,
+                        settings_as_class.subfit_orders,
+                        master_params,
+                        start_end=[level_data.azm_start, level_data.azm_end],
+                        max_n_fev=level_max_f_eval,
+                        jacobian=settings_as_class.fit_jacobian,
+                        backend=settings_as_class.fit_backend,
+                        compiled_model=level_model,
+                    )
+                else:
+                    fout = lmm.fit_model(
+                        level_data,
+                        settings_as_class.subfit_orders,
+                        master_params,
+                        start_end=[level_data.azm_start, level_data.azm_end],
+                        fit_method=None,
+                        weights=None,
+                        max_n_fev=level_max_f_eval,
+                        jacobian=settings_as_class.fit_jacobian,
+                        backend=settings_as_class.fit_backend,
+                        compiled_model=level_model,
+                    )
+                used = factor == 1
+                if factor != 1 and fout.success:
+                    level_chisq = full_chisq(compiled_model, data_as_class, fout.params)
+                    used = level_chisq < start_chisq
+                if used:
+                    master_params = fout.params
+                    if factor != 1:
+                        start_chisq = level_chisq
+                profile.stop(stage, fout)
+                resolution_stats.append(
+                    {
+                        "factor": factor,
+                        "n-data": fout.ndata,
+                        "function-evaluations": fout.nfev,
+                        "time-elapsed": time.time() - level_start,
+                        "ChiSq": fout.chisqr,
+                        "success": bool(fout.success),
+                        "used": bool(used),
+                    }
+                )
 
             if (
                 fout.success == 1
@@ -785,6 +1009,14 @@ def fit_sub_pattern(
                 step = 0
                 # clear previous_params so we can't get back here
                 previous_params = None
+            elif (
+                fout.success == 1
+                and refine_schedule is not None
+                and refine_schedule.recheck(master_params)
+            ):
+                # the final fit left the parameters of skipped stages as they were
+                # propagated, so refine them and fit again.
+                step = step - 10
             elif fout.success == 1:
                 # it worked, errors are not massive, carry on
                 step = step + 100
@@ -840,6 +1072,28 @@ def fit_sub_pattern(
         logger.effusive(" ".join(map(str, [("number data %i" % fout.ndata)])))
         logger.effusive(" ".join(map(str, [("degrees of freedom %i" % fout.nfree)])))
         logger.effusive(" ".join(map(str, [("ChiSquared %f" % fout.chisqr)])))
+        if settings_as_class.fit_peak_window is not None:
+            # the bound of the peak tails left out by the windowed evaluation.
+            compiled_model.evaluate(compiled_model.vector(master_params))
+            truncation_error = compiled_model.truncation_error
+            logger.moreinfo(
+                " ".join(
+                    map(
+                        str,
+                        [
+                            (
+                                "Peaks evaluated within %s widths; truncation error <= %.3g (%.3g of the maximum intensity)"
+                                % (
+                                    settings_as_class.fit_peak_window,
+                                    truncation_error,
+                                    truncation_error
+                                    / np.max(np.abs(data_as_class.intensity)),
+                                )
+                            )
+                        ],
+                    )
+                )
+            )
         # get all correlation coefficients
         # FIX ME: this lists all the coefficients rather than just the unique half -- ie.
         # it contains corr(a,b) and corr(b,a)
@@ -867,6 +1121,10 @@ def fit_sub_pattern(
     if "note" in settings_as_class.subfit_orders:
         new_params.update({"note": settings_as_class.subfit_orders["note"]})
 
+    logger.effusive(
+        " ".join(map(str, [("Series basis cache: %s" % sf.basis_cache_info())]))
+    )
+
     # Elapsed time for fitting
     t_end = time.time()
     t_elapsed = t_end - t_start
@@ -887,6 +1145,12 @@ def fit_sub_pattern(
             "aic": fout.aic,
             "bic": fout.bic,
         }
+        if settings_as_class.fit_peak_window is not None:
+            fit_stats["truncation-error"] = truncation_error
+        if settings_as_class.fit_resolution_levels is not None:
+            fit_stats["resolution-levels"] = resolution_stats
+        if refine_schedule is not None:
+            fit_stats["refine-stages"] = refine_schedule.summary()
     else:
         fit_stats = {
             "time-elapsed": t_elapsed,
@@ -902,6 +1166,8 @@ def fit_sub_pattern(
             "aic": np.nan,
             "bic": np.nan,
         }
+    if settings_as_class.fit_profile:
+        fit_stats["profile"] = profile.stages
 
     new_params.update({"FitProperties": fit_stats})
     new_params.update(
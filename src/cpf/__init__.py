@@ -6,6 +6,13 @@ __all__ = [
     "peak_functions",
     "series_functions",
     "lmfit_model",
+    "compiled_model",
+    "batched_fit",
+    "refine_schedule",
+    "fit_profile",
+    "results_store",
+    "prefetch",
+    "image_index",
     "output_formatters",
     "XRD_FitPattern",
     "XRD_FitSubpattern",
@@ -26,14 +33,21 @@ from . import (
     IO_functions,
     XRD_FitPattern,
     XRD_FitSubpattern,
+    batched_fit,
+    compiled_model,
     data_preprocess,
+    fit_profile,
     fitsubpattern_chunks,
     h5_functions,
+    image_index,
     input_types,
     lmfit_model,
     logger_functions,
     output_formatters,
     peak_functions,
+    prefetch,
+    refine_schedule,
+    results_store,
     series_functions,
     settings,
 )
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+
+"""
+Fit all the azimuthal chunks of a subpattern together.
+
+Each chunk is a small 1D problem: a polynomial background and pseudo-Voigt peaks in
+two theta, with a single value for each property. Rather than making an lmfit model
+for every chunk, the chunks are stacked (padded to the same length) and a single
+Levenberg-Marquardt minimisation is made for all of them at once. Each chunk has its
+own trust region and convergence, so the chunks remain independent problems.
+
+The minimisation follows MINPACK's lmdif, which lmfit uses for 'leastsq': the
+Jacobian is made by forward differences in the internal values of the parameters (the
+MINUIT transformation of the bounds, as lmfit), the steps are found and accepted and
+the fits converge as in lmdif, and the function evaluations are counted as lmfit counts
+them. The errors are made from the covariance matrix as lmfit does. The only
+differences from fitting each chunk with lmfit_model.fit_model are in the rounding of
+the linear algebra, so chunks that are well determined get the same fits. Chunks with
+more than one minimum, or that stop at the maximum number of evaluations, can end in
+different places.
+"""
+
+__all__ = ["fit_chunks_batched"]
+
+import numpy as np
+
+import cpf.peak_functions as pf
+
+# settings of the minimisation, as lmfit_model.fit_model gives leastsq.
+_ftol = 1.5e-8
+_xtol = 1e-5
+_epsfcn = 1e-10
+_factor = 100
+
+_epsmch = np.finfo(float).eps
+_dwarf = np.finfo(float).tiny
+
+
+def fit_chunks_batched(chunk_data, chunk_params, orders, max_n_fev=400):
+    """
+    Fit the peaks and background to many chunks at once.
+    :param chunk_data: list of data classes, one for each chunk, containing intensity,
+        tth and the conversion function.
+    :param chunk_params: list of lmfit Parameter classes, one for each chunk, with the
+        same parameter names ("bg_cX_f0" and "peak_X_Y0") for each chunk.
+    :param orders: orders dictionary to get minimum position of the range
+    :param max_n_fev: maximum number of function evaluations for each chunk, counted
+        as lmfit counts them
+    :return: list of lmfit Parameter classes with the fitted values and errors.
+    """
+    if len(chunk_params) == 0:
+        return []
+    names = list(chunk_params[0].keys())
+    for params in chunk_params:
+        if list(params.keys()) != names:
+            raise ValueError("The chunks must all have the same parameters.")
+    background, peaks = _layout(names)
+
+    n_chunks = len(chunk_params)
+    n_data = np.array([np.size(data.intensity) for data in chunk_data])
+    n_max = np.max(n_data)
+
+    # stack the data, padding each chunk with zero weight.
+    two_theta = np.zeros((n_chunks, n_max))
+    intensity = np.zeros((n_chunks, n_max))
+    weight = np.zeros((n_chunks, n_max))
+    for k, data in enumerate(chunk_data):
+        two_theta[k, : n_data[k]] = np.asarray(data.tth, dtype=float)
+        two_theta[k, n_data[k] :] = np.asarray(data.tth, dtype=float)[0]
+        intensity[k, : n_data[k]] = np.asarray(data.intensity, dtype=float)
+        weight[k, : n_data[k]] = 1
+    two_theta_prime = two_theta - orders["range"][0]
+
+    # parameter values, bounds and which are varied. lmfit moves values outside the
+    # bounds onto them.
+    value = np.array([[p[n].value for n in names] for p in chunk_params], dtype=float)
+    lower = np.array([[p[n].min for n in names] for p in chunk_params], dtype=float)
+    upper = np.array([[p[n].max for n in names] for p in chunk_params], dtype=float)
+    vary = np.array([[p[n].vary for n in names] for p in chunk_params], dtype=bool)
+    value = np.clip(value, lower, upper)
+    n_vary = np.sum(vary, axis=1)
+
+    def residual(internal, rows):
+        """residual of the model for some of the chunks, given the internal values of
+        the parameters of those chunks"""
+        values = np.where(
+            vary[rows], _to_external(internal, lower[rows], upper[rows]), value[rows]
+        )
+        data = [chunk_data[k] for k in rows]
+        fit = np.zeros((len(rows), n_max))
+        for column, power in background:
+            fit = fit + values[:, column, np.newaxis] * two_theta_prime[rows] ** power
+        for peak in peaks:
+            d, h, w, p = [values[:, peak[comp], np.newaxis] for comp in "dhwp"]
+            two_theta_0 = _conversion(data, d[:, 0])[:, np.newaxis]
+            fit = fit + pf.pseudo_voigt_peak(two_theta[rows], two_theta_0, w, h, p)
+        return (fit - intensity[rows]) * weight[rows]
+
+    everything = np.arange(n_chunks)
+    internal = np.where(vary, _to_internal(value, lower, upper), value)
+    fvec = residual(internal, everything)
+    fnorm = np.linalg.norm(fvec, axis=1)
+    n_fev = np.ones(n_chunks, dtype=int)
+    jac = np.zeros((n_chunks, n_max, len(names)))
+    diag = np.ones((n_chunks, len(names)))
+    delta = np.zeros(n_chunks)
+    par = np.zeros(n_chunks)
+    xnorm = np.zeros(n_chunks)
+    gnorm = np.zeros(n_chunks)
+    # no step has been taken yet, so the trust region is still being set.
+    first = np.ones(n_chunks, dtype=bool)
+    # the Jacobian is remade after each step that is taken.
+    new_jacobian = np.ones(n_chunks, dtype=bool)
+    active = np.ones(n_chunks, dtype=bool)
+    converged = np.zeros(n_chunks, dtype=bool)
+
+    while np.any(active):
+        # Jacobian by forward differences, as MINPACK's fdjac2. lmfit stops a fit
+        # at the evaluation that takes it over the maximum number of evaluations.
+        rows = np.where(active & new_jacobian)[0]
+        stop = rows[n_fev[rows] + n_vary[rows] > max_n_fev]
+        active[stop] = False
+        rows = rows[n_fev[rows] + n_vary[rows] <= max_n_fev]
+        if len(rows) > 0:
+            jac[rows] = _forward_jacobian(residual, internal[rows], fvec[rows], rows)
+            jac[rows] = jac[rows] * vary[rows, np.newaxis, :]
+            n_fev[rows] += n_vary[rows]
+            column_norm = np.linalg.norm(jac[rows], axis=1)
+            # the scale of the parameters is set by the first Jacobian and then only
+            # grows, and the first trust region is a factor larger than the parameters.
+            start = rows[first[rows]]
+            diag[start] = np.where(
+                column_norm[first[rows]] > 0, column_norm[first[rows]], 1
+            )
+            xnorm[start] = np.linalg.norm(diag[start] * internal[start], axis=1)
+            delta[start] = np.where(xnorm[start] > 0, _factor * xnorm[start], _factor)
+            diag[rows] = np.maximum(diag[rows], column_norm)
+            new_jacobian[rows] = False
+            # the largest cosine between the residuals and the columns of the
+            # Jacobian. If it is zero no step can improve the fit.
+            with np.errstate(all="ignore"):
+                cosine = np.abs(np.einsum("kni,kn->ki", jac[rows], fvec[rows])) / (
+                    column_norm * fnorm[rows, np.newaxis]
+                )
+                gnorm[rows] = np.where(
+                    fnorm[rows] > 0,
+                    np.max(np.where(column_norm > 0, cosine, 0), axis=1),
+                    0,
+                )
+            flat = rows[gnorm[rows] == 0]
+            converged[flat] = True
+            active[flat] = False
+
+        rows = np.where(active)[0]
+        stop = rows[n_fev[rows] + 1 > max_n_fev]
+        active[stop] = False
+        rows = rows[n_fev[rows] + 1 <= max_n_fev]
+        if len(rows) == 0:
+            continue
+
+        # the step within the trust region, as MINPACK's lmpar.
+        step, par[rows] = _trust_region_step(
+            jac[rows], fvec[rows], diag[rows], delta[rows], par[rows]
+        )
+        pnorm = np.linalg.norm(diag[rows] * step, axis=1)
+        delta[rows] = np.where(first[rows], np.minimum(delta[rows], pnorm), delta[rows])
+
+        trial = internal[rows] + step
+        trial_fvec = residual(trial, rows)
+        n_fev[rows] += 1
+        fnorm1 = np.linalg.norm(trial_fvec, axis=1)
+
+        # the actual and predicted reductions of the cost, relative to the cost.
+        with np.errstate(all="ignore"):
+            actual = np.where(
+                0.1 * fnorm1 < fnorm[rows], 1 - (fnorm1 / fnorm[rows]) ** 2, -1
+            )
+            temp1 = (
+                np.linalg.norm(np.einsum("kni,ki->kn", jac[rows], step), axis=1)
+                / fnorm[rows]
+            )
+            temp2 = np.sqrt(par[rows]) * pnorm / fnorm[rows]
+            predicted = temp1**2 + temp2**2 / 0.5
+            derivative = -(temp1**2 + temp2**2)
+            ratio = np.where(predicted != 0, actual / predicted, 0)
+
+            # update the trust region by how well the reduction was predicted.
+            temp = np.where(
+                actual >= 0, 0.5, 0.5 * derivative / (derivative + 0.5 * actual)
+            )
+            temp = np.where((0.1 * fnorm1 >= fnorm[rows]) | (temp < 0.1), 0.1, temp)
+            shrink = ratio <= 0.25
+            grow = ~shrink & ((par[rows] == 0) | (ratio >= 0.75))
+            delta[rows] = np.where(
+                shrink,
+                temp * np.minimum(delta[rows], pnorm / 0.1),
+                np.where(grow, pnorm / 0.5, delta[rows]),
+            )
+            par[rows] = np.where(
+                shrink, par[rows] / temp, np.where(grow, 0.5 * par[rows], par[rows])
+            )
+
+        # take the step if it made a reasonable part of the predicted reduction.
+        success = rows[ratio >= 1e-4]
+        internal[success] = trial[ratio >= 1e-4]
+        fvec[success] = trial_fvec[ratio >= 1e-4]
+        fnorm[success] = fnorm1[ratio >= 1e-4]
+        xnorm[success] = np.linalg.norm(diag[success] * internal[success], axis=1)
+        first[success] = False
+        new_jacobian[success] = True
+
+        # convergence: the actual and predicted reductions are both small, or the
+        # trust region is small compared to the parameters.
+        done = (
+            (np.abs(actual) <= _ftol) & (predicted <= _ftol) & (0.5 * ratio <= 1)
+        ) | (delta[rows] <= _xtol * xnorm[rows])
+        converged[rows[done]] = True
+        active[rows[done]] = False
+        # the tolerances are too small for any further improvement, which lmfit
+        # reports without errors.
+        stuck = (
+            ((np.abs(actual) <= _epsmch) & (predicted <= _epsmch) & (0.5 * ratio <= 1))
+            | (delta[rows] <= _epsmch * xnorm[rows])
+            | (gnorm[rows] <= _epsmch)
+        )
+        active[rows[stuck]] = False
+
+    # errors from the covariance matrix of the varied parameters, as lmfit: it is
+    # found from the last Jacobian of the internal values, so there are no errors if a
+    # parameter is on a bound, and is scaled by the reduced chi-squared. Fits that do
+    # not converge have no errors.
+    value = np.where(vary, _to_external(internal, lower, upper), value)
+    grad = _gradient(internal, lower, upper)
+    out = []
+    for k, params in enumerate(chunk_params):
+        params = params.copy()
+        for i, name in enumerate(names):
+            params[name].value = value[k, i]
+            params[name].stderr = None
+        free = np.where(vary[k])[0]
+        n_free = n_data[k] - len(free)
+        if converged[k] and n_free > 0 and len(free) > 0:
+            jac_free = jac[k, : n_data[k]][:, free]
+            try:
+                covar = np.linalg.inv(jac_free.T @ jac_free)
+            except np.linalg.LinAlgError:
+                covar = None
+            if covar is not None:
+                covar = (
+                    covar
+                    * np.outer(grad[k, free], grad[k, free])
+                    * fnorm[k] ** 2
+                    / n_free
+                )
+                for name in names:
+                    params[name].stderr = 0
+                for i, c in enumerate(free):
+                    params[names[c]].stderr = float(np.sqrt(np.abs(covar[i, i])))
+        out.append(params)
+    return out
+
+
+def _forward_jacobian(residual, internal, fvec, rows):
+    """
+    Jacobian of the residuals by forward differences, with the steps of MINPACK's
+    fdjac2 for lmfit's epsfcn.
+    :param residual: function of the internal values and rows giving the residuals
+    :param internal: array of the internal values for the rows
+    :param fvec: array of the residuals at the internal values
+    :param rows: index of the chunks
+    :return: array of size (rows, data, parameters)
+    """
+    eps = np.sqrt(max(_epsfcn, _epsmch))
+    jac = np.zeros(fvec.shape + (internal.shape[1],))
+    for i in range(internal.shape[1]):
+        step = eps * np.abs(internal[:, i])
+        step[step == 0] = eps
+        moved = internal.copy()
+        moved[:, i] = moved[:, i] + step
+        jac[:, :, i] = (residual(moved, rows) - fvec) / step[:, np.newaxis]
+    return jac
+
+
+def _trust_region_step(jac, fvec, diag, delta, par):
+    """
+    Levenberg-Marquardt step within the trust region of each chunk, as MINPACK's lmpar.
+    The damping parameter is found so that the scaled length of the step is within 10%
+    of the trust region, or is zero if the Gauss-Newton step is inside it.
+    :param jac: array of the Jacobians, size (chunks, data, parameters)
+    :param fvec: array of the residuals, size (chunks, data)
+    :param diag: array of the scales of the parameters
+    :param delta: array of the sizes of the trust regions
+    :param par: array of the damping parameters of the last steps
+    :return: array of the steps and array of the damping parameters
+    """
+    n_chunks, n_data, n_par = jac.shape
+    gradient = np.einsum("kni,kn->ki", jac, fvec)
+    # parameters that do not change the residuals do not move.
+    still = np.all(jac == 0, axis=1)
+    squared = diag**2
+
+    def solve(damping):
+        """steps for the damping parameters, and the triangular factors of the damped
+        Jacobians, from the QR decomposition of the Jacobians augmented by the
+        damping (as MINPACK's qrsolv), which keeps the conditioning of the Jacobians"""
+        damped = np.sqrt(damping)[:, np.newaxis] * diag
+        damped[still] = 1
+        augmented = np.concatenate(
+            [jac, damped[:, :, np.newaxis] * np.eye(n_par)], axis=1
+        )
+        target = np.concatenate([fvec, np.zeros((n_chunks, n_par))], axis=1)
+        q, r = np.linalg.qr(augmented)
+        projected = np.einsum("kmi,km->ki", q, target)
+        try:
+            return -np.linalg.solve(r, projected[:, :, np.newaxis])[:, :, 0], r
+        except np.linalg.LinAlgError:
+            return (
+                -np.stack(
+                    [
+                        np.linalg.lstsq(a, b, rcond=None)[0]
+                        for a, b in zip(augmented, target)
+                    ]
+                ),
+                r,
+            )
+
+    def correction(step, r, norm):
+        """squared length used by the Newton correction of the damping parameter"""
+        scaled = squared * step / norm[:, np.newaxis]
+        try:
+            projected = np.linalg.solve(np.swapaxes(r, 1, 2), scaled[:, :, np.newaxis])[
+                :, :, 0
+            ]
+        except np.linalg.LinAlgError:
+            projected = np.stack(
+                [np.linalg.lstsq(a.T, b, rcond=None)[0] for a, b in zip(r, scaled)]
+            )
+        return np.sum(projected**2, axis=1)
+
+    with np.errstate(all="ignore"):
+        # the Gauss-Newton step.
+        step, system = solve(np.zeros(len(delta)))
+        dxnorm = np.linalg.norm(diag * step, axis=1)
+        fp = dxnorm - delta
+        searching = fp > 0.1 * delta
+        par = np.where(searching, par, 0)
+
+        # bounds on the damping parameter.
+        full_rank = np.linalg.matrix_rank(jac) == np.sum(~still, axis=1)
+        lower = np.where(full_rank, (fp / delta) / correction(step, system, dxnorm), 0)
+        lower = np.where(np.isfinite(lower) & (lower > 0), lower, 0)
+        gnorm = np.linalg.norm(gradient / diag, axis=1)
+        upper = gnorm / delta
+        upper = np.where(upper == 0, _dwarf / np.minimum(delta, 0.1), upper)
+        par = np.minimum(np.maximum(par, lower), upper)
+        par = np.where(par == 0, gnorm / dxnorm, par)
+        par = np.where(searching, par, 0)
+
+        for iteration in range(10):
+            if not np.any(searching):
+                break
+            par = np.where(
+                searching & (par == 0), np.maximum(_dwarf, 0.001 * upper), par
+            )
+            trial, system = solve(np.where(searching, par, 0))
+            step = np.where(searching[:, np.newaxis], trial, step)
+            dxnorm = np.linalg.norm(diag * step, axis=1)
+            previous = fp
+            fp = np.where(searching, dxnorm - delta, fp)
+            found = (
+                (np.abs(fp) <= 0.1 * delta)
+                | ((lower == 0) & (fp <= previous) & (previous < 0))
+                | (iteration == 9)
+            )
+            searching = searching & ~found
+            change = (fp / delta) / correction(step, system, dxnorm)
+            lower = np.where(searching & (fp > 0), np.maximum(lower, par), lower)
+            upper = np.where(searching & (fp < 0), np.minimum(upper, par), upper)
+            par = np.where(searching, np.maximum(lower, par + change), par)
+    return step, par
+
+
+def _layout(names):
+    """
+    Positions of the background and peak parameters in the list of names.
+    :param names: list of parameter names
+    :return: list of (position, power of two theta) for the background, and list of
+        dicts of the positions of d, h, w and p for each peak.
+    """
+    background = []
+    i = 0
+    while "bg_c" + str(i) + "_f0" in names:
+        background.append((names.index("bg_c" + str(i) + "_f0"), float(i)))
+        i = i + 1
+    peaks = []
+    a = 0
+    while "peak_" + str(a) + "_d0" in names:
+        peaks.append(
+            {comp: names.index("peak_" + str(a) + "_" + comp + "0") for comp in "dhwp"}
+        )
+        a = a + 1
+    if len(background) + 4 * len(peaks) != len(names):
+        raise ValueError("The chunk parameters are not all background or peak values.")
+    return background, peaks
+
+
+def _conversion(chunk_data, d_spacing):
+    """
+    Convert the d-spacing of each chunk to two theta (or energy).
+    :param chunk_data: list of data classes
+    :param d_spacing: array of a d-spacing for each chunk
+    :return: array of two theta for each chunk
+    """
+    return np.array(
+        [
+            np.ravel(data.conversion(np.array([d]), reverse=1))[0]
+            for data, d in zip(chunk_data, d_spacing)
+        ],
+        dtype=float,
+    )
+
+
+def _to_internal(value, lower, upper):
+    """
+    Unbounded internal values of the parameters (the MINUIT transformation, as lmfit).
+    """
+    both, low, high = _bound_types(lower, upper)
+    with np.errstate(all="ignore"):
+        return np.select(
+            [both, low, high],
+            [
+                np.arcsin(2 * (value - lower) / (upper - lower) - 1),
+                np.sqrt((value - lower + 1) ** 2 - 1),
+                np.sqrt((upper - value + 1) ** 2 - 1),
+            ],
+            value,
+        )
+
+
+def _to_external(internal, lower, upper):
+    """
+    Parameter values from the internal values.
+    """
+    both, low, high = _bound_types(lower, upper)
+    with np.errstate(all="ignore"):
+        return np.select(
+            [both, low, high],
+            [
+                lower + (np.sin(internal) + 1) * (upper - lower) / 2,
+                lower - 1 + np.sqrt(internal**2 + 1),
+                upper + 1 - np.sqrt(internal**2 + 1),
+            ],
+            internal,
+        )
+
+
+def _gradient(internal, lower, upper):
+    """
+    Derivative of the parameter values with respect to the internal values.
+    """
+    both, low, high = _bound_types(lower, upper)
+    with np.errstate(all="ignore"):
+        return np.select(
+            [both, low, high],
+            [
+                np.cos(internal) * (upper - lower) / 2,
+                internal / np.sqrt(internal**2 + 1),
+                -internal / np.sqrt(internal**2 + 1),
+            ],
+            np.ones_like(internal),
+        )
+
+
+def _bound_types(lower, upper):
+    """
+    Which parameters are bounded on both sides, below only and above only.
+    """
+    finite_lower = np.isfinite(lower)
+    finite_upper = np.isfinite(upper)
+    return (
+        finite_lower & finite_upper,
+        finite_lower & ~finite_upper,
+        ~finite_lower & finite_upper,
+    )
@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the fitting with synthetic data.
+
+Synthetic data sets, with known peak parameters, are made with lmfit_model.peaks_model
+as the forward model. Each data set is a series of images on a (generic, pyFAI)
+detector of a chosen size with a Dioptas calibration (*.poni) and an input file, so it
+is read and fitted in the same way as real data. The size of the detector, the
+number of peaks, the orders and type of the series, the number of images and the noise
+are all chosen for each case.
+
+For each case the time taken to read the data (fill_data), to fit the chunks of a
+subpattern (fit_chunks), to fit a subpattern (fit_sub_pattern), to fit all the images
+(execute) and to write the output files (write_output) is measured, along with the
+error in the fitted d-spacings. The results are saved as a JSON file, which can be
+used as the baseline of later runs: times (or errors) that are larger than the
+baseline's by more than a tolerance are reported as regressions.
+
+From the command line:
+    python -m cpf.benchmark --save baseline.json
+    python -m cpf.benchmark --baseline baseline.json
+"""
+
+__all__ = [
+    "default_cases",
+    "make_synthetic_data",
+    "run_case",
+    "run_benchmark",
+    "compare_to_baseline",
+]
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fabio
+import numpy as np
+import pyFAI
+from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+from pyFAI.detectors import Detector
+
+import cpf.lmfit_model as lmm
+import cpf.series_functions as sf
+from cpf.fitsubpattern_chunks import fit_chunks
+from cpf.input_types.DioptasFunctions import DioptasDetector
+from cpf.IO_functions import json_numpy_serializer
+from cpf.logger_functions import logger
+from cpf.results_store import load_fits
+from cpf.XRD_FitPattern import execute, initiate, write_output
+from cpf.XRD_FitSubpattern import fit_sub_pattern
+
+# stages that are timed, in order.
+stages = ["fill_data", "fit_chunks", "fit_sub_pattern", "execute", "write_output"]
+
+# geometry of the synthetic detector.
+_pixel_size = 172e-6  # m
+_distance = 0.2  # m
+_wavelength = 0.4066e-10  # m
+
+_component_names = {"d": "d-space", "h": "height", "w": "width", "p": "profile"}
+
+
+def default_cases():
+    """
+    The cases run by default: a small reference case and cases that scale each of its
+    properties in turn.
+    :return: list of dicts of the arguments of make_synthetic_data, with a name
+    """
+    orders = {"d-space": 2, "height": 4, "width": 1, "profile": 0}
+    small = {
+        "name": "small",
+        "shape": [512, 512],
+        "n_peaks": 1,
+        "orders": orders,
+        "series_type": "fourier",
+        "n_images": 3,
+        "noise": 1.0,
+    }
+    return [
+        small,
+        {**small, "name": "detector-1024", "shape": [1024, 1024]},
+        {**small, "name": "detector-2048", "shape": [2048, 2048]},
+        {**small, "name": "peaks-4", "n_peaks": 4},
+        {
+            **small,
+            "name": "orders-high",
+            "orders": {"d-space": 4, "height": 12, "width": 4, "profile": 2},
+        },
+        {**small, "name": "spline", "series_type": "spline-cubic"},
+        {**small, "name": "images-10", "n_images": 10},
+        {**small, "name": "noise-10", "noise": 10.0},
+    ]
+
+
+def make_synthetic_data(
+    directory,
+    shape=(512, 512),
+    n_peaks=1,
+    orders=None,
+    series_type="fourier",
+    n_images=3,
+    noise=1.0,
+    seed=0,
+    name="synthetic",
+    **kwargs,
+):
+    """
+    Make a synthetic data set: a series of images, the calibration and an input file.
+    The peaks are rings spread over the two theta range that is complete on the
+    detector, each in its own subpattern. Their d-spacings change slightly from image
+    to image.
+    :param directory: directory to write the data set to
+    :param shape: shape of the detector (pixels)
+    :param n_peaks: number of peaks (and subpatterns)
+    :param orders: dict of the orders of the series of "d-space", "height", "width"
+        and "profile" (default 2, 4, 1 and 0)
+    :param series_type: type of the series ("fourier" or a spline)
+    :param n_images: number of images
+    :param noise: noise, as a multiple of the square root of the intensity (1 is the
+        counting noise)
+    :param seed: seed of the random numbers
+    :param name: base name of the files
+    :return: dict of the input file name and the true parameters of each image
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    if orders is None:
+        orders = {"d-space": 2, "height": 4, "width": 1, "profile": 0}
+    rng = np.random.default_rng(seed)
+
+    # calibration: the beam is at the centre of the detector.
+    detector = Detector(
+        pixel1=_pixel_size, pixel2=_pixel_size, max_shape=tuple(int(s) for s in shape)
+    )
+    integrator = AzimuthalIntegrator(
+        dist=_distance,
+        poni1=shape[0] * _pixel_size / 2,
+        poni2=shape[1] * _pixel_size / 2,
+        detector=detector,
+        wavelength=_wavelength,
+    )
+    calibration_file = directory / (name + ".poni")
+    if calibration_file.exists():
+        calibration_file.unlink()
+    integrator.write(str(calibration_file))
+
+    data_class = DioptasDetector()
+    data_class.get_calibration(file_name=str(calibration_file))
+    data_class.get_detector()
+    two_theta, azimuth = data_class.get_geometry()
+    start_end = [
+        np.around(np.min(azimuth) / data_class.azm_blocks) * data_class.azm_blocks,
+        np.around(np.max(azimuth) / data_class.azm_blocks) * data_class.azm_blocks,
+    ]
+
+    # the peaks are spread over the complete rings, each with its own range.
+    two_theta_max = np.degrees(np.arctan(min(shape) * _pixel_size / 2 / _distance))
+    peak_two_theta = two_theta_max * (np.arange(n_peaks) + 1.5) / (n_peaks + 1.5)
+    half_range = min(0.25, 0.3 * two_theta_max / (n_peaks + 1.5))
+    width = half_range / 8
+    background = 10.0
+
+    coefficient_type = sf.coefficient_type_as_number(series_type)
+    truth = {"bg_c0_f0": background}
+    fit_orders = []
+    for k in range(n_peaks):
+        d_spacing = data_class.conversion(peak_two_theta[k])
+        for comp, value, spread in [
+            ("d", d_spacing, 1e-3),
+            ("h", 100.0 * (1 + k) / n_peaks, 0.2),
+            ("w", width, 0.1),
+            ("p", 0.5, 0.1),
+        ]:
+            n_coeff = 2 * orders[_component_names[comp]] + 1
+            if coefficient_type == 0:
+                # fourier: the mean and the (smaller) harmonics
+                coeffs = np.concatenate(
+                    [[value], value * spread * rng.uniform(-1, 1, n_coeff - 1) / 2]
+                )
+            else:
+                # spline: the values at the knots
+                coeffs = value * (1 + spread * rng.uniform(-1, 1, n_coeff) / 2)
+            if comp == "p":
+                coeffs = np.clip(coeffs, 0, 1)
+            for n, coeff in enumerate(coeffs):
+                truth["peak_" + str(k) + "_" + comp + str(n)] = coeff
+            truth["peak_" + str(k) + "_" + comp + "_tp"] = coefficient_type
+        peak = {
+            comp_name: orders[comp_name]
+            for comp_name in ["d-space", "height", "width", "profile"]
+        }
+        peak["symmetry"] = 1
+        if coefficient_type != 0:
+            for comp_name in ["d-space", "height", "width", "profile"]:
+                peak[comp_name + "-type"] = series_type
+        fit_orders.append(
+            {
+                "background": [0],
+                "peak": [peak],
+                "range": [
+                    [peak_two_theta[k] - half_range, peak_two_theta[k] + half_range]
+                ],
+            }
+        )
+
+    # the images. The d-spacings are reduced a little in each image.
+    image_truth = []
+    for j in range(n_images):
+        params = dict(truth)
+        for k in range(n_peaks):
+            prefix = "peak_" + str(k) + "_d"
+            for key in params:
+                if key.startswith(prefix) and not key.endswith("_tp"):
+                    params[key] = truth[key] * (1 - 2e-4 * j)
+        intensity = np.zeros(two_theta.size)
+        # each peak is evaluated only within its range.
+        for k in range(n_peaks):
+            near = np.abs(two_theta.flatten() - peak_two_theta[k]) < 2 * half_range
+            peak_params = {
+                key.replace("peak_" + str(k) + "_", "peak_0_"): value
+                for key, value in params.items()
+                if key.startswith("peak_" + str(k) + "_")
+            }
+            peak_params["bg_c0_f0"] = 0
+            intensity[near] += lmm.peaks_model(
+                two_theta.flatten()[near],
+                azimuth.flatten()[near],
+                data_class=data_class,
+                orders={"range": [0, 0]},
+                start_end=start_end,
+                **peak_params,
+            )
+        intensity = intensity + background
+        intensity = intensity + noise * np.sqrt(intensity) * rng.standard_normal(
+            intensity.size
+        )
+        # the images are flipped when they are read (as Dioptas does).
+        image = intensity.reshape(two_theta.shape)[::-1].astype(np.float32)
+        fabio.tifimage.TifImage(data=image).write(
+            str(directory / (name + "_%05i.tif" % (j + 1)))
+        )
+        image_truth.append(params)
+
+    input_file = directory / (name + "_input.py")
+    with open(input_file, "w") as f:
+        f.write("# Synthetic data made by cpf.benchmark.\n\n")
+        f.write("datafile_directory = %r\n" % (str(directory) + os.sep))
+        f.write("datafile_Basename = %r\n" % (name + "_"))
+        f.write('datafile_Ending = ".tif"\n')
+        f.write("datafile_StartNum = 1\n")
+        f.write("datafile_EndNum = %i\n" % n_images)
+        f.write("datafile_NumDigit = 5\n\n")
+        f.write('Calib_type = "Dioptas"\n')
+        f.write('Calib_detector = "Detector"\n')
+        f.write("Calib_param = %r\n" % str(calibration_file))
+        f.write("Calib_pixels = %i\n\n" % int(_pixel_size * 1e6))
+        f.write("fit_orders = %s\n\n" % json.dumps(fit_orders, indent=4))
+        f.write("AziBins = 90\n\n")
+        f.write("Output_directory = %r\n" % (str(directory) + os.sep))
+
+    return {
+        "input_file": str(input_file),
+        "truth": image_truth,
+        "start_end": start_end,
+    }
+
+
+def _timed(function, *args, **kwargs):
+    """
+    :return: the result of function and the time it took
+    """
+    start = time.perf_counter()
+    out = function(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def run_case(case, directory, repeats=3, parallel=False, outputs=None):
+    """
+    Make the data of a case and time each stage of fitting it.
+    :param case: dict of the arguments of make_synthetic_data, with a name
+    :param directory: directory for the data and the fits
+    :param repeats: number of times that the stages of a single subpattern are
+        repeated; the shortest time is kept
+    :param parallel: fit the images in parallel
+    :param outputs: output types to write (default CoefficientTable)
+    :return: dict of the case, the times of the stages and the largest error in the
+        fitted d-spacings (as a fraction of the d-spacing)
+    """
+    if outputs is None:
+        outputs = ["CoefficientTable"]
+    name = case.get("name", "synthetic")
+    data = make_synthetic_data(Path(directory) / name, **case)
+    times = {}
+
+    settings_for_fit = initiate(data["input_file"])
+    data_class = settings_for_fit.data_class
+    times["fill_data"] = min(
+        _timed(
+            data_class.fill_data,
+            settings_for_fit.image_list[0],
+            settings=settings_for_fit,
+        )[1]
+        for _ in range(repeats)
+    )
+
+    # a single subpattern of the first image.
+    settings_for_fit.set_subpattern(0, 0)
+    sub_data = data_class.subpattern(
+        data_class.limits_index(range_bounds=settings_for_fit.fit_orders[0]["range"])
+    )
+    # with the same options as execute uses.
+    times["fit_chunks"] = min(
+        _timed(fit_chunks, sub_data, settings_for_fit, fit_method="leastsq")[1]
+        for _ in range(repeats)
+    )
+    times["fit_sub_pattern"] = min(
+        _timed(
+            fit_sub_pattern,
+            sub_data,
+            settings_for_fit,
+            None,
+            debug=False,
+            iterations=1,
+            min_data_intensity=settings_for_fit.fit_min_data_intensity,
+            min_peak_intensity=settings_for_fit.fit_min_peak_intensity,
+            fit_method="leastsq",
+        )[1]
+        for _ in range(repeats)
+    )
+
+    # all the images.
+    settings_for_fit = initiate(data["input_file"])
+    times["execute"] = _timed(
+        execute, setting_class=settings_for_fit, parallel=parallel
+    )[1]
+    times["write_output"] = _timed(
+        write_output, setting_class=settings_for_fit, out_type=outputs
+    )[1]
+
+    return {
+        "case": {key: value for key, value in case.items()},
+        "times": times,
+        "d-space-error": _d_space_error(settings_for_fit, data),
+    }
+
+
+def _d_space_error(settings_for_fit, data):
+    """
+    Largest difference between the fitted and true d-spacings, over all the images,
+    peaks and azimuths, as a fraction of the d-spacing.
+    """
+    azimuths = np.linspace(data["start_end"][0], data["start_end"][1], 73)
+    error = 0.0
+    all_fits = load_fits(settings_for_fit, range(len(data["truth"])))
+    for truth, fits in zip(data["truth"], all_fits):
+        for k, fit in enumerate(fits):
+            true_coeffs = [
+                truth["peak_" + str(k) + "_d" + str(n)]
+                for n in range(len(fit["peak"][0]["d-space"]))
+            ]
+            coeff_type = truth["peak_" + str(k) + "_d_tp"]
+            true_d = sf.coefficient_expand(
+                azimuths,
+                param=true_coeffs,
+                coeff_type=coeff_type,
+                start_end=data["start_end"],
+            )
+            if any(value is None for value in fit["peak"][0]["d-space"]):
+                return np.inf
+            fit_d = sf.coefficient_expand(
+                azimuths,
+                param=fit["peak"][0]["d-space"],
+                coeff_type=fit["peak"][0]["d-space_type"],
+                start_end=data["start_end"],
+            )
+            error = max(error, float(np.max(np.abs(fit_d - true_d) / true_d)))
+    return error
+
+
+def run_benchmark(
+    cases=None,
+    directory=None,
+    repeats=3,
+    parallel=False,
+    results_file=None,
+    baseline=None,
+    tolerance=0.25,
+):
+    """
+    Run the benchmark cases and compare them with a baseline.
+    :param cases: list of cases (default default_cases())
+    :param directory: directory for the data and fits (default a temporary directory)
+    :param repeats: number of repeats of the single subpattern stages
+    :param parallel: fit the images in parallel
+    :param results_file: JSON file to save the results to, or None
+    :param baseline: results, or the name of a results file, to compare with, or None
+    :param tolerance: fractional increase in a time (or error) that is a regression
+    :return: results and list of regressions
+    """
+    if cases is None:
+        cases = default_cases()
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pyFAI": pyFAI.version,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+        },
+        "cases": [],
+    }
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        if directory is None:
+            directory = temporary_directory
+        for case in cases:
+            logger.info(" ".join(map(str, [("Benchmark case: %s" % case.get("name"))])))
+            results["cases"].append(
+                run_case(case, directory, repeats=repeats, parallel=parallel)
+            )
+
+    if results_file is not None:
+        with open(results_file, "w") as f:
+            json.dump(results, f, indent=2, default=json_numpy_serializer)
+
+    regressions = []
+    if baseline is not None:
+        if not isinstance(baseline, dict):
+            with open(baseline) as f:
+                baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, tolerance=tolerance)
+    return results, regressions
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25, min_time=0.05):
+    """
+    Find the stages that take longer (and the fits that are worse) than the baseline.
+    Cases are matched by name; cases that are not in both are ignored.
+    :param results: results of run_benchmark
+    :param baseline: results of an earlier run_benchmark
+    :param tolerance: fractional increase that is a regression
+    :param min_time: times shorter than this (s) are too noisy to compare
+    :return: list of dicts of the case, stage, baseline and new values and their ratio
+    """
+    old_cases = {case["case"]["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        name = case["case"]["name"]
+        if name not in old_cases:
+            continue
+        old = old_cases[name]
+        compare = [
+            (stage, old["times"][stage], case["times"][stage], min_time)
+            for stage in stages
+            if stage in old["times"] and stage in case["times"]
+        ]
+        # errors are allowed to be a little worse: the fits are of noisy data.
+        compare.append(
+            ("d-space-error", old["d-space-error"], case["d-space-error"], 1e-6)
+        )
+        for stage, old_value, new_value, floor in compare:
+            if new_value > floor and new_value > old_value * (1 + tolerance):
+                regressions.append(
+                    {
+                        "case": name,
+                        "stage": stage,
+                        "baseline": old_value,
+                        "new": new_value,
+                        "ratio": new_value / old_value if old_value else np.inf,
+                    }
+                )
+    return regressions
+
+
+def main(argv=None):
+    """
+    Run the benchmark from the command line.
+    :return: 1 if there are regressions, otherwise 0
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m cpf.benchmark",
+        description="Benchmark the fitting with synthetic data.",
+    )
+    parser.add_argument(
+        "--cases",
+        help="comma separated names of the cases to run (default: all); one of "
+        + ", ".join(case["name"] for case in default_cases()),
+    )
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--save", help="file to save the results to")
+    parser.add_argument("--directory", help="directory for the data and the fits")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--parallel", action="store_true")
+    args = parser.parse_args(argv)
+
+    cases = default_cases()
+    if args.cases:
+        names = args.cases.split(",")
+        cases = [case for case in cases if case["name"] in names]
+    results, regressions = run_benchmark(
+        cases=cases,
+        directory=args.directory,
+        repeats=args.repeats,
+        parallel=args.parallel,
+        results_file=args.save,
+        baseline=args.baseline,
+        tolerance=args.tolerance,
+    )
+    for case in results["cases"]:
+        print(
+            "%-16s %s; d-space error %.2g"
+            % (
+                case["case"]["name"],
+                "; ".join(
+                    "%s %.3fs" % (stage, case["times"][stage]) for stage in stages
+                ),
+                case["d-space-error"],
+            )
+        )
+    for regression in regressions:
+        print(
+            "REGRESSION %(case)s %(stage)s: %(baseline).3g -> %(new).3g (x%(ratio).2f)"
+            % regression
+        )
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
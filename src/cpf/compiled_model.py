@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""
+Precompiled form of the peak and background model (lmfit_model.peaks_model).
+
+The model is linear in the series coefficients of each component, so for a fixed set of
+positions each component is the product of a design matrix and its coefficients. The
+matrices and the layout of the coefficients are made once per subpattern, which removes
+the string parsing of the parameter names from every evaluation of the model.
+
+Optionally the peaks are only evaluated within a window of a number of peak widths
+around their centres, which is found from an index of the sorted two theta values made
+with the model. The largest intensity omitted from the tails of the peaks is kept as
+truncation_error.
+"""
+
+__all__ = ["CompiledModel"]
+
+import numpy as np
+
+import cpf.peak_functions as pf
+import cpf.series_functions as sf
+
+
+class CompiledModel:
+    """
+    Design matrices and parameter layout for the peaks model of one subpattern.
+
+    The coefficients are held as a flat vector, ordered as in the lmfit Parameters
+    class the model was made from. Parameters that are not series coefficients
+    (the series types and symmetries) are fixed when the model is made.
+    """
+
+    def __init__(
+        self,
+        params,
+        two_theta,
+        azimuth,
+        data_class=None,
+        orders=None,
+        start_end=[0, 360],
+        window=None,
+    ):
+        """
+        :param params: lmfit Parameter class or dict of the parameter values
+        :param two_theta: arr values float
+        :param azimuth: arr values float
+        :param data_class: data class containing the conversion function
+        :param orders: orders dictionary to get minimum position of the range
+        :param start_end: start and end of azimuths
+        :param window: half width, as a number of peak widths, of the window the peaks
+            are evaluated in, or None to evaluate the peaks at every position
+        """
+        if hasattr(params, "valuesdict"):
+            params = params.valuesdict()
+
+        self.data_class = data_class
+        self.start_end = start_end
+        self.shape = np.shape(azimuth)
+        self.two_theta = np.asarray(two_theta, dtype=float).flatten()
+        self.azimuth = np.asarray(azimuth, dtype=float).flatten()
+        self.window = window
+        if window is not None:
+            self.sort_index = np.argsort(self.two_theta, kind="stable")
+        else:
+            self.sort_index = None
+        # largest peak intensity omitted by the window in the last evaluation.
+        self.truncation_error = 0.0
+
+        self.names = []
+
+        # background: a design matrix and power of two theta for each order.
+        # N.B. the background is expanded with the default start_end.
+        two_theta_prime = self.two_theta - orders["range"][0]
+        self.background = []
+        i = 0
+        while "bg_c" + str(i) + "_f0" in params:
+            param_str = "bg_c" + str(i)
+            names = self._series_names(params, param_str, "f")
+            self.background.append(
+                (
+                    slice(len(self.names), len(self.names) + len(names)),
+                    sf.coefficient_basis(
+                        self.azimuth,
+                        len(names),
+                        coeff_type=sf.get_series_type(params, param_str, "f"),
+                    ),
+                    two_theta_prime ** float(i),
+                )
+            )
+            self.names.extend(names)
+            i = i + 1
+
+        # peaks: a design matrix and slice of the coefficient vector for each component.
+        self.peaks = []
+        a = 0
+        while "peak_" + str(a) + "_d0" in params:
+            param_str = "peak_" + str(a)
+            if param_str + "_s0" in params:
+                symm = params[param_str + "_s0"]
+            else:
+                symm = 1
+            peak = {}
+            for comp in ["d", "h", "w", "p"]:
+                names = self._series_names(params, param_str, comp)
+                if comp == "d" or symm == 1:
+                    azm = self.azimuth
+                else:
+                    azm = self.azimuth * symm
+                peak[comp] = (
+                    slice(len(self.names), len(self.names) + len(names)),
+                    sf.coefficient_basis(
+                        azm,
+                        len(names),
+                        coeff_type=sf.get_series_type(params, param_str, comp),
+                        start_end=start_end,
+                    ),
+                )
+                self.names.extend(names)
+            self.peaks.append(peak)
+            a = a + 1
+
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        # the model is linear in the background and peak height coefficients.
+        positions = np.arange(len(self.names))
+        self.linear_index = np.concatenate(
+            [positions[index] for index, basis, power in self.background]
+            + [positions[peak["h"][0]] for peak in self.peaks]
+        ).astype(int)
+        self.linear_names = [self.names[i] for i in self.linear_index]
+
+    @staticmethod
+    def _series_names(params, param_str, comp):
+        """
+        Names of the coefficients of one series, in order.
+        :param params: dict of the parameter values
+        :param param_str: base string to select parameters
+        :param comp: component to add to base string to select parameters
+        :return: list of parameter names
+        """
+        new_str = param_str + "_" + comp
+        n = 0
+        while new_str + str(n) in params:
+            n = n + 1
+        return [new_str + str(i) for i in range(n)]
+
+    def check_positions(self, two_theta, azimuth):
+        """
+        Raise an error if the positions are not those the model was made for.
+        :param two_theta: arr values float
+        :param azimuth: arr values float
+        """
+        if np.size(two_theta) != self.two_theta.size or np.shape(azimuth) != self.shape:
+            raise ValueError(
+                "The compiled model was made for positions of a different size."
+            )
+
+    def vector(self, params):
+        """
+        Flat vector of the series coefficients.
+        :param params: lmfit Parameter class or dict of the parameter values
+        :return: array of the coefficients
+        """
+        if hasattr(params, "valuesdict"):
+            params = params.valuesdict()
+        return np.array([params[name] for name in self.names], dtype=float)
+
+    @staticmethod
+    def expand(basis, coeffs):
+        """
+        Product of a design matrix and its coefficients.
+        The columns are added in the same order as by series_functions.coefficient_expand
+        so the values are identical to it.
+        :param basis: design matrix of the series
+        :param coeffs: coefficients of the series
+        :return: value of the series at each position
+        """
+        out = basis[:, 0] * coeffs[0]
+        for k in range(1, basis.shape[1]):
+            out = out + basis[:, k] * coeffs[k]
+        return out
+
+    def components(self, vector):
+        """
+        Expand the components of every peak.
+        :param vector: flat vector of the series coefficients
+        :return: list of dicts of the d, h, w and p values at each position
+        """
+        out = []
+        for peak in self.peaks:
+            out.append(
+                {
+                    comp: self.expand(basis, vector[index])
+                    for comp, (index, basis) in peak.items()
+                }
+            )
+        return out
+
+    def evaluate(self, vector):
+        """
+        Intensity of the model at the positions it was made for. Any mask of the
+        positions is not applied.
+        :param vector: flat vector of the series coefficients
+        :return: intensity at each position
+        """
+        intensity = np.zeros(self.azimuth.size)
+        for index, basis, power in self.background:
+            intensity = intensity + self.expand(basis, vector[index]) * power
+        truncation = 0.0
+        for comp in self.components(vector):
+            two_theta_all = self.data_class.conversion(comp["d"], reverse=1)
+            intensity = intensity + pf.pseudo_voigt_peak(
+                self.two_theta,
+                two_theta_all,
+                comp["w"],
+                comp["h"],
+                comp["p"],
+                window=self.window,
+                sort_index=self.sort_index,
+            )
+            if self.window is not None:
+                truncation = max(
+                    truncation,
+                    np.max(
+                        pf.pseudo_voigt_truncation(comp["h"], comp["p"], self.window)
+                    ),
+                )
+        self.truncation_error = float(truncation)
+        return intensity.reshape(self.shape)
+
+    def derivatives(self, vector):
+        """
+        Derivatives of the model intensity with respect to every series coefficient.
+        The derivative of the conversion from d-spacing is evaluated by central
+        difference so that it is independent of the detector type.
+        :param vector: flat vector of the series coefficients
+        :return: array of size (n positions, n coefficients)
+        """
+        derivs = np.zeros((self.two_theta.size, len(self.names)))
+        for index, basis, power in self.background:
+            derivs[:, index] = basis * power[:, np.newaxis]
+        for peak, comp in zip(self.peaks, self.components(vector)):
+            two_theta_all = self.data_class.conversion(comp["d"], reverse=1)
+            d_tth0, d_w, d_h, d_p = pf.pseudo_voigt_derivatives(
+                self.two_theta,
+                two_theta_all,
+                comp["w"],
+                comp["h"],
+                comp["p"],
+                window=self.window,
+                sort_index=self.sort_index,
+            )
+            d_comp = {
+                "d": d_tth0 * self._conversion_gradient(comp["d"]),
+                "h": d_h,
+                "w": d_w,
+                "p": d_p,
+            }
+            for c, (index, basis) in peak.items():
+                derivs[:, index] = basis * d_comp[c][:, np.newaxis]
+        return derivs
+
+    def linear_design(self, vector):
+        """
+        Design matrix of the linear (background and peak height) coefficients for the
+        other coefficients in vector. The model intensity is the product of this
+        matrix and the linear coefficients, vector[self.linear_index].
+        :param vector: flat vector of the series coefficients
+        :return: array of size (n positions, n linear coefficients)
+        """
+        design = np.zeros((self.two_theta.size, len(self.names)))
+        for index, basis, power in self.background:
+            design[:, index] = basis * power[:, np.newaxis]
+        for peak, comp in zip(self.peaks, self.components(vector)):
+            two_theta_all = self.data_class.conversion(comp["d"], reverse=1)
+            # the peak shape with unit height
+            shape = pf.pseudo_voigt_peak(
+                self.two_theta,
+                two_theta_all,
+                comp["w"],
+                1,
+                comp["p"],
+                window=self.window,
+                sort_index=self.sort_index,
+            )
+            index, basis = peak["h"]
+            design[:, index] = basis * shape[:, np.newaxis]
+        return design[:, self.linear_index]
+
+    def _conversion_gradient(self, d_spacing):
+        """
+        Gradient of the d-spacing to dispersion (two theta or energy) conversion.
+        :param d_spacing: d-spacings to evaluate the gradient at
+        :return: gradient of the conversion at each d-spacing
+        """
+        d_spacing = np.asarray(d_spacing, dtype=float)
+        step = np.abs(d_spacing) * 6e-6
+        step[step == 0] = 6e-6
+        return (
+            self.data_class.conversion(d_spacing + step, reverse=1)
+            - self.data_class.conversion(d_spacing - step, reverse=1)
+        ) / (2 * step)
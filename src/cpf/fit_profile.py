@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+Instrumentation of the stages of fit_sub_pattern.
+
+Each stage of the fit of a subpattern (the chunk fits, the series fits to the chunks,
+each refinement stage and the final fit) is timed, by the wall clock and by the
+processor time of the process that made it, and the number of function evaluations,
+data and varied parameters of its fit are recorded. The record is saved in the
+FitProperties of the subpattern, so it is returned from the worker processes with the
+fit, and the records of every image and subpattern are collected into a report for
+the run. Values that are not known (e.g. the function evaluations of the chunk fits)
+are left out of the record, because a propagated fit containing None is discarded.
+"""
+
+__all__ = ["FitProfile", "profile_rows", "summarise_profile", "write_profile_report"]
+
+import csv
+import json
+import time
+
+# columns of the report, in order.
+_columns = [
+    "image",
+    "subpattern",
+    "stage",
+    "component",
+    "wall-time",
+    "cpu-time",
+    "function-evaluations",
+    "n-data",
+    "n-variables",
+]
+
+
+class FitProfile:
+    """
+    Record of the stages of the fit of a subpattern.
+    """
+
+    def __init__(self):
+        # list of dicts, one for each stage in the order that they were made.
+        self.stages = []
+
+    def start(self, stage, component=None):
+        """
+        Start timing a stage.
+        :param stage: type of the stage, e.g. "chunks", "series", "refine" or "final"
+        :param component: what is fitted in the stage, e.g. "peak_0_d", or None
+        :return: entry for the stage, to pass to stop
+        """
+        entry = {"stage": stage}
+        if component is not None:
+            entry["component"] = component
+        entry["_start"] = (time.perf_counter(), time.process_time())
+        return entry
+
+    def stop(self, entry, fout=None, n_data=None, n_variables=None):
+        """
+        Stop timing a stage and record it.
+        :param entry: entry returned by start
+        :param fout: result of the fit made in the stage, or None. Its number of
+            function evaluations, data and varied parameters are recorded.
+        :param n_data: number of data, if there is no fit result
+        :param n_variables: number of varied parameters, if there is no fit result
+        :return: entry for the stage
+        """
+        wall_start, cpu_start = entry.pop("_start")
+        entry["wall-time"] = time.perf_counter() - wall_start
+        entry["cpu-time"] = time.process_time() - cpu_start
+        if fout is not None:
+            entry["function-evaluations"] = int(fout.nfev)
+            n_data = fout.ndata
+            n_variables = fout.nvarys
+        if n_data is not None:
+            entry["n-data"] = int(n_data)
+        if n_variables is not None:
+            entry["n-variables"] = int(n_variables)
+        self.stages.append(entry)
+        return entry
+
+
+def profile_rows(fitted_params, image):
+    """
+    Rows of the profile report from the fits to an image.
+    :param fitted_params: list of the fits (new_params dicts) to each subpattern
+    :param image: number of the image
+    :return: list of dicts, one for each stage of each subpattern
+    """
+    rows = []
+    for subpattern, fit in enumerate(fitted_params):
+        if not isinstance(fit, dict):
+            continue
+        for entry in fit.get("FitProperties", {}).get("profile", []):
+            rows.append({"image": image, "subpattern": subpattern, **entry})
+    return rows
+
+
+def summarise_profile(rows):
+    """
+    Totals of the profile over all the images, for each subpattern and type of stage.
+    :param rows: rows of the profile report
+    :return: list of dicts with the number, wall and processor time and function
+        evaluations of each type of stage of each subpattern
+    """
+    totals = {}
+    for row in rows:
+        key = (row["subpattern"], row["stage"])
+        if key not in totals:
+            totals[key] = {
+                "subpattern": row["subpattern"],
+                "stage": row["stage"],
+                "count": 0,
+                "wall-time": 0.0,
+                "cpu-time": 0.0,
+                "function-evaluations": 0,
+            }
+        totals[key]["count"] += 1
+        totals[key]["wall-time"] += row["wall-time"]
+        totals[key]["cpu-time"] += row["cpu-time"]
+        totals[key]["function-evaluations"] += row.get("function-evaluations", 0)
+    return [totals[key] for key in sorted(totals)]
+
+
+def write_profile_report(rows, csv_file, json_file):
+    """
+    Write the profile of a run as a CSV file, with a row for each stage of each fit,
+    and as a JSON file, with the rows and their totals.
+    :param rows: rows of the profile report
+    :param csv_file: name of the CSV file
+    :param json_file: name of the JSON file
+    :return: None
+    """
+    with open(csv_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=_columns, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    with open(json_file, "w") as f:
+        json.dump(
+            {"totals": summarise_profile(rows), "stages": rows},
+            f,
+            indent=2,
+        )
@@ -5,16 +5,20 @@ __all__ = ["get_manual_guesses", "get_chunk_background_guess", "fit_chunks"]
 # CPF_XRD_FitSubpattern
 # Script fits subset of the data with peaks of pre-defined Fourier orders
 
+from copy import copy
+
 import matplotlib.pyplot as plt
 import numpy as np
 import numpy.ma as ma
 from lmfit import Model, Parameters
 
+import cpf.batched_fit as bf
 import cpf.histograms as hist
 import cpf.IO_functions as io
 import cpf.lmfit_model as lmm
 import cpf.logger_functions as lg
 import cpf.series_functions as sf
+from cpf.compiled_model import CompiledModel
 
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
@@ -80,6 +84,7 @@ def get_manual_guesses(settings_as_class, data_as_class, debug=False):
             inp_param=temp_param,
             param_str=param_str + "_" + comp,
             fit_method="leastsq",
+            solver=settings_as_class.fit_series_solver,
         )
         temp_param = fout.params
 
@@ -297,6 +302,164 @@ def get_chunk_peak_guesses(
     return peaks, limits, p_fixed
 
 
+def _chunk_arrays(data, chunks):
+    """
+    Sort the data into chunks, without the masked data. The chunks are views of a
+    single, read-only, array so that the data are only copied once.
+    :param data: (masked) array of data
+    :param chunks: list of the (flattened) indices of the data in each chunk
+    :return: list of arrays of the unmasked data in each chunk
+    """
+    if len(chunks) == 0:
+        return []
+    sizes = [np.size(chunk) for chunk in chunks]
+    values = ma.ravel(data)[np.concatenate([np.ravel(chunk) for chunk in chunks])]
+    keep = ~ma.getmaskarray(values)
+    values = ma.getdata(values)[keep]
+    values.flags.writeable = False
+    edges = np.concatenate([[0], np.cumsum(keep)])[np.cumsum([0] + sizes)]
+    return [values[edges[j] : edges[j + 1]] for j in range(len(chunks))]
+
+
+def _fit_chunk(task):
+    """
+    Fit the peaks and background to a single chunk with lmfit.
+    This is a module level function so that it can be sent to a pool of processes.
+    The chunks are always fitted with finite difference derivatives. Many of the chunk
+    fits stop at the maximum number of function evaluations, and where they stop depends
+    on the derivatives used; an analytical Jacobian here changes the starting values of
+    the series and so the final fit.
+    :param task: tuple of the chunk data class, orders, lmfit Parameter class,
+        maximum number of function evaluations and fit method.
+    :return: lmfit Parameter class of the fitted chunk
+    """
+    chunk_data, orders, params, max_n_f_eval, fit_method = task
+    fit = lmm.fit_model(
+        chunk_data,  # needs to contain intensity, tth, azi (as chunks), conversion factor
+        orders,
+        params,
+        fit_method=fit_method,
+        max_n_fev=max_n_f_eval,
+        weights=None,
+        compiled_model=CompiledModel(
+            params,
+            chunk_data.tth,
+            chunk_data.azm,
+            data_class=chunk_data,
+            orders=orders,
+        ),
+    )
+    return fit.params
+
+
+def _chunk_for_worker(chunk_data):
+    """
+    Copy of a chunk's data class without the arrays that are not needed to fit it,
+    to keep small what is sent to the worker processes.
+    :param chunk_data: data class of the chunk
+    :return: data class
+    """
+    chunk_data = copy(chunk_data)
+    for name in ["x", "y", "z", "dspace", "original_mask"]:
+        if getattr(chunk_data, name, None) is not None:
+            setattr(chunk_data, name, None)
+    return chunk_data
+
+
+def _store_chunk_fit(
+    out_vals, params, guess, chunk_data, settings_as_class, azimuth, j, n_chunks
+):
+    """
+    Add the fitted values of a chunk to the output, and plot the fit if debugging.
+    :param out_vals: dictionary of the chunk fits
+    :param params: lmfit Parameter class of the fitted chunk
+    :param guess: lmfit Parameter class of the initial guess (only used for plotting)
+    :param chunk_data: data class of the chunk
+    :param settings_as_class: settings class
+    :param azimuth: azimuth of the chunk
+    :param j: number of the chunk
+    :param n_chunks: number of chunks
+    :return: None
+    """
+    # if debug:
+    logger.debug(" ".join(map(str, [("Fitted chunk; %i/%i" % (j, n_chunks))])))
+    lg.pretty_print_to_logger(params, level="DEBUG", space=True)
+
+    # get values from fit and append to arrays for output
+    for i in range(len(settings_as_class.subfit_orders["background"])):
+        out_vals["bg"][i].append(params["bg_c" + str(i) + "_f0"].value)
+        out_vals["bg_err"][i].append(params["bg_c" + str(i) + "_f0"].stderr)
+    comp_list = ["h", "d", "w", "p"]
+    for pk in range(len(settings_as_class.subfit_orders["peak"])):
+        for cp in range(len(comp_list)):
+            out_vals[comp_list[cp]][pk].append(
+                params["peak_" + str(pk) + "_" + comp_list[cp] + "0"].value
+            )
+            out_vals[comp_list[cp] + "_err"][pk].append(
+                params["peak_" + str(pk) + "_" + comp_list[cp] + "0"].stderr
+            )
+
+    out_vals["chunks"].append(azimuth)
+
+    # plot the fits.
+    # if debug:
+    if lg.make_logger_output(level="DEBUG"):
+        tth_plot = chunk_data.tth
+        int_plot = chunk_data.intensity
+        azm_plot = chunk_data.azm
+        # required for plotting energy dispersive data. - but I am not sure why
+        azm_plot = ma.array(azm_plot, mask=(~np.isfinite(azm_plot)))
+        gmodel = Model(
+            lmm.peaks_model,
+            independent_vars=["two_theta", "azimuth"],
+            data_class=chunk_data,
+            orders=settings_as_class.subfit_orders,
+        )
+        tth_model = np.linspace(
+            np.min(chunk_data.tth),
+            np.max(chunk_data.tth),
+            100,
+        )
+        azm_model = tth_model * 0 + np.mean(azm_plot)
+
+        mod_plot = gmodel.eval(
+            params=params,
+            two_theta=tth_model,
+            azimuth=azm_model,
+        )
+        guess_plot = gmodel.eval(
+            params=guess,
+            two_theta=tth_model,
+            azimuth=azm_model,
+        )
+        plt.plot(tth_plot, int_plot, ".", label="data")
+        plt.plot(
+            tth_model,
+            np.array(guess_plot).flatten(),
+            marker="",
+            color="green",
+            linewidth=2,
+            linestyle="dashed",
+            label="guess",
+        )
+        plt.plot(
+            tth_model,
+            np.array(mod_plot).flatten(),
+            marker="",
+            color="red",
+            linewidth=2,
+            label="fit",
+        )
+        plt.legend()
+        plt.title(
+            (
+                (io.peak_string(settings_as_class.subfit_orders) + "; azimuth = %.1f")
+                % azimuth
+            )
+        )
+        plt.show()
+
+
 def fit_chunks(
     data_as_class,
     settings_as_class,
@@ -307,6 +470,7 @@ def fit_chunks(
     max_n_f_eval=400,
     save_fit=False,
     debug=False,
+    executor=None,
 ):
     """
     Take the raw data, fit the chunks and return the chunk fits
@@ -316,6 +480,9 @@ def fit_chunks(
     :param save_fit:
     :param debug:
     :param fit_method:
+    :param executor: None to fit the chunks in turn, or a pool (e.g. a pathos
+        ProcessPool or a concurrent.futures executor) whose map method is used to fit
+        the chunks concurrently. The results are kept in the order of the chunks.
     :return chunk_params:
     """
 
@@ -356,6 +523,10 @@ def fit_chunks(
         chunks, azichunks = data_as_class.bins(settings_as_class, cascade=True)
     else:
         chunks, azichunks = data_as_class.bins(settings_as_class)
+    # Sort the data into the chunks once; the data of each chunk are then a view.
+    chunk_intensity = _chunk_arrays(data_as_class.intensity, chunks)
+    chunk_tth = _chunk_arrays(data_as_class.tth, chunks)
+    chunk_azm = _chunk_arrays(data_as_class.azm, chunks)
     # Final output list of azimuths with corresponding twotheta_0,h,w
 
     # setup arrays
@@ -388,6 +559,9 @@ def fit_chunks(
 
     out_vals["peak"] = io.peak_string(settings_as_class.subfit_orders)
 
+    # chunks set up to be fitted together, if using the batched engine or an executor.
+    batch = []
+
     for j in range(len(chunks)):
         # logger.info(" ".join(map(str, [('\nFitting to data chunk ' + str(j + 1) + ' of ' + str(len(chunks)) + '\n')])))
         logger.debug(
@@ -404,18 +578,12 @@ def fit_chunks(
             )
         )
 
-        # make data class for chunks.
-        chunk_data = data_as_class.duplicate()
-        # reduce data to a subset
-        # FIXME: this is crude but I am not convinced that it needs to be contained within the data class.
-        # FEXME: maybe I need to reconstruct the data class so that dat_class.tth is a function that applies a mask when called. but this will be slower.
-        chunk_data.intensity = chunk_data.intensity.flatten()[chunks[j]].compressed()
-        # logger.info(" ".join(map(str, [(type(chunk_data.intensity))])))
-        # logger.info(" ".join(map(str, [(chunk_data.intensity.dtype)])))
-        # stop
-        chunk_data.tth = chunk_data.tth.flatten()[chunks[j]].compressed()
-        chunk_data.azm = chunk_data.azm.flatten()[chunks[j]].compressed()
-        # chunk_data.dspace = chunk_data.dspace.flatten()[chunks[j]].compressed()
+        # make data class for chunks, containing only the (unmasked) data in the chunk.
+        # The rest of the data class is shared with the subpattern's data class.
+        chunk_data = copy(data_as_class)
+        chunk_data.intensity = chunk_intensity[j]
+        chunk_data.tth = chunk_tth[j]
+        chunk_data.azm = chunk_azm[j]
 
         # find other output from intensities
         if mode == "maxima":
@@ -529,104 +697,40 @@ def fit_chunks(
                 )
                 lg.pretty_print_to_logger(params, level="DEBUG", space=True)
                 # if debug:
+                guess = None
                 if lg.make_logger_output(level="DEBUG"):
                     # keep the original params for plotting afterwards
                     guess = params
 
+                if (
+                    settings_as_class.fit_chunk_engine == "batched"
+                    or executor is not None
+                ):
+                    # the chunks are fitted together after they are all set up.
+                    batch.append((j, chunk_data, params, guess))
+                    continue
+
                 # Run actual fit
-                fit = lmm.fit_model(
-                    chunk_data,  # needs to contain intensity, tth, azi (as chunks), conversion factor
-                    settings_as_class.subfit_orders,
-                    params,
-                    fit_method=fit_method,
-                    max_n_fev=max_n_f_eval,
-                    weights=None,
+                params = _fit_chunk(
+                    (
+                        chunk_data,
+                        settings_as_class.subfit_orders,
+                        params,
+                        max_n_f_eval,
+                        fit_method,
+                    )
                 )
-                params = fit.params  # update lmfit parameters
 
-                # if debug:
-                logger.debug(
-                    " ".join(map(str, [("Fitted chunk; %i/%i" % (j, len(chunks)))]))
+                _store_chunk_fit(
+                    out_vals,
+                    params,
+                    guess,
+                    chunk_data,
+                    settings_as_class,
+                    azichunks[j],
+                    j,
+                    len(chunks),
                 )
-                lg.pretty_print_to_logger(params, level="DEBUG", space=True)
-
-                # get values from fit and append to arrays for output
-                for i in range(len(background_guess)):
-                    out_vals["bg"][i].append(params["bg_c" + str(i) + "_f0"].value)
-                    out_vals["bg_err"][i].append(params["bg_c" + str(i) + "_f0"].stderr)
-                comp_list = ["h", "d", "w", "p"]
-                comp_names = ["height", "d-space", "width", "profile"]
-                for pk in range(len(peaks)):
-                    for cp in range(len(comp_list)):
-                        out_vals[comp_list[cp]][pk].append(
-                            params["peak_" + str(pk) + "_" + comp_list[cp] + "0"].value
-                        )
-                        out_vals[comp_list[cp] + "_err"][pk].append(
-                            params["peak_" + str(pk) + "_" + comp_list[cp] + "0"].stderr
-                        )
-
-                out_vals["chunks"].append(azichunks[j])
-
-                # plot the fits.
-                # if debug:
-                if lg.make_logger_output(level="DEBUG"):
-                    tth_plot = chunk_data.tth
-                    int_plot = chunk_data.intensity
-                    azm_plot = chunk_data.azm
-                    # required for plotting energy dispersive data. - but I am not sure why
-                    azm_plot = ma.array(azm_plot, mask=(~np.isfinite(azm_plot)))
-                    gmodel = Model(
-                        lmm.peaks_model,
-                        independent_vars=["two_theta", "azimuth"],
-                        data_class=chunk_data,
-                        orders=settings_as_class.subfit_orders,
-                    )
-                    tth_model = np.linspace(
-                        np.min(chunk_data.tth),
-                        np.max(chunk_data.tth),
-                        100,
-                    )
-                    azm_model = tth_model * 0 + np.mean(azm_plot)
-
-                    mod_plot = gmodel.eval(
-                        params=params,
-                        two_theta=tth_model,
-                        azimuth=azm_model,
-                    )
-                    guess_plot = gmodel.eval(
-                        params=guess,
-                        two_theta=tth_model,
-                        azimuth=azm_model,
-                    )
-                    plt.plot(tth_plot, int_plot, ".", label="data")
-                    plt.plot(
-                        tth_model,
-                        np.array(guess_plot).flatten(),
-                        marker="",
-                        color="green",
-                        linewidth=2,
-                        linestyle="dashed",
-                        label="guess",
-                    )
-                    plt.plot(
-                        tth_model,
-                        np.array(mod_plot).flatten(),
-                        marker="",
-                        color="red",
-                        linewidth=2,
-                        label="fit",
-                    )
-                    plt.legend()
-                    plt.title(
-                        (
-                            (
-                                io.peak_string(settings_as_class.subfit_orders)
-                                + "; azimuth = %.1f"
-                            )
-                            % azichunks[j]
-                        )
-                    )
-                    plt.show()
             else:
                 # there are not enough data to fit for the chunks
                 pass
@@ -634,6 +738,43 @@ def fit_chunks(
         else:
             raise ValueError("The mode for processing the chunks is not recognised.")
 
+    if len(batch) > 0 and settings_as_class.fit_chunk_engine == "batched":
+        # fit all the chunks at once.
+        fitted = bf.fit_chunks_batched(
+            [chunk_data for j, chunk_data, params, guess in batch],
+            [params for j, chunk_data, params, guess in batch],
+            settings_as_class.subfit_orders,
+            max_n_fev=max_n_f_eval,
+        )
+    elif len(batch) > 0:
+        # fit the chunks concurrently. map returns the fits in the order of the chunks.
+        fitted = executor.map(
+            _fit_chunk,
+            [
+                (
+                    _chunk_for_worker(chunk_data),
+                    settings_as_class.subfit_orders,
+                    params,
+                    max_n_f_eval,
+                    fit_method,
+                )
+                for j, chunk_data, params, guess in batch
+            ],
+        )
+    if len(batch) > 0:
+        # store the fits in the order of the chunks.
+        for (j, chunk_data, params, guess), fitted_params in zip(batch, fitted):
+            _store_chunk_fit(
+                out_vals,
+                fitted_params,
+                guess,
+                chunk_data,
+                settings_as_class,
+                azichunks[j],
+                j,
+                len(chunks),
+            )
+
     return out_vals, new_azi_chunks
 
 
@@ -681,6 +822,7 @@ def fit_series(
             symmetry=1,
             errs=data_val_errors,
             fit_method="leastsq",
+            solver=settings_as_class.fit_series_solver,
         )
         master_params = fout.params
 
@@ -746,6 +888,7 @@ def fit_series(
                     errs=data_val_errors,
                     fit_method="leastsq",
                     max_nfev=max_n_f_eval,
+                    solver=settings_as_class.fit_series_solver,
                 )
 
             master_params = fout.params
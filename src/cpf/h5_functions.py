@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import atexit
 import os
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
 
 import cv2  # opencv-python
 import h5py
@@ -15,6 +19,23 @@ import cpf.XRD_FitPattern as fp
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
 
+try:
+    # decodes bitshuffle compressed chunks (e.g. from Eiger detectors) without the
+    # hdf5 filter. Optional: without it the chunks are read by the filter.
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+# largest number of h5 files kept open for reading by each thread.
+h5_open_files = 16
+# the files open for reading by each thread, as {file name: (file, modification
+# time)}, with the most recently used last. Each thread has its own files, so that a
+# thread never closes a file that another thread is reading.
+_h5_local = threading.local()
+# the files of every thread, as [(thread, files)], so that they can all be closed.
+_h5_thread_files = []
+_h5_files_lock = threading.Lock()
+
 
 # copied from internet somewhere August 2022
 def allkeys(obj):
@@ -152,12 +173,19 @@ def get_image_keys(
     bottom_level="iterate",
     index=0,
     key_str="",
+    lazy=False,
 ):
+    """
+    Make the h5 keys, [key, position, label], of the images in an h5 file.
+    With lazy the keys of the frames of each dataset are not listed but are returned
+    as a FrameKeys sequence, which makes them when they are asked for, and a list of
+    these sequences (one for each dataset) is returned.
+    """
     # validate the inputs
     # image_key_validate(h5key_list, key_start=key_start, key_end=key_end, key_step=key_step)
 
     if isinstance(datafile, str):
-        datafile = h5py.File(datafile, "a")
+        datafile = open_h5(datafile)
 
     keys = []
     sep1 = "_"
@@ -198,38 +226,39 @@ def get_image_keys(
                 # FIXME! this is the line to use if the last entry in the list in empty
                 # labels = str(key_str)
 
+                if lazy:
+                    return [[[key, index_values, labels]]]
                 return [[key, index_values, labels]]
 
             elif bottom_level == "iterate":
                 # iterate over the size of the array in the h5 group.
 
-                # make list of key labels
-                key_strings_new = get_image_key_strings(
+                # the key labels, which are made when they are needed.
+                key_labels = KeyLabels(
                     datafile,
                     key_route=key_route,
                     key_names=h5key_names[0],
                     key_measure=h5key_list[0],
-                    key_start=0,
-                    key_end=-1,
-                    key_step=1,
                     index=index,
                 )
-                out = []
 
-                if number_data != len(key_strings_new):
+                if number_data != len(key_labels):
                     err_str = (
                         "The number of data (%i) does not match the number of keys (%i). "
                         "It is not possible to continue until this error is corrected."
-                        % (number_data, len(key_strings_new))
+                        % (number_data, len(key_labels))
                     )
                     raise ValueError(err_str)
 
-                # get the labels:
-                lbl_temp = []
-                for i in [*range(key_start[0], key_end[0], key_step[0])]:
-                    lbl_temp.append([key, i, key_str + sep1 + key_strings_new[i]])
-
-                return lbl_temp
+                frames = FrameKeys(
+                    key,
+                    range(key_start[0], key_end[0], key_step[0]),
+                    key_labels,
+                    prefix=key_str + sep1,
+                )
+                if lazy:
+                    return [frames]
+                return list(frames)
 
             else:
                 err_str = "This h5 process is not recognised."
@@ -296,6 +325,7 @@ def get_image_keys(
                     bottom_level=bottom_level,
                     index=index,
                     key_str=str(key_strings[i]),
+                    lazy=lazy,
                 )
             )
 
@@ -347,69 +377,17 @@ def get_image_key_strings(
 
     """
 
-    if not isinstance(key_names, list):
-        key_names = [key_names]
-    number_data_tmp1 = []
-    number_data_tmp = []
-    for i in range(len(key_names)):
-        if (
-            isinstance(datafile[key_route + "/" + key_names[i]], h5py.Group)
-            and key_names[i] == "/"
-        ):
-            logger.debug(" ".join(map(str, [(i, "/")])))
-            number_data_tmp.append(
-                len(list(datafile[key_route + "/" + key_names[i]].keys()))
-            )
-
-        elif (
-            isinstance(datafile[key_route + "/" + key_names[i]], h5py.Group)
-            and key_names[i] == ""
-        ):
-            try:
-                if key_measure == "/":
-                    number_data_tmp.append(
-                        len(list(datafile[key_route + "/" + key_names[i]].keys()))
-                    )
-                else:
-                    attr = datafile[key_route + "/" + key_measure]
-                    tmp = datafile.get(key_route + "/" + key_measure)
-                    number_data_tmp.append(tmp.shape[index])
-
-            except:
-                logger.debug(" ".join(map(str, [(i, "value")])))
-                number_data_tmp.append(0)
-
-        else:
-            number_data_tmp.append(datafile[key_route + "/" + key_names[i]].size)
-
-    number_data = np.max(number_data_tmp)
-
-    if isinstance(key_names, str):
-        key_names = [key_names]
-
-    # get the labels
-    labels = []
-    for i in range(len(key_names)):
-        if key_names[i] == "":
-            # if empty then list numbers.
-            labels_temp = np.array(range(number_data))
-            # FIXME: We are zero counting the images and the indecies. It might be better to 1 count them.
-            # if so to 1 count the indicies we add 1 to the prewvious line.
-            # the counting over the arrays needs to be done in get_image_keys
-            labels_temp = unique_labels(labels_temp, number_data=number_data)
-        elif key_names[i] == "/":
-            # if "/" then list names of subgroups
-            labels_temp = list(datafile[key_route + "/" + key_names[i]].keys())
-        else:
-            # it is a key and so list the key contents.
-            try:
-                # number_data = datafile[key_route + "/" + key_names[i]].shape[index]
-                labels_temp = datafile[key_route + "/" + key_names[i]][()]
-            except:
-                # catch incase 1 iterable index is the length of the data and the other is only 1.
-                labels_temp = datafile[key_route + "/" + key_names[i]][()]
-            labels_temp = unique_labels(labels_temp, number_data=labels_temp.size)
-        labels.append(labels_temp)
+    key_labels = KeyLabels(
+        datafile,
+        key_route=key_route,
+        key_names=key_names,
+        key_measure=key_measure,
+        key_str=key_str,
+        index=index,
+        sep1=sep1,
+        sep2=sep2,
+    )
+    number_data = len(key_labels)
 
     # if we are using all the data make sure we run to the end.
     if key_end == -1:
@@ -428,15 +406,117 @@ def get_image_key_strings(
         key_start -= 1
 
     # make the list of labels
-    out = []
-    for i in [*range(key_start, key_end + 1, key_step)]:
+    return [key_labels[i] for i in [*range(key_start, key_end + 1, key_step)]]
+
+
+class KeyLabels:
+    """
+    The key labels (see get_image_key_strings) of the data in an h5 group, made when
+    they are asked for. The values the labels are made from are read from the h5
+    file when the class is made, but the label strings are not made until they are
+    needed, which for long series of images is much quicker.
+    """
+
+    def __init__(
+        self,
+        datafile,
+        key_route="",
+        key_names=[""],
+        key_measure=[""],
+        key_str="",
+        index=0,
+        sep1="_",
+        sep2="=",
+    ):
+        """
+        :param datafile: h5 file handle
+        :param key_route: route to the group in the h5 file
+        :param key_names: names of the keys to make the labels from
+        :param key_measure: key of the data to count the labels for
+        :param key_str: label to put in front of each label
+        :param index: axis of the data to count the labels along
+        :param sep1: separator between the parts of the labels
+        :param sep2: separator between the key names and values
+        """
+        if not isinstance(key_names, list):
+            key_names = [key_names]
+        number_data_tmp = []
+        for i in range(len(key_names)):
+            if (
+                isinstance(datafile[key_route + "/" + key_names[i]], h5py.Group)
+                and key_names[i] == "/"
+            ):
+                logger.debug(" ".join(map(str, [(i, "/")])))
+                number_data_tmp.append(
+                    len(list(datafile[key_route + "/" + key_names[i]].keys()))
+                )
+
+            elif (
+                isinstance(datafile[key_route + "/" + key_names[i]], h5py.Group)
+                and key_names[i] == ""
+            ):
+                try:
+                    if key_measure == "/":
+                        number_data_tmp.append(
+                            len(list(datafile[key_route + "/" + key_names[i]].keys()))
+                        )
+                    else:
+                        tmp = datafile.get(key_route + "/" + key_measure)
+                        number_data_tmp.append(tmp.shape[index])
+
+                except:
+                    logger.debug(" ".join(map(str, [(i, "value")])))
+                    number_data_tmp.append(0)
+
+            else:
+                number_data_tmp.append(datafile[key_route + "/" + key_names[i]].size)
+
+        number_data = np.max(number_data_tmp)
+
+        # get the labels
+        labels = []
+        for i in range(len(key_names)):
+            if key_names[i] == "":
+                # if empty then list numbers.
+                labels_temp = np.arange(number_data)
+                # FIXME: We are zero counting the images and the indecies. It might be better to 1 count them.
+                # if so to 1 count the indicies we add 1 to the prewvious line.
+                # the counting over the arrays needs to be done in get_image_keys
+                labels_temp = unique_labels(labels_temp, number_data=number_data)
+            elif key_names[i] == "/":
+                # if "/" then list names of subgroups
+                labels_temp = list(datafile[key_route + "/" + key_names[i]].keys())
+            else:
+                # it is a key and so list the key contents.
+                labels_temp = datafile[key_route + "/" + key_names[i]][()]
+                labels_temp = unique_labels(labels_temp, number_data=labels_temp.size)
+            labels.append(labels_temp)
+
+        self.number_data = int(number_data)
+        self.labels = labels
+        self.key_names = key_names
+        self.key_route = key_route
+        self.key_str = key_str
+        self.sep1 = sep1
+        self.sep2 = sep2
+
+    def __len__(self):
+        return self.number_data
+
+    def __getitem__(self, i):
+        """
+        :param i: position of the data in the group
+        :return: label of the data, as a licit file name
+        """
+        labels = self.labels
+        key_names = self.key_names
         lbl_str = ""
         for j in range(len(labels)):
             if isinstance(key_names[j], str) and len(key_names[j]) == 0:
                 pass
             else:
                 lbl_str = lbl_str + os.path.basename(
-                    os.path.normpath(key_route + "/" + key_names[j])
+                    os.path.normpath(self.key_route + "/" + key_names[j])
                 )
 
             if (
@@ -447,27 +527,221 @@ def get_image_key_strings(
                 else:
                     lbl_str = lbl_str + str(labels[j][i])
             elif labels[j].size == 1:
-                lbl_str = lbl_str + sep2 + str(labels[j])
+                lbl_str = lbl_str + self.sep2 + str(labels[j])
             else:
-                if np.size(labels[j]) == 1:
-                    # if labels are a single item they can come wrapped in lists.
-                    # not sure why but this is here to capture it.
-                    labels = [item for items in labels for item in items]
-
-                    lbl_str = lbl_str + sep2 + str(labels[j])
-                else:
-                    lbl_str = lbl_str + sep2 + str(labels[j][i])
+                lbl_str = lbl_str + self.sep2 + str(labels[j][i])
             if j != len(key_names) - 1:  # np.size(labels[j]):
-                lbl_str = lbl_str + sep1
+                lbl_str = lbl_str + self.sep1
 
         # IO.licit_filename(lbl_str)
-        if len(key_str) != 0:
-            lbl_str = key_str + sep1 + lbl_str
+        if len(self.key_str) != 0:
+            lbl_str = self.key_str + self.sep1 + lbl_str
+
+        return IO.licit_filename(lbl_str)
+
+
+class FrameKeys(Sequence):
+    """
+    The h5 keys, [key, position, label], of the frames of a dataset, made when they
+    are asked for rather than listed for every frame.
+    """
+
+    def __init__(self, key, positions, key_labels, prefix=""):
+        """
+        :param key: key of the dataset in the h5 file
+        :param positions: positions of the frames in the dataset (a range)
+        :param key_labels: labels of the frames, by position (see KeyLabels)
+        :param prefix: text in front of the frame labels
+        """
+        self.key = key
+        self.positions = positions
+        self.key_labels = key_labels
+        self.prefix = prefix
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return FrameKeys(self.key, self.positions[i], self.key_labels, self.prefix)
+        position = self.positions[i]
+        return [self.key, position, self.prefix + self.key_labels[position]]
+
+
+def open_h5(filename):
+    """
+    Open an h5 file to read. The file is kept open, and reused by the thread that
+    opened it, until it is one of the thread's least recently used of more than
+    h5_open_files files or it is changed. Other threads open the file themselves.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the h5 file.
+
+    Returns
+    -------
+    datafile : h5py.File
+        The file, open to read.
+
+    """
+    filename = os.path.abspath(filename)
+    modified = os.stat(filename).st_mtime_ns
+    h5_files = _thread_h5_files()
+    if filename in h5_files:
+        datafile, opened = h5_files.pop(filename)
+        if opened == modified and datafile.id.valid:
+            h5_files[filename] = (datafile, opened)
+            return datafile
+        # the file has changed since it was opened.
+        datafile.close()
+    datafile = h5py.File(filename, "r")
+    h5_files[filename] = (datafile, modified)
+    while len(h5_files) > h5_open_files:
+        _, (oldest, _) = h5_files.popitem(last=False)
+        oldest.close()
+    return datafile
+
+
+def _thread_h5_files():
+    """
+    The h5 files kept open by the current thread. The files of threads that have
+    finished are closed when a thread first opens a file.
+    :return: OrderedDict of {file name: (file, modification time)}
+    """
+    h5_files = getattr(_h5_local, "files", None)
+    if h5_files is None:
+        h5_files = OrderedDict()
+        _h5_local.files = h5_files
+        with _h5_files_lock:
+            for thread, files in list(_h5_thread_files):
+                if not thread.is_alive():
+                    _h5_thread_files.remove((thread, files))
+                    _close_all(files)
+            _h5_thread_files.append((threading.current_thread(), h5_files))
+    return h5_files
+
+
+def _close_all(h5_files):
+    while h5_files:
+        _, (datafile, _) = h5_files.popitem()
+        datafile.close()
+
+
+def close_h5_files():
+    """
+    Close the h5 files kept open by open_h5, in every thread. This should only be
+    called when no other thread is reading them (e.g. at exit).
+    """
+    with _h5_files_lock:
+        for _, files in _h5_thread_files:
+            _close_all(files)
+
 
-        lbl_str = IO.licit_filename(lbl_str)
+atexit.register(close_h5_files)
 
-        out.append(lbl_str)
 
+def _chunk_decoder(dataset):
+    """
+    Make a function that decodes the stored chunks of a dataset, read with
+    read_direct_chunk, into arrays. This is only done for bitshuffle (with lz4)
+    compressed chunks, which are decoded by the bitshuffle package (if it is
+    installed) without holding the python interpreter, so that images can be decoded
+    at the same time on different threads. Each chunk must contain whole frames (i.e.
+    it is only chunked along the first axis). Other filters (e.g. gzip) are decoded
+    as quickly by hdf5 as they can be here.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        The dataset of images.
+
+    Returns
+    -------
+    decode : function or None
+        Function of the chunk's bytes that returns the chunk as an array, or None if
+        the chunks cannot be decoded here.
+
+    """
+    if bitshuffle is None:
+        return None
+    chunks = dataset.chunks
+    if chunks is None or tuple(chunks[1:]) != tuple(dataset.shape[1:]):
+        return None
+    plist = dataset.id.get_create_plist()
+    filters = [plist.get_filter(i) for i in range(plist.get_nfilters())]
+    if len(filters) != 1:
+        return None
+    code, _, values, _ = filters[0]
+    if code != hdf5plugin.BSHUF_ID or len(values) < 5 or values[4] != 2:  # lz4
+        return None
+    dtype = np.dtype(dataset.dtype)
+
+    def decode(buffer):
+        # 12 byte header: size of the chunk and of the blocks, in bytes.
+        block_size = int.from_bytes(buffer[8:12], "big") // dtype.itemsize
+        data = bitshuffle.decompress_lz4(
+            np.frombuffer(buffer, dtype=np.uint8, offset=12),
+            (int(np.prod(chunks)),),
+            dtype,
+            block_size,
+        )
+        return data.reshape(chunks)
+
+    return decode
+
+
+def read_frames(dataset, positions, out=None):
+    """
+    Read frames (positions along the first axis) from a dataset of images.
+    The frames are read a chunk at a time, so that each chunk is read (and
+    decompressed) once however many of its frames are wanted. Chunks that can be
+    decoded without the hdf5 filters (see _chunk_decoder) are read directly.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        The dataset of images.
+    positions : list
+        Positions of the frames in the dataset.
+    out : array, optional
+        Array to read the frames into, with the frames along the first axis. The
+        default is None, which makes a new array.
+
+    Returns
+    -------
+    out : array
+        The frames, in the order of positions.
+
+    """
+    positions = np.asarray(positions, dtype=int)
+    positions = np.where(positions < 0, positions + dataset.shape[0], positions)
+    if out is None:
+        out = np.empty((len(positions),) + dataset.shape[1:], dtype=dataset.dtype)
+    frames_per_chunk = dataset.chunks[0] if dataset.chunks is not None else 1
+    decode = _chunk_decoder(dataset)
+
+    # group the frames by the chunk they are in.
+    chunk_of = positions // frames_per_chunk
+    for chunk in np.unique(chunk_of):
+        wanted = np.flatnonzero(chunk_of == chunk)
+        start = chunk * frames_per_chunk
+        if decode is not None:
+            offset = (int(start),) + (0,) * (dataset.ndim - 1)
+            filter_mask, buffer = dataset.id.read_direct_chunk(offset)
+            if filter_mask == 0:
+                out[wanted] = decode(buffer)[positions[wanted] - start]
+                continue
+        if len(wanted) == 1:
+            # read straight into the output.
+            dataset.read_direct(
+                out,
+                source_sel=np.s_[positions[wanted[0]]],
+                dest_sel=np.s_[wanted[0]],
+            )
+        else:
+            stop = min(start + frames_per_chunk, dataset.shape[0])
+            out[wanted] = dataset[start:stop][positions[wanted] - start]
     return out
 
 
@@ -521,23 +795,30 @@ def get_images(
         image_num = [image_num]
     # image_num could also be a list -- in which case leave it alone.
 
-    # get image
-    for i in range(len(image_num)):
-        n = image_num[i]
-        datafile = h5py.File(image_list[n][0], "a")
+    # get the images, reading the frames in each file and dataset together.
+    frames = {}
+    for i, n in enumerate(image_num):
         datakey = image_list[n][1][0]
         data_position_in_key = image_list[n][1][1]
-        data_tmp = np.array(datafile[datakey][data_position_in_key])
-
-        if len(image_num) == 1:
-            data = data_tmp
+        frames.setdefault((image_list[n][0], datakey), []).append(
+            (i, data_position_in_key)
+        )
+    data = None
+    for (filename, datakey), positions in frames.items():
+        dataset = open_h5(filename)[datakey]
+        if not all(isinstance(p, (int, np.integer)) for _, p in positions):
+            # e.g. lists of frames to be summed.
+            frames_read = np.array([dataset[p] for _, p in positions])
         else:
-            axis = 2
-            if i == 0:
-                data = data_tmp
-                data = np.expand_dims(data, axis=axis)
-            else:
-                data = np.append(data, np.expand_dims(data_tmp, axis=axis), axis=axis)
+            frames_read = read_frames(dataset, [p for _, p in positions])
+        if len(image_num) == 1:
+            return frames_read[0]
+        if data is None:
+            # the images are stacked along the last axis.
+            data = np.empty(
+                frames_read.shape[1:] + (len(image_num),), dtype=frames_read.dtype
+            )
+        data[..., [i for i, _ in positions]] = np.moveaxis(frames_read, 0, -1)
 
     return data
 
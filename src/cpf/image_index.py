@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Index of the images to be fitted, for long series of h5 images.
+
+The image list of the settings has an entry for every image: a file name, or for h5
+files [file name, [key, position, label]]. Listing every frame of the h5 files, and
+making its label, when the settings are read is slow and takes a lot of memory for
+series of 100,000s of frames. The ImageIndex holds the frames of each h5 dataset as a
+sequence of keys (see h5_functions.FrameKeys) and makes the entries of the image list
+when they are asked for.
+
+The ImageIndex is used in place of the list of images: it has a length, and can be
+indexed and sliced like a list.
+"""
+
+__all__ = ["ImageIndex"]
+
+from bisect import bisect_right
+from collections.abc import Sequence
+
+
+class ImageIndex(Sequence):
+    """
+    The images of a list of h5 files, as [file name, [key, position, label]] entries
+    that are made when they are asked for.
+    """
+
+    def __init__(self):
+        # the files and keys of the images, as [(file name, keys), ...].
+        self._series = []
+        # the number of images up to the end of each of the series.
+        self._ends = []
+        # the images selected (by slicing) or None for all the images.
+        self._selection = None
+
+    def append(self, filename, keys):
+        """
+        Add the images of a dataset to the end of the index.
+        :param filename: name of the h5 file
+        :param keys: sequence of the h5 keys ([key, position, label]) of the images
+        """
+        if self._selection is not None:
+            raise TypeError("Images cannot be added to a slice of an image index.")
+        self._series.append((filename, keys))
+        self._ends.append(len(self) + len(keys))
+
+    def _images(self):
+        """
+        The positions of the images, in all the series.
+        """
+        if self._selection is not None:
+            return self._selection
+        return range(self._ends[-1] if self._ends else 0)
+
+    def __len__(self):
+        return len(self._images())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            selected = ImageIndex()
+            selected._series = self._series
+            selected._ends = self._ends
+            selected._selection = self._images()[i]
+            return selected
+        number = self._images()[i]
+        series = bisect_right(self._ends, number)
+        filename, keys = self._series[series]
+        start = self._ends[series - 1] if series > 0 else 0
+        return [filename, keys[number - start]]
+
+    def __repr__(self):
+        return "ImageIndex(%i images)" % len(self)
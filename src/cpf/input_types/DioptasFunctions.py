@@ -4,9 +4,12 @@
 __all__ = ["DioptasDetector"]
 
 
+import hashlib
+import json
 import re
 import sys
 from copy import deepcopy
+from pathlib import Path
 
 import fabio
 import matplotlib.pyplot as plt
@@ -184,7 +187,13 @@ class DioptasDetector:
 
     # @staticmethod
     def import_image(
-        self, image_name=None, settings=None, mask=None, dtype=None, debug=False
+        self,
+        image_name=None,
+        settings=None,
+        mask=None,
+        dtype=None,
+        image=None,
+        debug=False,
     ):
         """
         Import the data image into the intensity array.
@@ -201,6 +210,9 @@ class DioptasDetector:
             Mask array to apply to data. The default is None.
         dtype : string, optional
             Data type string, to force the data type and bit depth. The default is None.
+        image : array, optional
+            The image, if it has already been read by read_image (e.g. in the
+            background, by an ImagePrefetcher). The default is None.
         debug : boolian, optional
             True/Flase to display debuging information. The default is False.
 
@@ -228,6 +240,51 @@ class DioptasDetector:
             # load the data for the chosen subpattern.
             image_name = settings.subfit_filename
 
+        if image is None:
+            image = self.read_image(image_name, dtype=dtype)
+        im = image
+
+        if lg.make_logger_output(level="DEBUG"):
+            fig = plt.figure()
+            ax = fig.add_subplot(1, 1, 1)
+            ax.imshow(im)
+            plt.title(IO_functions.title_file_names(image_name=image_name))
+            plt.show()
+            plt.close()
+
+        # apply mask to the intensity array
+        if mask == None and ma.is_masked(self.intensity) == False:
+            self.intensity = ma.array(im)
+            return ma.array(im)
+        elif mask is not None:
+            # apply given mask
+            self.intensity = ma.array(im, mask=self.fill_mask(mask, im))
+            return ma.array(im, mask=mask)
+        else:
+            # apply mask from intensities
+            self.intensity = ma.array(im, mask=self.intensity.mask)
+            return ma.array(im)
+
+    def read_image(self, image_name, dtype=None):
+        """
+        Read an image and convert it to the orientation and data type of the
+        intensity array. This does not change the data class, so that it can be
+        called in a background thread while another image is fitted.
+
+        Parameters
+        ----------
+        image_name : string or list
+            Name of the image file, or list of the h5 file name and position of the
+            image.
+        dtype : string, optional
+            Data type string, to force the data type and bit depth. The default is None.
+
+        Returns
+        -------
+        im : array
+            Image intensity array.
+
+        """
         # read image
         if isinstance(image_name, list):
             # then it is a h5 type file
@@ -255,32 +312,10 @@ class DioptasDetector:
                 # using same bit precision
                 precision = re.findall("\d+", im[0].dtype.name)[0]
                 dtype = np.dtype("float" + precision)
-        im = ma.array(im, dtype=dtype)
 
         # Dioptas flips the images to match the orientations in Fit2D
         # Therefore implemented here to be consistent with Dioptas.
-        im = np.array(im)[::-1]
-
-        if lg.make_logger_output(level="DEBUG"):
-            fig = plt.figure()
-            ax = fig.add_subplot(1, 1, 1)
-            ax.imshow(im)
-            plt.title(IO_functions.title_file_names(image_name=image_name))
-            plt.show()
-            plt.close()
-
-        # apply mask to the intensity array
-        if mask == None and ma.is_masked(self.intensity) == False:
-            self.intensity = ma.array(im)
-            return ma.array(im)
-        elif mask is not None:
-            # apply given mask
-            self.intensity = ma.array(im, mask=self.fill_mask(mask, im))
-            return ma.array(im, mask=mask)
-        else:
-            # apply mask from intensities
-            self.intensity = ma.array(im, mask=self.intensity.mask)
-            return ma.array(im)
+        return np.array(im, dtype=dtype)[::-1]
 
     def fill_data(
         self, diff_file=None, settings=None, mask=None, make_zyx=False, debug=False
@@ -349,12 +384,9 @@ class DioptasDetector:
                 "The pixel size of the data and the detector are not the same"
             )
 
-        self.tth = ma.array(
-            np.rad2deg(self.detector.twoThetaArray(self.detector.detector.max_shape))
-        )
-        self.azm = ma.array(
-            np.rad2deg(self.detector.chiArray(self.detector.detector.max_shape))
-        )
+        tth, azm = self.get_geometry(settings=settings)
+        self.tth = ma.array(tth)
+        self.azm = ma.array(azm)
         # self.dspace = self._get_d_space()
         if make_zyx:
             zyx = self.detector.calc_pos_zyx()
@@ -363,7 +395,7 @@ class DioptasDetector:
             self.x = zyx[2]
 
         # get and apply mask
-        mask_array = self.get_mask(mask, self.intensity)
+        mask_array = self.get_mask(mask, self.intensity, settings=settings)
         self.mask_apply(mask_array, debug=debug)
 
         self.azm_start = (
@@ -373,6 +405,82 @@ class DioptasDetector:
             np.around(np.max(self.azm.flatten()) / self.azm_blocks) * self.azm_blocks
         )
 
+    def get_geometry(self, settings=None):
+        """
+        Two theta and azimuth (in degrees) of every pixel of the detector.
+
+        The arrays only depend on the calibration and the shape of the detector, so
+        if the settings turn the cache on they are cached on disk, in a file named by a
+        hash of both, and memory-mapped when they are next needed.
+
+        Parameters
+        ----------
+        settings : settings class, optional
+            cpf settings class containing the cache directory (calibration_cache).
+            The default is None, which does not cache the arrays.
+
+        Returns
+        -------
+        tth : array
+            Two theta of each pixel.
+        azm : array
+            Azimuth of each pixel.
+        """
+        shape = tuple(self.detector.detector.max_shape)
+
+        cache = False
+        if settings is not None:
+            cache = settings.calibration_cache
+        if cache is True:
+            cache = IO_functions.cache_directory()
+
+        cache_file = None
+        if cache:
+            config = [
+                self.detector.get_config(),
+                shape,
+                getattr(self.detector, "chiDiscAtPi", None),
+                pyFAI.version,
+            ]
+            key = hashlib.sha1(
+                json.dumps(config, sort_keys=True, default=str).encode()
+            ).hexdigest()
+            cache_file = Path(cache) / ("geometry_" + key + ".npy")
+            try:
+                # copy-on-write so that the cache file is never changed.
+                geometry = np.load(cache_file, mmap_mode="c")
+                if geometry.shape == (2,) + shape:
+                    logger.moreinfo(  # type: ignore
+                        " ".join(
+                            map(str, [("Detector geometry read from %s" % cache_file)])
+                        )
+                    )
+                    return np.asarray(geometry[0]), np.asarray(geometry[1])
+            except (OSError, ValueError):
+                pass
+
+        geometry = np.array(
+            [
+                np.rad2deg(self.detector.twoThetaArray(shape)),
+                np.rad2deg(self.detector.chiArray(shape)),
+            ]
+        )
+
+        if cache_file is not None:
+            try:
+                IO_functions.save_cache_array(cache_file, geometry)
+                logger.moreinfo(  # type: ignore
+                    " ".join(
+                        map(str, [("Detector geometry cached in %s" % cache_file)])
+                    )
+                )
+            except OSError as e:
+                logger.warning(
+                    " ".join(map(str, [("Detector geometry was not cached: %s" % e)]))
+                )
+
+        return geometry[0], geometry[1]
+
     @staticmethod
     def detector_check(calibration_data, settings=None):
         """
@@ -469,7 +577,9 @@ class DioptasDetector:
 DioptasDetector._get_d_space = _AngleDispersive_common._get_d_space
 DioptasDetector.conversion = _AngleDispersive_common.conversion
 DioptasDetector.bins = _AngleDispersive_common.bins
+DioptasDetector.limits_index = _AngleDispersive_common.limits_index
 DioptasDetector.set_limits = _AngleDispersive_common.set_limits
+DioptasDetector.subpattern = _AngleDispersive_common.subpattern
 DioptasDetector.test_azims = _AngleDispersive_common.test_azims
 
 # add masking functions to detetor class.
@@ -8,6 +8,7 @@ import glob
 import json
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 import fabio
@@ -29,6 +30,10 @@ from cpf.input_types._Plot_AngleDispersive import _Plot_AngleDispersive
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
 
+# largest number of threads used to read the frames of an image. The frames are
+# separate files, so the reading is limited by the file system rather than python.
+frame_read_threads = 8
+
 """
 25th April 2024
 
@@ -185,6 +190,10 @@ class ESRFlvpDetector:
         self.conversion_constant = None
         self.detector = None
 
+        # sorted frames of each image, as {glob string: (files, positions)}, so that
+        # the directory is only listed once for each image.
+        self._sorted_files = {}
+
         if settings_class:
             self.get_calibration(settings=settings_class)
         if self.calibration:
@@ -284,6 +293,10 @@ class ESRFlvpDetector:
             Array of detector positions in degrees.
 
         """
+        if file_string in self._sorted_files:
+            files_list, positions = self._sorted_files[file_string]
+            return list(files_list), list(positions)
+
         # load the list of files
         files_list = glob.glob(file_string)
 
@@ -295,7 +308,45 @@ class ESRFlvpDetector:
         positions = [positions[i] for i in order]
         files_list = [files_list[i] for i in order]
 
-        return files_list, positions
+        if len(files_list) > 0:
+            # files that are not there yet (e.g. still being collected) are looked
+            # for again.
+            self._sorted_files[file_string] = (files_list, positions)
+
+        return list(files_list), list(positions)
+
+    def _read_frames(self, frames):
+        """
+        Read the frames of an image into a single array. The frames after the first
+        are read on separate threads, each into its place in the array.
+
+        Parameters
+        ----------
+        frames : list
+            Names of the frame files, in order.
+
+        Returns
+        -------
+        im : array
+            The frames, flipped (see import_image), as a (frames, rows, columns) array.
+
+        """
+        first = np.flipud(fabio.open(frames[0]).data)
+        im = np.empty((len(frames),) + first.shape, dtype=first.dtype)
+        im[0] = first
+
+        def read_frame(i):
+            im[i] = np.flipud(fabio.open(frames[i]).data)
+
+        threads = min(frame_read_threads, len(frames) - 1)
+        if threads > 1:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                # list the results so that any error reading the frames is raised.
+                list(executor.map(read_frame, range(1, len(frames))))
+        else:
+            for i in range(1, len(frames)):
+                read_frame(i)
+        return im
 
     def get_detector(
         self, settings=None, calibration_file=None, diffraction_data=None, debug=False
@@ -492,7 +543,7 @@ class ESRFlvpDetector:
         # get ordered list of images
         frames, angles = self._get_sorted_files(image_name, debug=debug)
 
-        im = np.array([np.flipud(fabio.open(f).data) for f in frames])
+        im = self._read_frames(frames)
         # 13th June 2024 - Note on flipud: the flipud command is included to invert the short axis of the detector intensity.
         # If I flip the data then the 'spots' in the reconstructed data are spot like, rather than incoherent
         # intensity diffraction peaks.
@@ -719,7 +770,7 @@ class ESRFlvpDetector:
 
         # add masks to arrays
         # FIX ME: should we apply the mask as the arrays are populated rather than here?
-        mask_array = self.get_mask(mask, self.intensity)
+        mask_array = self.get_mask(mask, self.intensity, settings=settings)
 
         self.mask_apply(mask_array, debug=debug)
         # FIX ME: should we apply the mask as the arrays are populated rather than
@@ -834,7 +885,9 @@ class ESRFlvpDetector:
 ESRFlvpDetector._get_d_space = _AngleDispersive_common._get_d_space
 ESRFlvpDetector.conversion = _AngleDispersive_common.conversion
 ESRFlvpDetector.bins = _AngleDispersive_common.bins
+ESRFlvpDetector.limits_index = _AngleDispersive_common.limits_index
 ESRFlvpDetector.set_limits = _AngleDispersive_common.set_limits
+ESRFlvpDetector.subpattern = _AngleDispersive_common.subpattern
 ESRFlvpDetector.test_azims = _AngleDispersive_common.test_azims
 
 # add masking functions to detetor class.
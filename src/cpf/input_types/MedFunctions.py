@@ -401,7 +401,7 @@ class MedDetector:
         # catch old formtting of the mask
         if isinstance(mask, list):
             mask = {"detector": mask}
-        mask_array = self.get_mask(mask, debug=debug)
+        mask_array = self.get_mask(mask, debug=debug, settings=settings)
         self.mask_apply(mask_array, debug=debug)
 
         self.azm_start = (
@@ -619,13 +619,19 @@ class MedDetector:
         :param **kwargs: - to ensure compatibility
         :return:
         """
-        bin_mean_azi = np.unique(self.azm.data)
+        bin_mean_azi, bin_number = np.unique(self.azm.data, return_inverse=True)
+        # masked data are not in any bin.
+        bin_number = bin_number.flatten()
+        bin_number[ma.getmaskarray(self.azm).flatten()] = len(bin_mean_azi)
+        # sort the data by bin (keeping their order within each bin) so that each
+        # chunk is a slice of the sorted indices.
+        order = np.argsort(bin_number, kind="stable")
+        edges = np.searchsorted(
+            bin_number[order], np.arange(len(bin_mean_azi) + 1), side="left"
+        )
         chunks = []
-        # azichunks = []
-        temp_azimuth = self.azm.flatten()
         for i in range(len(bin_mean_azi)):
-            azi_chunk = np.where((temp_azimuth == bin_mean_azi[i]))
-            chunks.append(azi_chunk)
+            chunks.append(order[edges[i] : edges[i + 1]])
 
         return chunks, bin_mean_azi
 
@@ -971,7 +977,9 @@ class MedDetector:
 
 
 # add common functions.
+MedDetector.limits_index = _AngleDispersive_common.limits_index
 MedDetector.set_limits = _AngleDispersive_common.set_limits
+MedDetector.subpattern = _AngleDispersive_common.subpattern
 
 # add masking functions to detetor class.
 MedDetector.get_mask = _masks.get_mask
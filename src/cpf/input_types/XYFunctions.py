@@ -404,7 +404,7 @@ class XYDetector:
         # self.dspace = self._get_d_space()
 
         # get and apply mask
-        mask_array = self.get_mask(mask, self.intensity)
+        mask_array = self.get_mask(mask, self.intensity, settings=settings)
         self.mask_apply(mask_array, debug=debug)
 
         self.azm_start = (
@@ -518,7 +518,9 @@ def csv_to_image(image_name):
 XYDetector._get_d_space = _AngleDispersive_common._get_d_space
 XYDetector.conversion = _AngleDispersive_common.conversion
 XYDetector.bins = _AngleDispersive_common.bins
+XYDetector.limits_index = _AngleDispersive_common.limits_index
 XYDetector.set_limits = _AngleDispersive_common.set_limits
+XYDetector.subpattern = _AngleDispersive_common.subpattern
 XYDetector.test_azims = _AngleDispersive_common.test_azims
 
 # add masking functions to detetor class.
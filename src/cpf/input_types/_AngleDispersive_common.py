@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from copy import copy
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -87,7 +88,8 @@ class _AngleDispersive_common:
         Assign each data to a chunk corresponding to its azimuth value
         Returns array with indices for each bin and array of bin centroids
         :param orders_class:
-        :return chunks:
+        :param cascade:
+        :return chunks: list of arrays of the (flattened) indices of the data in each bin
         :return bin_mean_azi:
         """
 
@@ -110,7 +112,7 @@ class _AngleDispersive_common:
             # split the data into bins with an approximately constant number of data.
             # uses b_num to determine bin size
             num_bins = int(np.round(len(self.azm[self.azm.mask == False]) / b_num))
-            bin_boundaries = self.equalObs(
+            bin_boundaries = equalObs(
                 np.sort(self.azm[self.azm.mask == False]), num_bins
             )
         elif bt == 1:
@@ -149,25 +151,35 @@ class _AngleDispersive_common:
             )
         )
 
-        # fit the data to the bins
+        # fit the data to the bins.
+        # Each datum is in the bin with start < azimuth <= end. The data are sorted by
+        # bin (keeping their order within each bin) so that each chunk is a slice of
+        # the sorted indices.
+        temp_azimuth = self.azm.flatten()
+        bin_number = (
+            np.searchsorted(bin_boundaries, ma.getdata(temp_azimuth), side="left") - 1
+        )
+        order = np.argsort(bin_number, kind="stable")
+        edges = np.searchsorted(
+            bin_number[order], np.arange(len(bin_boundaries)), side="left"
+        )
         chunks = []
         bin_mean_azi = []
-        temp_azimuth = self.azm.flatten()
         for i in range(len(bin_boundaries) - 1):
-            start = bin_boundaries[i]
-            end = bin_boundaries[i + 1]
-            azi_chunk = np.where((temp_azimuth > start) & (temp_azimuth <= end))
+            azi_chunk = order[edges[i] : edges[i + 1]]
             chunks.append(azi_chunk)
             bin_mean_azi.append(np.mean(temp_azimuth[azi_chunk]))
 
         return chunks, bin_mean_azi
 
-    def set_limits(self, range_bounds=[-np.inf, np.inf], azi_bounds=[-np.inf, np.inf]):
+    def limits_index(
+        self, range_bounds=[-np.inf, np.inf], azi_bounds=[-np.inf, np.inf]
+    ):
         """
-        Cut the data to only data within range_bounds (two theta) and azi_bounds (azimuth).
+        Find the data within range_bounds (two theta) and azi_bounds (azimuth).
 
-        N.B. This is not a masking function. it removes all the data outside of the range.
-        Data inside the range that is masked remains.
+        The index only depends on the positions of the data, so it can be made once
+        and used to cut each new image (see set_limits and subpattern).
 
         Parameters
         ----------
@@ -178,15 +190,44 @@ class _AngleDispersive_common:
 
         Returns
         -------
-        None.
+        tuple of arrays
+            Index of the data within the limits.
 
         """
-        local_mask = np.where(
+        return np.where(
             (self.tth >= range_bounds[0])
             & (self.tth <= range_bounds[1])
             & (self.azm >= azi_bounds[0])
             & (self.azm <= azi_bounds[1])
         )
+
+    def set_limits(
+        self, range_bounds=[-np.inf, np.inf], azi_bounds=[-np.inf, np.inf], index=None
+    ):
+        """
+        Cut the data to only data within range_bounds (two theta) and azi_bounds (azimuth).
+
+        N.B. This is not a masking function. it removes all the data outside of the range.
+        Data inside the range that is masked remains.
+
+        Parameters
+        ----------
+        range_bounds : list, optional
+            Two theta limits to apply to the data. The default is [-np.inf, np.inf].
+        azi_bounds : list, optional
+            Azimuth limits to apply to the data. . The default is [-np.inf, np.inf].
+        index : tuple of arrays, optional
+            Index of the data to keep, from limits_index. If given the bounds are
+            not used. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        if index is None:
+            index = self.limits_index(range_bounds=range_bounds, azi_bounds=azi_bounds)
+        local_mask = index
         self.intensity = self.intensity[local_mask]
         self.tth = self.tth[local_mask]
         self.azm = self.azm[local_mask]
@@ -206,6 +247,27 @@ class _AngleDispersive_common:
         # self.azm_end = np.max(self.azm)
         # self.azm_start = np.min(self.azm)
 
+    def subpattern(self, index):
+        """
+        Copy of the data class cut to the data in index (see limits_index).
+
+        Only the data within the index are copied; the rest of the data class
+        (calibration, detector etc.) is shared with the original.
+
+        Parameters
+        ----------
+        index : tuple of arrays
+            Index of the data to keep, from limits_index.
+
+        Returns
+        -------
+        Data class instance.
+
+        """
+        new = copy(self)
+        new.set_limits(index=index)
+        return new
+
     def test_azims(self, steps=360):
         """
         Returns equally spaced set of aximuths within possible range.
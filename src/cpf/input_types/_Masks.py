@@ -30,6 +30,12 @@ Need functions that can:
 Remove mask functions from these class files and put in separate common file.
 """
 
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+
 import numpy as np
 import numpy.ma as ma
 
@@ -37,6 +43,8 @@ import numpy.ma as ma
 # from matplotlib import gridspec, cm, colors
 from PIL import Image, ImageDraw
 
+from cpf.IO_functions import cache_directory, save_cache_array
+
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
 
@@ -54,10 +62,13 @@ class _masks:
     #     """
     #     self = detector_class
 
-    def get_mask(self, mask, im_ints=None, debug=False):
+    def get_mask(self, mask, im_ints=None, debug=False, settings=None):
         """
         Creates the mask for the diffracion data and returns a boolian image.
 
+        The parts of the mask made from the mask image, polygons and detectors are
+        cached (see static_mask). The threshold, two theta and azimuth limits are
+        applied to them each time.
 
         Parameters
         ----------
@@ -65,6 +76,9 @@ class _masks:
             Object that can created into a mask for the data.
         im_ints : array
             Diffraction data array -- so that can build mask around it.
+        settings : settings class, optional
+            cpf settings class containing the cache directory (calibration_cache).
+            The default is None, which does not cache the mask on disk.
 
         Returns
         -------
@@ -83,46 +97,16 @@ class _masks:
             # make empty dictionary
             mask = {}
 
-        # make empty mask
-        im_mask = np.zeros(im_ints.shape, dtype="bool")
-
-        if "image" in mask:
-            # Dioptas mask is compressed Tiff image.
-            # Save and load functions within Dioptas are: load_mask and save_mask in dioptas/model/MaskModel.py
-            mask_from_image = np.array(Image.open(mask["image"]))
-            # im_ints = ma.array(im_ints, mask=im_mask)
-            # im_ints = ma.masked_less(im_ints, 0)
-            if mask_from_image.shape == im_ints.shape:
-                im_mask = np.asarray(im_mask) | np.asarray(mask_from_image)
-            elif mask_from_image.shape == im_ints.shape[1:2]:
-                # the masked image is for a single detector frame and the diffraction data is composed of multiple frames
-                # (e.g. ESRFlvp detector).
-                # assumes the repitition of the detector frame is in the first dimension of the array
-                mask_from_image = np.expand_dims(mask_from_image, axis=0)
-                mask_from_image = np.repeat(
-                    mask_from_image, mask_from_image.shape[0], axis=0
-                )
-            im_mask = np.asarray(im_mask) | ma.asarray(mask_from_image)
-
-        if "polygon" in mask:
-            polygons = mask["polygon"]
-            for i in polygons:
-                img = Image.new("L", im_ints.shape, 0)
-                ImageDraw.Draw(img).polygon(i, outline=1, fill=1)
-                im_mask = im_mask + ma.array(img)
+        # the parts of the mask that are the same for every image.
+        cache = False
+        if settings is not None:
+            cache = settings.calibration_cache
+        im_mask = static_mask(mask, im_ints.shape, cache=cache)
 
         if "threshold" in mask:
             threshold = mask["threshold"]
-            im_mask = (
-                np.asarray(im_mask)
-                | ma.masked_outside(im_ints, threshold[0], threshold[1]).mask
-            )
-
-        if "detector" in mask:
-            # Masks for energy dispersive detector elements for full detector.
-            # Works by removing complete detectors.
-            for x in range(len(mask["detector"])):
-                im_mask[mask["detector"][x] - 1] = True
+            data = ma.getdata(im_ints)
+            im_mask = im_mask | (data < threshold[0]) | (data > threshold[1])
 
         if "energy" in mask:
             raise ValueError("'Energy' is not implemented.")
@@ -151,13 +135,14 @@ class _masks:
 
         # FIX ME: Should also add circles and other polygons as per GSAS-II masks
 
-        # mask invalid values
-        mask2 = ma.masked_invalid(im_ints).mask
-        # mask everything less than 0.
-        mask3 = ma.masked_less(im_ints, 0).mask
-
-        # combine masks
-        im_mask = np.asarray(im_mask) | np.asarray(mask2) | np.asarray(mask3)
+        # mask invalid values, everything less than 0 and anything already masked.
+        data = ma.getdata(im_ints)
+        im_mask = (
+            np.asarray(im_mask)
+            | ~np.isfinite(data)
+            | (data < 0)
+            | ma.getmaskarray(im_ints)
+        )
         # im_ints = ma.array(im_ints, mask=im_mask)
 
         """
@@ -333,3 +318,128 @@ class _masks:
 
         logger.effusive(" ".join(map(str, [("Remove all masks.")])))
         self.mask_apply(None)
+
+
+# number of static masks kept in memory, as packed bits.
+mask_cache_size = 4
+# the static masks kept in memory, as {key: packed bits}.
+_static_masks = OrderedDict()
+
+
+def static_mask(mask, shape, cache=False):
+    """
+    Make the parts of the mask that are the same for every image: the mask image,
+    the polygons and the detectors. The thresholds and the two theta and azimuth
+    limits are not included.
+
+    Reading the mask image and drawing the polygons is slow compared to the rest of
+    the masking, so the mask is cached, as packed bits, in memory and, if cache is
+    set, in a file in the cache directory. The cached masks are found by a hash of the mask
+    (including the modification time of the mask image) and the shape of the data.
+
+    Parameters
+    ----------
+    mask : dictionary
+        Mask definitions (see get_mask).
+    shape : tuple
+        Shape of the diffraction data.
+    cache : bool or string, optional
+        Directory to cache the mask in. True uses the default directory; False (the
+        default) or None does not cache the mask on disk.
+
+    Returns
+    -------
+    im_mask : boolian array
+        The mask.
+    """
+    shape = tuple(int(n) for n in shape)
+    if "image" not in mask and "polygon" not in mask:
+        # nothing to read or draw.
+        return _make_static_mask(mask, shape)
+
+    config = {
+        "polygon": mask.get("polygon"),
+        "detector": mask.get("detector"),
+        "shape": shape,
+    }
+    if "image" in mask:
+        stat = os.stat(mask["image"])
+        config["image"] = [
+            os.path.abspath(mask["image"]),
+            stat.st_mtime_ns,
+            stat.st_size,
+        ]
+    key = hashlib.sha1(
+        json.dumps(config, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    size = int(np.prod(shape))
+
+    packed = _static_masks.get(key)
+    cache_file = None
+    if cache is True:
+        cache = cache_directory()
+    if packed is None and cache:
+        cache_file = Path(cache) / ("mask_" + key + ".npy")
+        try:
+            packed = np.load(cache_file)
+            if packed.size != (size + 7) // 8:
+                packed = None
+            else:
+                logger.moreinfo(  # type: ignore
+                    " ".join(map(str, [("Mask read from %s" % cache_file)]))
+                )
+        except (OSError, ValueError):
+            packed = None
+
+    if packed is None:
+        im_mask = _make_static_mask(mask, shape)
+        packed = np.packbits(im_mask)
+        if cache_file is not None:
+            try:
+                save_cache_array(cache_file, packed)
+                logger.moreinfo(  # type: ignore
+                    " ".join(map(str, [("Mask cached in %s" % cache_file)]))
+                )
+            except OSError as e:
+                logger.warning(" ".join(map(str, [("Mask was not cached: %s" % e)])))
+    else:
+        im_mask = np.unpackbits(packed, count=size).reshape(shape).view(bool)
+
+    _static_masks[key] = packed
+    _static_masks.move_to_end(key)
+    while len(_static_masks) > mask_cache_size:
+        _static_masks.popitem(last=False)
+
+    return im_mask
+
+
+def _make_static_mask(mask, shape):
+    """
+    Make the static mask (see static_mask) without the cache.
+    """
+    # make empty mask
+    im_mask = np.zeros(shape, dtype="bool")
+
+    if "image" in mask:
+        # Dioptas mask is compressed Tiff image.
+        # Save and load functions within Dioptas are: load_mask and save_mask in dioptas/model/MaskModel.py
+        mask_from_image = np.array(Image.open(mask["image"]))
+        # if the masked image is for a single detector frame and the diffraction data
+        # is composed of multiple frames (e.g. ESRFlvp detector) it is repeated for
+        # each frame (in the first dimension of the array) by broadcasting.
+        im_mask = im_mask | (mask_from_image != 0)
+
+    if "polygon" in mask:
+        polygons = mask["polygon"]
+        for i in polygons:
+            img = Image.new("L", shape, 0)
+            ImageDraw.Draw(img).polygon(i, outline=1, fill=1)
+            im_mask = im_mask | (np.array(img) != 0)
+
+    if "detector" in mask:
+        # Masks for energy dispersive detector elements for full detector.
+        # Works by removing complete detectors.
+        for x in range(len(mask["detector"])):
+            im_mask[mask["detector"][x] - 1] = True
+
+    return im_mask
@@ -19,18 +19,25 @@ __all__ = [
     "un_vary_part_params",
     "un_vary_single_param",
     "peaks_model",
+    "peaks_jacobian",
     "fit_model",
+    "fit_model_least_squares",
+    "fit_model_varpro",
     "coefficient_fit",
 ]
 
 import sys
 import warnings
+from copy import deepcopy
 
 import numpy as np
-from lmfit import Model, Parameters
+from lmfit import Model, Parameters, fit_report, minimize
+from lmfit.minimizer import MinimizerResult
+from scipy.optimize import least_squares
 
 import cpf.peak_functions as pf
 import cpf.series_functions as sf
+from cpf.compiled_model import CompiledModel
 
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
@@ -727,6 +734,7 @@ def peaks_model(
     data_class=None,  # needs to contain conversion factor
     orders=None,  # orders dictionary to get minimum position of the range.
     start_end=[0, 360],
+    compiled_model=None,  # precompiled design matrices for these positions.
     **params,
 ):
     """Full model of intensities at twotheta and azi given input parameters
@@ -736,12 +744,22 @@ def peaks_model(
     :param nterms_back: total number of polynomial expansion components for the background int
     :param conv: inputs for the conversion call dict
     :param PenCalc: penalise background or not int
+    :param compiled_model: CompiledModel made for these positions, or None
     :param params: lmfit parameter class dict
     :return lmfit model fit result
     """
     # N.B. params now doesn't persist as a parameter class, merely a dictionary, so e.g. call key/value pairs as
     # normal not with '.value'
 
+    if compiled_model is not None:
+        # evaluate the model as matrix products rather than parsing the parameters.
+        compiled_model.check_positions(two_theta, azimuth)
+        intensity = compiled_model.evaluate(compiled_model.vector(params))
+        mask = np.ma.getmaskarray(two_theta) | np.ma.getmaskarray(azimuth)
+        if np.any(mask):
+            intensity = np.ma.array(intensity, mask=mask)
+        return intensity
+
     # expand the background
     intensity = sf.background_expansion((azimuth, two_theta), orders, params)
 
@@ -762,6 +780,11 @@ def peaks_model(
             symm = params["peak_" + str(a) + "_s0"]
         else:
             symm = 1
+        # keep the same azimuth array if possible, so its series bases are cached.
+        if symm == 1:
+            azimuth_symm = azimuth
+        else:
+            azimuth_symm = azimuth * symm
 
         # May need to fix for multiple Fourier coefficients per component
         param_str = "peak_" + str(a)
@@ -775,19 +798,19 @@ def peaks_model(
         parms = gather_params_from_dict(params, param_str, comp)
         coeff_type = sf.get_series_type(params, param_str, comp)
         h_all = sf.coefficient_expand(
-            azimuth * symm, parms, coeff_type=coeff_type, start_end=start_end
+            azimuth_symm, parms, coeff_type=coeff_type, start_end=start_end
         )
         comp = "w"
         parms = gather_params_from_dict(params, param_str, comp)
         coeff_type = sf.get_series_type(params, param_str, comp)
         w_all = sf.coefficient_expand(
-            azimuth * symm, parms, coeff_type=coeff_type, start_end=start_end
+            azimuth_symm, parms, coeff_type=coeff_type, start_end=start_end
         )
         comp = "p"
         parms = gather_params_from_dict(params, param_str, comp)
         coeff_type = sf.get_series_type(params, param_str, comp)
         p_all = sf.coefficient_expand(
-            azimuth * symm, parms, coeff_type=coeff_type, start_end=start_end
+            azimuth_symm, parms, coeff_type=coeff_type, start_end=start_end
         )
 
         # conversion
@@ -807,6 +830,85 @@ def peaks_model(
     return intensity
 
 
+def peaks_jacobian(
+    params,
+    data,
+    weights,
+    two_theta=None,
+    azimuth=None,
+    data_class=None,
+    orders=None,
+    start_end=[0, 360],
+    compiled_model=None,
+    **kwargs,
+):
+    """Analytical Jacobian of the residual (data - peaks_model) for lmfit.
+    The call signature is that lmfit uses for 'Dfun': the Parameters class followed by
+    the arguments and keywords of the residual.
+    :param params: lmfit Parameter class
+    :param data: intensity values being fitted
+    :param weights: weights applied to the residual, or None
+    :param two_theta: arr values float
+    :param azimuth: arr values float
+    :param data_class: data class containing the conversion function
+    :param orders: orders dictionary
+    :param start_end: start and end of azimuths
+    :param compiled_model: CompiledModel made for these positions, or None
+    :return: array of size (n data, n varying parameters)
+    """
+    if compiled_model is None:
+        compiled_model = CompiledModel(
+            params,
+            two_theta,
+            azimuth,
+            data_class=data_class,
+            orders=orders,
+            start_end=start_end,
+        )
+    else:
+        compiled_model.check_positions(two_theta, azimuth)
+
+    derivs = compiled_model.derivatives(compiled_model.vector(params))
+    columns = [compiled_model.index[key] for key, par in params.items() if par.vary]
+    # residual is data - model
+    jac = -derivs[:, columns]
+    if weights is not None:
+        jac = jac * np.asarray(weights).reshape(-1, 1)
+    # the model is masked wherever the positions are masked and the residual there is
+    # then just the data, which does not change with the parameters.
+    masked = (
+        np.ma.getmaskarray(two_theta).flatten() | np.ma.getmaskarray(azimuth).flatten()
+    )
+    if np.ma.isMaskedArray(data):
+        masked = masked | np.ma.getmaskarray(data).flatten()
+    jac[masked] = 0
+    return jac
+
+
+def _move_off_bounds(params, fraction=1e-8):
+    """
+    Move varying parameters that sit exactly on a bound a very small distance inside it.
+    lmfit's bounds transformation has a zero gradient at the bounds, which stalls
+    leastsq when it is given an exact Jacobian.
+    :param params: lmfit Parameter class
+    :param fraction: fraction of the bounded range to move the parameter by
+    :return: copy of the lmfit Parameter class
+    """
+    params = deepcopy(params)
+    for par in params.values():
+        if not par.vary or par.expr is not None:
+            continue
+        if np.isfinite(par.min) and np.isfinite(par.max):
+            step = (par.max - par.min) * fraction
+        else:
+            step = np.max([np.abs(par.value), 1]) * fraction
+        if par.value <= par.min:
+            par.set(value=par.min + step)
+        elif par.value >= par.max:
+            par.set(value=par.max - step)
+    return params
+
+
 def fit_model(
     data_as_class,  # needs to contain intensity, tth, azi (as chunks), conversion factor
     orders,
@@ -815,6 +917,9 @@ def fit_model(
     fit_method="leastsq",
     weights=None,
     max_n_fev=400,
+    jacobian="numerical",
+    compiled_model=None,
+    backend="lmfit",
 ):
     """Initiate model of intensities at twotheta and azi given input parameters and fit
     :param max_n_fev:
@@ -828,12 +933,34 @@ def fit_model(
     :param fixed: unsure
     :param method: lmfit choice of fitting method e.g. a least squares
     :param weights: errors on intensity values arr of size intensity_fit
+    :param jacobian: 'numerical' (finite differences) or 'analytical' (peaks_jacobian)
+    :param compiled_model: CompiledModel made for the data, or None
+    :param backend: 'lmfit' to fit with an lmfit Model or 'least_squares' to fit with
+        scipy directly (see fit_model_least_squares)
     :return: lmfit model result
     """
+    if backend == "least_squares" and not any(
+        par.expr is not None for par in params.values()
+    ):
+        return fit_model_least_squares(
+            data_as_class,
+            orders,
+            params,
+            start_end=start_end,
+            weights=weights,
+            max_n_fev=max_n_fev,
+            jacobian=jacobian,
+            compiled_model=compiled_model,
+        )
 
     # FIX ME: DMF does the above statement need addressing?
     gmodel = Model(peaks_model, independent_vars=["two_theta", "azimuth"])
 
+    fit_kws = {}
+    if jacobian == "analytical":
+        fit_kws["Dfun"] = peaks_jacobian
+        params = _move_off_bounds(params)
+
     if 1:
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
@@ -846,9 +973,11 @@ def fit_model(
                 data_class=data_as_class,  # needs to contain tth, azi, conversion factor
                 orders=orders,  # orders class to get peak lengths (if needed)
                 start_end=start_end,  # start and end of azimuths if needed
+                compiled_model=compiled_model,  # precompiled model if it exists
                 nan_policy="propagate",
                 max_nfev=max_n_fev,
                 xtol=1e-5,
+                fit_kws=fit_kws,
             )
     else:
         out = gmodel.fit(
@@ -859,13 +988,323 @@ def fit_model(
             data_class=data_as_class,  # needs to contain tth, azi, conversion factor
             orders=orders,  # orders class to get peak lengths (if needed)
             start_end=start_end,  # start and end of azimuths if needed
+            compiled_model=compiled_model,  # precompiled model if it exists
             nan_policy="propagate",
             max_nfev=max_n_fev,
             xtol=1e-5,
+            fit_kws=fit_kws,
         )
     return out
 
 
+class LeastSquaresResult(MinimizerResult):
+    """
+    Result of fit_model_least_squares, with the attributes of an lmfit result.
+    """
+
+    def fit_report(self, **kws):
+        """
+        Report of the fit, as lmfit's.
+        :param kws: keywords passed to lmfit.fit_report
+        :return: str
+        """
+        return fit_report(self, **kws)
+
+
+def fit_model_least_squares(
+    data_as_class,
+    orders,
+    params,
+    start_end=[0, 360],
+    weights=None,
+    max_n_fev=400,
+    jacobian="numerical",
+    compiled_model=None,
+):
+    """Fit the model with scipy.optimize.least_squares on a flat vector of the varying
+    parameters. This is the same fit as fit_model but without making an lmfit Model
+    and passing the parameters through it on every evaluation. The bounds are those of
+    the parameters (made from parse_bounds by initiate_all_params_for_fit) and are
+    applied by the trust region reflective method, rather than lmfit's transformation,
+    so the fits can stop at slightly different places. The errors are made from the
+    pseudo-inverse of the Jacobian, as curve_fit does.
+    :param data_as_class: data class containing intensity, tth, azm and the conversion
+    :param orders: orders dictionary to get minimum position of the range
+    :param params: lmfit Parameter class of the model
+    :param start_end: start and end of azimuths
+    :param weights: weights applied to the residual, or None
+    :param max_n_fev: maximum number of function evaluations
+    :param jacobian: 'numerical' (finite differences) or 'analytical'
+    :param compiled_model: CompiledModel made for the data, or None
+    :return: LeastSquaresResult, with the attributes of an lmfit result used here
+    """
+    if compiled_model is None:
+        compiled_model = CompiledModel(
+            params,
+            data_as_class.tth,
+            data_as_class.azm,
+            data_class=data_as_class,
+            orders=orders,
+            start_end=start_end,
+        )
+    else:
+        compiled_model.check_positions(data_as_class.tth, data_as_class.azm)
+
+    # fit the same data as fit_model: lmfit converts the data and positions to arrays
+    # without their masks.
+    intensity = np.ma.getdata(data_as_class.intensity).flatten()
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float).flatten()
+
+    params = deepcopy(params)
+    var_names = [name for name, par in params.items() if par.vary]
+    columns = np.array([compiled_model.index[name] for name in var_names], dtype=int)
+    lower = np.array([params[name].min for name in var_names], dtype=float)
+    upper = np.array([params[name].max for name in var_names], dtype=float)
+    start = np.clip([params[name].value for name in var_names], lower, upper)
+    vector = compiled_model.vector(params)
+
+    def residual(x):
+        """residual (data - model) of the varying parameters"""
+        vector[columns] = x
+        out = intensity - compiled_model.evaluate(vector).flatten()
+        if weights is not None:
+            out = out * weights
+        return out
+
+    def residual_jacobian(x):
+        """Jacobian of the residual"""
+        vector[columns] = x
+        jac = -compiled_model.derivatives(vector)[:, columns]
+        if weights is not None:
+            jac = jac * weights[:, np.newaxis]
+        return jac
+
+    if np.isfinite(max_n_fev):
+        max_nfev = int(max_n_fev)
+    else:
+        max_nfev = None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        res = least_squares(
+            residual,
+            start,
+            jac=residual_jacobian if jacobian == "analytical" else "2-point",
+            bounds=(lower, upper),
+            method="trf",
+            x_scale="jac",
+            xtol=1e-5,
+            max_nfev=max_nfev,
+        )
+
+    for name, value in zip(var_names, res.x):
+        params[name].value = value
+    ndata = intensity.size
+    nvarys = len(var_names)
+    chisqr = float(2 * res.cost)
+    covar = None
+    if ndata > nvarys and nvarys > 0:
+        covar = _pseudo_inverse_covariance(res.jac) * chisqr / (ndata - nvarys)
+    if covar is not None:
+        _set_errors(params, var_names, covar)
+    else:
+        for par in params.values():
+            par.stderr, par.correl = None, None
+
+    out = LeastSquaresResult(
+        params=params,
+        var_names=var_names,
+        covar=covar,
+        init_vals=list(start),
+        residual=res.fun,
+        nfev=res.nfev,
+        success=res.status > 0,
+        errorbars=covar is not None,
+        method="least_squares",
+        message=res.message,
+        ndata=ndata,
+        nvarys=nvarys,
+        nfree=ndata - nvarys,
+    )
+    out._calculate_statistics()
+    return out
+
+
+def _pseudo_inverse_covariance(jac):
+    """
+    Unscaled covariance matrix from the pseudo-inverse of the Jacobian, as
+    scipy.optimize.curve_fit makes it: the singular values smaller than the rounding
+    of the largest are dropped, so a poorly determined direction does not lose the
+    errors of all the parameters.
+    :param jac: Jacobian of the residual, size (data, varied parameters)
+    :return: covariance matrix of the varied parameters
+    """
+    _, singular, vt = np.linalg.svd(jac, full_matrices=False)
+    keep = singular > np.finfo(float).eps * max(jac.shape) * singular[0]
+    vt = vt[keep] / singular[keep, np.newaxis]
+    return vt.T @ vt
+
+
+def _set_errors(params, var_names, covar):
+    """
+    Set the errors and correlations of the parameters from a covariance matrix, as
+    lmfit does: the parameters that are not varied have no error.
+    :param params: lmfit Parameter class, changed in place
+    :param var_names: names of the varied parameters, in the order of covar
+    :param covar: covariance matrix of the varied parameters
+    """
+    for par in params.values():
+        par.stderr, par.correl = 0, None
+    for i, name in enumerate(var_names):
+        params[name].stderr = float(np.sqrt(np.abs(covar[i, i])))
+        params[name].correl = {
+            other: float(covar[i, j] / np.sqrt(covar[i, i] * covar[j, j]))
+            for j, other in enumerate(var_names)
+            if j != i
+        }
+
+
+def fit_model_varpro(
+    data_as_class,
+    orders,
+    params,
+    start_end=[0, 360],
+    linear=None,
+    max_n_fev=400,
+    jacobian="numerical",
+    compiled_model=None,
+    backend="lmfit",
+):
+    """Fit the model by variable projection.
+    The model is linear in the background and peak height coefficients. These are
+    solved for exactly, by linear least squares, within each evaluation of the
+    residual so that only the varying d-spacing, width and profile coefficients are
+    passed to the non-linear minimisation, which uses Kaufman's approximation to the
+    Jacobian of the projected residual. The result is then polished by a fit
+    (fit_model) of all the varying parameters, which starts at the minimum and so is
+    short, to apply the bounds and get the errors. If that fit has no covariance
+    matrix, because a parameter is on a bound, the errors are made from the
+    pseudo-inverse of the Jacobian.
+    :param data_as_class: data class containing intensity, tth, azm and the conversion
+    :param orders: orders dictionary to get minimum position of the range
+    :param params: lmfit Parameter class of the model
+    :param start_end: start and end of azimuths
+    :param linear: names of the linear coefficients to solve for. If None the varying
+        linear coefficients are solved for.
+    :param max_n_fev: maximum number of function evaluations of each minimisation
+    :param jacobian: 'numerical' or 'analytical', passed to fit_model
+    :param compiled_model: CompiledModel made for the data, or None
+    :param backend: 'lmfit' or 'least_squares', passed to fit_model
+    :return: lmfit model result
+    """
+    if compiled_model is None:
+        compiled_model = CompiledModel(
+            params,
+            data_as_class.tth,
+            data_as_class.azm,
+            data_class=data_as_class,
+            orders=orders,
+            start_end=start_end,
+        )
+    else:
+        compiled_model.check_positions(data_as_class.tth, data_as_class.azm)
+
+    if linear is None:
+        linear = [
+            name
+            for name in compiled_model.linear_names
+            if params[name].vary and params[name].expr is None
+        ]
+    solve = np.array([name in linear for name in compiled_model.linear_names])
+
+    # fit the same data as fit_model: lmfit converts the data and positions to arrays
+    # without their masks.
+    intensity = np.ma.getdata(data_as_class.intensity).flatten()
+
+    # the last solution, which the Jacobian is evaluated at.
+    last = {}
+
+    def solve_linear(non_linear):
+        """coefficient vector with the best linear coefficients, design and residual"""
+        vector = compiled_model.vector(non_linear)
+        key = vector.tobytes()
+        if key in last:
+            return last[key]
+        design = compiled_model.linear_design(vector)
+        coefficients = vector[compiled_model.linear_index]
+        target = intensity - design[:, ~solve] @ coefficients[~solve]
+        coefficients[solve] = np.linalg.lstsq(design[:, solve], target, rcond=None)[0]
+        vector[compiled_model.linear_index] = coefficients
+        last.clear()
+        last[key] = vector, design, design @ coefficients - intensity
+        return last[key]
+
+    def projected_jacobian(non_linear):
+        """Kaufman's approximation to the Jacobian of the projected residual"""
+        vector, design, residual = solve_linear(non_linear)
+        columns = [
+            compiled_model.index[name] for name, par in non_linear.items() if par.vary
+        ]
+        derivs = compiled_model.derivatives(vector)[:, columns]
+        basis = np.linalg.qr(design[:, solve])[0]
+        return derivs - basis @ (basis.T @ derivs)
+
+    non_linear = _move_off_bounds(params)
+    for name in compiled_model.linear_names:
+        non_linear[name].set(vary=False)
+
+    if any(par.vary for par in non_linear.values()):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            out = minimize(
+                lambda p: solve_linear(p)[2],
+                non_linear,
+                method="leastsq",
+                max_nfev=max_n_fev,
+                Dfun=projected_jacobian,
+            )
+        non_linear = out.params
+        logger.debug(
+            " ".join(
+                map(
+                    str,
+                    [("Variable projection fit: %i function evaluations" % out.nfev)],
+                )
+            )
+        )
+
+    # copy the solution into the parameters and polish it.
+    coefficients = solve_linear(non_linear)[0][compiled_model.linear_index]
+    params = deepcopy(params)
+    for name in non_linear:
+        if params[name].expr is None:
+            params[name].set(value=non_linear[name].value)
+    for name, value in zip(compiled_model.linear_names, coefficients):
+        if name in linear and params[name].expr is None:
+            params[name].set(value=np.clip(value, params[name].min, params[name].max))
+
+    out = fit_model(
+        data_as_class,
+        orders,
+        params,
+        start_end=start_end,
+        max_n_fev=max_n_fev,
+        jacobian=jacobian,
+        compiled_model=compiled_model,
+        backend=backend,
+    )
+    if out.success and not out.errorbars and out.nfree > 0 and len(out.var_names) > 0:
+        # lmfit has no covariance matrix if a parameter is on a bound, because its
+        # transformation of the parameter has no gradient there. Make the errors from
+        # the pseudo-inverse of the Jacobian of the parameters themselves instead.
+        columns = [compiled_model.index[name] for name in out.var_names]
+        jac = compiled_model.derivatives(compiled_model.vector(out.params))[:, columns]
+        out.covar = _pseudo_inverse_covariance(jac) * out.chisqr / out.nfree
+        _set_errors(out.params, out.var_names, out.covar)
+        out.errorbars = True
+    return out
+
+
 def coefficient_fit(
     ydata,
     azimuth,
@@ -877,6 +1316,7 @@ def coefficient_fit(
     fit_method="leastsq",
     start_end=[0, 360],
     max_nfev=400,
+    solver="lmfit",
 ):
     """Fit the Fourier expansion to number of required terms
     :param ydata: Component data array to fit float
@@ -887,7 +1327,10 @@ def coefficient_fit(
     :param param_str: str start of parameter name
     :param symmetry: symmetry in azimuth of the fourier to be fit
     :param fit_method: lmfit method default 'leastsq'
-    :return: lmfit Model result
+    :param solver: 'lmfit' to fit the series iteratively or 'linear' to solve it
+        directly, by linear least squares. The linear solution falls back to lmfit
+        if it is not within the bounds of the parameters or is not unique.
+    :return: lmfit Model result, or lmfit Minimizer result if solved directly
     """
 
     # get NaN values.
@@ -933,6 +1376,20 @@ def coefficient_fit(
     except TypeError:
         new_errs[:] = 0.5  # Need to talk to Simon about this!!!
     new_errs = new_errs.astype("float64")
+
+    if solver == "linear":
+        out = _coefficient_fit_linear(
+            ydata[idx],
+            azimuth[idx] * symmetry,
+            new_errs,
+            inp_param,
+            param_str,
+            coeff_type,
+            start_end=start_end,
+        )
+        if out is not None:
+            return out
+
     out = f_model.fit(
         ydata[idx],
         inp_param,
@@ -946,3 +1403,79 @@ def coefficient_fit(
         max_nfev=max_nfev,
     )
     return out
+
+
+def _coefficient_fit_linear(
+    ydata, azimuth, weights, params, param_str, coeff_type, start_end=[0, 360]
+):
+    """
+    Solve for the coefficients of a series by weighted linear least squares.
+    All the series types are linear in their coefficients, so this is the minimum that
+    lmfit converges to, if it is within the bounds of the parameters. The errors are
+    those lmfit makes from the covariance matrix (scaled by the reduced chi-squared).
+    :param ydata: component values to fit
+    :param azimuth: azimuths of the values (multiplied by the symmetry)
+    :param weights: weights of the residual, as passed to lmfit
+    :param params: lmfit Parameter class
+    :param param_str: start of the names of the series coefficients, e.g. 'peak_0_h'
+    :param coeff_type: series type
+    :param start_end: start and end of azimuths
+    :return: lmfit Minimizer result, or None if the solution is not that of lmfit
+    """
+    n_coeff = 0
+    while param_str + str(n_coeff) in params:
+        n_coeff = n_coeff + 1
+    names = [param_str + str(i) for i in range(n_coeff)]
+    free = [i for i, name in enumerate(names) if params[name].vary]
+    # lmfit would also vary (or constrain) parameters that are not in the series.
+    others = [
+        name
+        for name, par in params.items()
+        if (par.vary and name not in names) or par.expr is not None
+    ]
+    n_free = len(ydata) - len(free)
+    if len(free) == 0 or len(others) > 0 or n_free <= 0:
+        return None
+    if not np.all(np.isfinite(weights)):
+        return None
+
+    basis = sf.coefficient_basis(
+        azimuth, n_coeff, coeff_type=coeff_type, start_end=start_end
+    )
+    values = np.array([params[name].value for name in names], dtype=float)
+    fixed = [i for i in range(n_coeff) if i not in free]
+    target = (ydata - basis[:, fixed] @ values[fixed]) * weights
+    design = basis[:, free] * weights[:, np.newaxis]
+    solution, _, rank, _ = np.linalg.lstsq(design, target, rcond=None)
+    if rank < len(free):
+        return None
+    for i, value in zip(free, solution):
+        if value < params[names[i]].min or value > params[names[i]].max:
+            return None
+
+    residual = design @ solution - target
+    chisqr = float(np.sum(residual**2))
+    redchi = chisqr / n_free
+    covar = np.linalg.inv(design.T @ design) * redchi
+
+    params = deepcopy(params)
+    var_names = [names[i] for i in free]
+    for i, name in enumerate(var_names):
+        params[name].value = solution[i]
+    _set_errors(params, var_names, covar)
+    return MinimizerResult(
+        params=params,
+        var_names=var_names,
+        covar=covar,
+        residual=residual,
+        chisqr=chisqr,
+        redchi=redchi,
+        ndata=len(ydata),
+        nvarys=len(free),
+        nfree=n_free,
+        nfev=1,
+        success=True,
+        errorbars=True,
+        method="linear",
+        message="Solved by linear least squares.",
+    )
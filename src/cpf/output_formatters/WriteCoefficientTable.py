@@ -1,7 +1,6 @@
 __all__ = ["Requirements", "WriteOutput"]
 
 
-import json
 import os
 from itertools import product
 
@@ -13,6 +12,7 @@ import cpf.peak_functions as pf
 
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
+from cpf.results_store import load_fits
 
 
 def Requirements():
@@ -152,20 +152,7 @@ def WriteOutput(setting_class=None, setting_file=None, debug=False, **kwargs):
     text_file.write("\n")
 
     # read all the data.
-    fits = []
-    for z in range(setting_class.image_number):
-        setting_class.set_subpattern(z, 0)
-
-        filename = IO.make_outfile_name(
-            setting_class.subfit_filename,  # diff_files[z],
-            directory=setting_class.output_directory,  # directory=FitSettings.Output_directory,
-            extension=".json",
-            overwrite=True,
-        )  # overwrite =false to get the file name without incrlemeting it.
-
-        # Read JSON data from file
-        with open(filename) as json_data:
-            fits.append(json.load(json_data))
+    fits = load_fits(setting_class)
 
     # make lists of the parameters to iterate over
     images = list(range(setting_class.image_number))
@@ -14,6 +14,7 @@ import cpf.output_formatters.convert_fit_to_crystallographic as cfc
 
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
+from cpf.results_store import load_fits
 
 
 def Requirements():
@@ -157,22 +158,12 @@ def WriteOutput(setting_class=None, setting_file=None, debug=True, **kwargs):
     text_file.write("\n")
 
     all_fits = []
+    fits = load_fits(setting_class)
     for z in range(setting_class.image_number):
         setting_class.set_subpattern(z, 0)
 
-        filename = IO.make_outfile_name(
-            setting_class.subfit_filename,
-            directory=setting_class.output_directory,
-            extension=".json",
-            overwrite=True,
-        )
-
-        if os.path.isfile(filename):
-            # Read JSON data from file
-            with open(filename) as json_data:
-                fit = json.load(json_data)
-
-            fit = IO.replace_null_terms(fit)
+        if fits[z] is not None:
+            fit = IO.replace_null_terms(fits[z])
 
             all_fits.append(fit)
 
@@ -1,7 +1,6 @@
 __all__ = ["Requirements", "WriteOutput"]
 
 
-import json
 import os
 
 import matplotlib.pyplot as plt
@@ -14,6 +13,7 @@ from cpf.data_preprocess import remove_cosmics as cosmicsimage_preprocess
 
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
+from cpf.results_store import load_fits
 from cpf.XRD_FitSubpattern import plot_FitAndModel
 
 
@@ -100,10 +100,15 @@ def WriteOutput(setting_class=None, setting_file=None, debug=False, **kwargs):
     duration = (setting_class.image_number) / fps
     num_subpatterns = len(setting_class.fit_orders)
 
+    fits = load_fits(setting_class)
     for z in range(num_subpatterns):
         y = list(range(setting_class.image_number))
 
         setting_class.set_subpattern(0, z)
+        # the data in the subpattern are the same for every frame.
+        index = data_class.limits_index(
+            range_bounds=setting_class.subfit_orders["range"]
+        )
 
         addd = IO.peak_string(setting_class.subfit_orders, fname=True)
         if setting_class.file_label != None:
@@ -141,9 +146,8 @@ def WriteOutput(setting_class=None, setting_file=None, debug=False, **kwargs):
                 pass
 
             # restrict data to the right part.
-            sub_data = data_class.duplicate()
             setting_class.set_subpattern(y[int(t * fps)], z)
-            sub_data.set_limits(range_bounds=setting_class.subfit_orders["range"])
+            sub_data = data_class.subpattern(index)
 
             # Mask the subpattern by intensity if called for
             if (
@@ -152,15 +156,8 @@ def WriteOutput(setting_class=None, setting_file=None, debug=False, **kwargs):
             ):
                 sub_data = SpotProcess(sub_data, setting_class)
 
-            # read fit file
-            json_file = IO.make_outfile_name(
-                setting_class.subfit_filename,  # diff_files[z],
-                directory=setting_class.output_directory,
-                extension=".json",
-                overwrite=True,
-            )
-            with open(json_file) as json_data:
-                data_fit = json.load(json_data)[z]
+            # get the fit to the image
+            data_fit = fits[y[int(t * fps)]][z]
 
             # make the plot of the fits.
             fig = plt.figure(1)
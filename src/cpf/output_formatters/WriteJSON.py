@@ -0,0 +1,46 @@
+__all__ = ["Requirements", "WriteOutput"]
+
+
+from cpf.logger_functions import logger
+from cpf.results_store import export_json
+
+
+def Requirements():
+    # List non-universally required parameters for writing this output type.
+
+    RequiredParams = [
+        #'apparently none!
+    ]
+    OptionalParams = []
+
+    return RequiredParams, OptionalParams
+
+
+def WriteOutput(setting_class=None, setting_file=None, debug=False, **kwargs):
+    # writes the fits in the results store as a JSON file for each diffraction
+    # pattern, as they are written without the store.
+
+    if setting_class is None and setting_file is None:
+        raise ValueError(
+            "Either the settings file or the setting class need to be specified."
+        )
+    elif setting_class is None:
+        from cpf.XRD_FitPattern import initiate
+
+        setting_class = initiate(setting_file)
+
+    if setting_class.output_store != "hdf5":
+        # the fits are already written as JSON files.
+        logger.info(
+            " ".join(
+                map(
+                    str,
+                    [("The fits are stored as JSON files; there is nothing to write.")],
+                )
+            )
+        )
+        return
+
+    written = export_json(setting_class)
+    for filename in written:
+        logger.moreinfo(" ".join(map(str, [("Writing %s" % filename)])))
@@ -11,6 +11,7 @@ import cpf.series_functions as sf
 
 # from cpf.XRD_FitPattern import logger
 from cpf.logger_functions import logger
+from cpf.results_store import load_fits
 
 
 def Requirements():
@@ -71,27 +72,11 @@ def WriteOutput(
     # wavelength = setting_class.data_class.calibration["conversion_constant"]
     wavelength = setting_class.data_class.conversion_constant
 
+    fits = load_fits(setting_class)
     for z in range(setting_class.image_number):
         # read file to write output for
-        # filename = os.path.splitext(os.path.basename(diff_files[z]))[0]
-        # filename = filename+'.json'
         setting_class.set_subpattern(z, 0)
-
-        filename = IO.make_outfile_name(
-            # diff_files[z],
-            # directory=FitSettings.Output_directory,
-            setting_class.subfit_filename,  # diff_files[z],
-            directory=setting_class.output_directory,  # directory=FitSettings.Output_directory,
-            extension=".json",
-            overwrite=True,
-        )  # overwrite =false to get the file name without incrlemeting it.
-
-        # Read JSON data from file
-        with open(filename) as json_data:
-            data_to_write = json.load(json_data)
-            data_to_write = IO.replace_null_terms(
-                data_to_write, val_to_find=None, replace_with=0
-            )
+        data_to_write = IO.replace_null_terms(fits[z], val_to_find=None, replace_with=0)
 
         # create output file name from passed name
         base = setting_class.subfit_filename
@@ -1,7 +1,6 @@
 __all__ = ["Requirements", "WriteOutput"]
 
 # import datetime
-import json
 import os
 from pathlib import Path
 
@@ -13,6 +12,7 @@ import cpf.output_formatters.WriteMultiFit as WriteMultiFit
 
 # import cpf.PeakFunctions as ff
 from cpf.logger_functions import logger
+from cpf.results_store import load_fits
 
 # from cpf.XRD_FitPattern import logger
 
@@ -250,6 +250,8 @@ def WriteOutput(
         text_file.write("# Number of peaks\n")
         text_file.write("     %i\n" % numpeaks)
         text_file.write("# Peaks info (use, h, k, l)\n")
+        # the fits, to check if the d-spacing fits are NaN or not.
+        fit = load_fits(setting_class, [i])[0]
         for x in range(len(setting_class.fit_orders)):
             for y in range(len(setting_class.fit_orders[x]["peak"])):
                 # FIXME: use this line below as a shortening for all the x and y pointers
@@ -261,23 +263,6 @@ def WriteOutput(
                     if hkl == "0" or hkl == 0:
                         hkl = "000"
 
-                    # check if the d-spacing fits are NaN or not. if NaN switch off (0) otherwise use (1).
-                    # Got first file name
-                    # filename = os.path.splitext(os.path.basename(diff_files[0]))[0]
-                    # filename = filename+'.json'
-
-                    filename = IO.make_outfile_name(
-                        setting_class.subfit_filename,  # diff_files[z],
-                        directory=setting_class.output_directory,  # directory=FitSettings.Output_directory,
-                        # diff_files[0],
-                        # directory=FitSettings.Output_directory,
-                        extension=".json",
-                        overwrite=True,
-                    )  # overwrite =false to get the file name without incrlemeting it.
-
-                    # Read JSON data from file
-                    with open(filename) as json_data:
-                        fit = json.load(json_data)
                     # check if the d-spacing fits are NaN or not. if NaN switch off.
                     if type(fit[x]["peak"][y]["d-space"][0]) == type(None) or np.isnan(
                         fit[x]["peak"][y]["d-space"][0]
@@ -14,6 +14,9 @@ __all__ = [
     "gaussian_peak",
     "lorentzian_peak",
     "pseudo_voigt_peak",
+    "pseudo_voigt_derivatives",
+    "peak_window",
+    "pseudo_voigt_truncation",
 ]
 
 import numpy as np
@@ -105,7 +108,9 @@ def lorentzian_peak(two_theta, two_theta_0, w_all, h_all):
     return l_peak
 
 
-def pseudo_voigt_peak(two_theta, two_theta_0, w_all, h_all, l_g_ratio):
+def pseudo_voigt_peak(
+    two_theta, two_theta_0, w_all, h_all, l_g_ratio, window=None, sort_index=None
+):
     """
     Pseudo-Voigt
     :param two_theta:
@@ -113,9 +118,181 @@ def pseudo_voigt_peak(two_theta, two_theta_0, w_all, h_all, l_g_ratio):
     :param w_all:
     :param h_all:
     :param l_g_ratio:
+    :param window: if not None, the peak is only evaluated within this many widths of
+        its centre and is zero elsewhere (see peak_window).
+    :param sort_index: argsort of the flattened two_theta, used to find the window.
     :return:
     """
+    if window is not None:
+        return _windowed(
+            pseudo_voigt_peak,
+            two_theta,
+            two_theta_0,
+            w_all,
+            h_all,
+            l_g_ratio,
+            window,
+            sort_index,
+        )
     p_v_peak = l_g_ratio * gaussian_peak(two_theta, two_theta_0, w_all, h_all) + (
         1 - l_g_ratio
     ) * lorentzian_peak(two_theta, two_theta_0, w_all, h_all)
     return p_v_peak
+
+
+def pseudo_voigt_derivatives(
+    two_theta, two_theta_0, w_all, h_all, l_g_ratio, window=None, sort_index=None
+):
+    """
+    Partial derivatives of the Pseudo-Voigt with respect to its properties.
+    :param two_theta:
+    :param two_theta_0:
+    :param w_all:
+    :param h_all:
+    :param l_g_ratio:
+    :param window: if not None, the derivatives are only evaluated within this many
+        widths of the peak centre and are zero elsewhere (see peak_window).
+    :param sort_index: argsort of the flattened two_theta, used to find the window.
+    :return: derivatives with respect to two_theta_0, w_all, h_all and l_g_ratio
+    """
+    if window is not None:
+        return _windowed(
+            pseudo_voigt_derivatives,
+            two_theta,
+            two_theta_0,
+            w_all,
+            h_all,
+            l_g_ratio,
+            window,
+            sort_index,
+        )
+    diff = two_theta - two_theta_0
+    diff_sq = diff**2
+    # unit height Gaussian and Lorentzian
+    gauss = np.exp(-diff_sq * np.log(4) / (2 * w_all**2))
+    lorentz = w_all**2 / (diff_sq + w_all**2)
+
+    d_two_theta_0 = h_all * (
+        l_g_ratio * gauss * diff * np.log(4) / w_all**2
+        + (1 - l_g_ratio) * 2 * diff * w_all**2 / (diff_sq + w_all**2) ** 2
+    )
+    d_w = h_all * (
+        l_g_ratio * gauss * diff_sq * np.log(4) / w_all**3
+        + (1 - l_g_ratio) * 2 * w_all * diff_sq / (diff_sq + w_all**2) ** 2
+    )
+    d_h = l_g_ratio * gauss + (1 - l_g_ratio) * lorentz
+    d_p = h_all * (gauss - lorentz)
+    return d_two_theta_0, d_w, d_h, d_p
+
+
+def peak_window(two_theta, two_theta_0, w_all, window, sort_index=None):
+    """
+    Positions within a number of widths of the peak centre.
+    The centre and width can be different at every position (they depend on azimuth),
+    so the candidate positions are those between the smallest and largest window
+    edges, found from the sorted two theta values, which are then selected by the
+    window at each position.
+    :param two_theta: two theta of the positions
+    :param two_theta_0: peak centre at each position
+    :param w_all: peak width at each position
+    :param window: half width of the window, as a number of peak widths
+    :param sort_index: argsort of the flattened two_theta, or None to test every
+        position
+    :return: flat indices of the positions inside the window
+    """
+    two_theta, two_theta_0, w_all = np.broadcast_arrays(two_theta, two_theta_0, w_all)
+    two_theta = np.ravel(two_theta)
+    two_theta_0 = np.ravel(two_theta_0)
+    half_width = np.abs(np.ravel(w_all)) * window
+    candidates = _window_candidates(two_theta, two_theta_0, half_width, sort_index)
+    if candidates is None:
+        return np.flatnonzero(np.abs(two_theta - two_theta_0) <= half_width)
+    inside = (
+        np.abs(two_theta[candidates] - two_theta_0[candidates])
+        <= (half_width[candidates])
+    )
+    return candidates[inside]
+
+
+def _window_candidates(two_theta, two_theta_0, half_width, sort_index):
+    """
+    Positions between the smallest and largest edges of the window.
+    :param two_theta: flat array of two theta
+    :param two_theta_0: flat array of the peak centre
+    :param half_width: flat array of the half width of the window
+    :param sort_index: argsort of two_theta, or None
+    :return: array of the candidate positions, or None if they are more than half of
+        the positions (when it is quicker to test all the positions in order).
+    """
+    if sort_index is None:
+        return None
+    first, last = np.searchsorted(
+        two_theta,
+        [np.min(two_theta_0 - half_width), np.max(two_theta_0 + half_width)],
+        side="left",
+        sorter=sort_index,
+    )
+    if 2 * (last - first) > two_theta.size:
+        return None
+    return sort_index[first:last]
+
+
+def pseudo_voigt_truncation(h_all, l_g_ratio, window):
+    """
+    Largest intensity of the Pseudo-Voigt that is left out by evaluating it only
+    within a window around the peak centre.
+    Both the Gaussian and Lorentzian fall monotonically away from the centre, so the
+    omitted intensity is largest at the edge of the window: 2^-(window^2) of the
+    height for the Gaussian and 1/(1+window^2) of the height for the Lorentzian.
+    :param h_all: peak height at each position
+    :param l_g_ratio: Gaussian fraction at each position
+    :param window: half width of the window, as a number of peak widths
+    :return: bound of the truncation error at each position
+    """
+    return np.abs(h_all) * (
+        np.abs(l_g_ratio) * 2.0 ** (-(window**2))
+        + np.abs(1 - l_g_ratio) / (1 + window**2)
+    )
+
+
+def _windowed(
+    function, two_theta, two_theta_0, w_all, h_all, l_g_ratio, window, sort_index
+):
+    """
+    Evaluate a peak function only at the positions within the window of the peak.
+    If the window covers most of the positions, it is quicker to evaluate the
+    function everywhere and then remove the values outside the window.
+    :param function: pseudo_voigt_peak or pseudo_voigt_derivatives
+    :param window: half width of the window, as a number of peak widths
+    :param sort_index: argsort of the flattened two_theta, or None
+    :return: output of function, zero outside the window
+    """
+    arrays = np.broadcast_arrays(
+        np.ma.getdata(two_theta), two_theta_0, w_all, h_all, l_g_ratio
+    )
+    shape = arrays[0].shape
+    flat = [np.ravel(a) for a in arrays]
+    half_width = np.abs(flat[2]) * window
+    candidates = _window_candidates(flat[0], flat[1], half_width, sort_index)
+
+    if candidates is None:
+        outside = np.abs(arrays[0] - arrays[1]) > half_width.reshape(shape)
+        out = function(*arrays)
+        if not np.any(outside):
+            return out
+        if isinstance(out, tuple):
+            return tuple(np.where(outside, 0.0, o) for o in out)
+        return np.where(outside, 0.0, out)
+
+    inside = candidates[
+        np.abs(flat[0][candidates] - flat[1][candidates]) <= half_width[candidates]
+    ]
+    out = function(*[a[inside] for a in flat])
+    if isinstance(out, tuple):
+        full = tuple(np.zeros(shape) for _ in out)
+        for f, o in zip(full, out):
+            f.flat[inside] = o
+        return full
+    full = np.zeros(shape)
+    full.flat[inside] = out
+    return full
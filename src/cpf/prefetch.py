@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Reading of the images in the background, while the previous images are fitted.
+
+execute reads each image (decoding the file, converting it to floats and flipping it)
+and then fits it. The fits wait for the disk and the disk waits for the fits. The
+ImagePrefetcher reads the next images of the image list on background threads, so
+that they are ready by the time they are fitted. The number of images read ahead is
+limited, as is the memory they take up.
+
+Only the reading of the image is done in the background, by the data class's
+read_image (for data classes that have one). The image is added to the data class,
+and the data class changed, by import_image in the main thread.
+"""
+
+__all__ = ["ImagePrefetcher"]
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cpf.logger_functions import logger
+
+
+class ImagePrefetcher:
+    """
+    Reads the images of a list in the background, a few images ahead of the image that
+    was asked for.
+    """
+
+    def __init__(self, read, images, depth=2, max_memory=None):
+        """
+        :param read: function that reads an image, given its entry in images
+        :param images: list of the images (file names, or [file, key] h5 entries)
+        :param depth: number of images to read ahead of the current image
+        :param max_memory: largest memory (in bytes) to use for the images read ahead,
+            or None for no limit. The size of each image is taken to be that of the
+            latest image read; until one is read only one image is read ahead.
+        """
+        self.read = read
+        self.images = images
+        self.depth = depth
+        self.max_memory = max_memory
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(depth, 1), thread_name_prefix="cpf-prefetch"
+        )
+        # the reads that have been started, as {image number: future}.
+        self._futures = {}
+        # the next image to start reading.
+        self._next = 0
+        self._image_size = None
+        self._fill(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop reading. Reads that have not started are cancelled.
+        """
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._executor.shutdown(wait=True)
+
+    def get(self, number):
+        """
+        Get an image, waiting for it to be read if it has not been read already, and
+        start reading the images after it.
+        :param number: number of the image in images
+        :return: the image, as returned by read
+        """
+        # images before this one will not be asked for.
+        for skipped in [n for n in self._futures if n < number]:
+            self._futures.pop(skipped).cancel()
+        future = self._futures.pop(number, None)
+        if future is None:
+            image = self.read(self.images[number])
+        else:
+            # any error reading the image is raised here.
+            image = future.result()
+        self._image_size = getattr(image, "nbytes", None)
+        self._fill(number + 1)
+        return image
+
+    def _fill(self, start):
+        """
+        Start reading the images from start, up to the depth and memory limits.
+        """
+        self._next = max(self._next, start)
+        while self._next < len(self.images) and len(self._futures) < self.depth:
+            if self.max_memory is not None:
+                if self._image_size is None and len(self._futures) > 0:
+                    # the size of the images is not known until one is read.
+                    break
+                # the image being fitted is held as well.
+                size = (len(self._futures) + 2) * (self._image_size or 0)
+                if size > self.max_memory:
+                    break
+            self._futures[self._next] = self._executor.submit(
+                self.read, self.images[self._next]
+            )
+            logger.effusive(
+                " ".join(map(str, [("Reading image %i ahead" % self._next)]))
+            )
+            self._next += 1
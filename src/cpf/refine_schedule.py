@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+"""
+Adaptive scheduling of the refinement stages of fit_sub_pattern.
+
+The refinement fits the background and then each component (h, d, w, p) of each peak
+in turn, with the other parameters fixed. When the fits are propagated from the
+previous image most of these stages barely change the fit. Before each stage the
+reduction in chi-squared that a (Gauss-Newton) step of its parameters would make is
+predicted from the derivatives of the model. The stage is skipped if this is less than
+a tolerance and the step changes none of the parameters by more than a fraction of
+their error (or of their value, if they have no error). A stage that is run but makes
+no more change than this is converged, and is skipped until another stage changes the
+fit. A stage that runs out of function evaluations is given more in the next
+iteration, and the iterations stop once no stage of an iteration changes the fit. Only
+stages that have been fitted are skipped: those already run in this refinement, or all
+of them if the parameters were propagated from a previous fit.
+
+A skipped stage is left to the final fit of all the parameters, which can stop without
+changing them (e.g. when a parameter is on its bound). After the final fit the stages
+that were skipped without ever being run are checked against it: those whose
+parameters it did not change are run when the refinement is repeated, so that no
+parameters are kept as they were propagated.
+"""
+
+__all__ = ["RefineSchedule"]
+
+import numpy as np
+
+from cpf.logger_functions import logger
+
+
+class RefineSchedule:
+    """
+    Decides which refinement stages to run and records what was done.
+
+    Each stage is named by the start of its parameter names, e.g. "bg_c0_f" or
+    "peak_1_d". The record of the stages (see stages) is saved in the FitProperties.
+    """
+
+    def __init__(
+        self,
+        compiled_model,
+        intensity,
+        propagated=False,
+        tolerance=1e-4,
+        step_tolerance=0.1,
+        escalate=2,
+    ):
+        """
+        :param compiled_model: CompiledModel made for the data
+        :param intensity: intensity of the data
+        :param propagated: True if the parameters are propagated from a previous fit,
+            so that any stage can be skipped from the first iteration
+        :param tolerance: smallest fractional reduction in chi-squared, predicted for
+            a stage, for the stage to be run
+        :param step_tolerance: largest change in the parameters of a skipped stage, as
+            a fraction of their errors (or values)
+        :param escalate: factor to increase the function evaluations of a stage by if
+            it does not converge
+        """
+        self.compiled_model = compiled_model
+        # the data are fitted without their mask, as by lmfit_model.fit_model.
+        self.intensity = np.ma.getdata(intensity).flatten()
+        self.tolerance = tolerance
+        self.step_tolerance = step_tolerance
+        self.escalate = escalate
+        self.propagated = propagated
+        # record of each stage: name, iteration, if it was run, the predicted
+        # reduction in chi-squared and largest step and, if run, the reduction and
+        # largest change made and the function evaluations.
+        self.stages = []
+        self._max_f_eval = {}
+        self._converged = set()
+        self._ran = set()
+        # values of the parameters of the skipped stages, and the stages to run in
+        # the next refinement whatever their prediction.
+        self._skipped = {}
+        self._force = set()
+        self._iteration = 0
+        self._run_in_iteration = False
+        self._before = None
+
+    def start_iteration(self, iteration):
+        """
+        Start an iteration over the stages. The first iteration of a refinement starts
+        after a final fit, so no stage is converged.
+        :param iteration: number of the iteration
+        """
+        if iteration == 0:
+            self._converged = set()
+        self._iteration = iteration
+        self._run_in_iteration = False
+
+    def converged(self):
+        """
+        :return: True if no stage of the current iteration changed the fit.
+        """
+        return not self._run_in_iteration
+
+    def chi_squared(self, params):
+        """
+        :param params: lmfit Parameter class
+        :return: chi-squared of the model with params, and its residual and vector
+        """
+        vector = self.compiled_model.vector(params)
+        residual = self.intensity - self.compiled_model.evaluate(vector).flatten()
+        return float(residual @ residual), residual, vector
+
+    def predict(self, params, names):
+        """
+        Reduction in chi-squared and change in the parameters made by a Gauss-Newton
+        step of the parameters in names, from the current values in params. The step
+        is limited by the bounds of the parameters.
+        :param params: lmfit Parameter class
+        :param names: names of the parameters of the step
+        :return: predicted reduction divided by the current chi-squared, and the
+            largest change in a parameter divided by its error (or value)
+        """
+        chisqr, residual, vector = self.chi_squared(params)
+        if chisqr == 0 or len(names) == 0 or not np.isfinite(chisqr):
+            return 0.0, 0.0
+        columns = [self.compiled_model.index[name] for name in names]
+        jac = self.compiled_model.derivatives(vector)[:, columns]
+        step = np.linalg.lstsq(jac, residual, rcond=None)[0]
+        value = np.array([params[name].value for name in names], dtype=float)
+        lower = np.array([params[name].min for name in names], dtype=float)
+        upper = np.array([params[name].max for name in names], dtype=float)
+        step = np.clip(value + step, lower, upper) - value
+        change = jac @ step
+        # the reduction is limited to chi-squared, which it can exceed if the step
+        # is clipped.
+        reduction = min(float(2 * residual @ change - change @ change) / chisqr, 1.0)
+        return max(reduction, 0.0), self._largest_step(params, names, step)
+
+    @staticmethod
+    def _largest_step(params, names, step):
+        """
+        Largest change in the parameters as a fraction of their errors (or values).
+        """
+        scale = np.array(
+            [
+                params[name].stderr if params[name].stderr else abs(params[name].value)
+                for name in names
+            ],
+            dtype=float,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative = np.where(step == 0, 0, np.abs(step) / scale)
+        return float(np.max(relative)) if len(names) > 0 else 0.0
+
+    def run(self, stage, params, also=None):
+        """
+        Decide if a stage is run. The parameters of the stage are those that vary in
+        params.
+        :param stage: name of the stage
+        :param params: lmfit Parameter class, set to vary the parameters of the stage
+        :param also: names of other parameters that are fitted with the stage (e.g.
+            the linear coefficients in variable projection), or None
+        :return: True if the stage should be run
+        """
+        names = [
+            name
+            for name, par in params.items()
+            if par.vary and par.expr is None and name in self.compiled_model.index
+        ]
+        names = names + [name for name in (also or []) if name not in names]
+        if stage in self._force:
+            self._force.discard(stage)
+            predicted, largest_step = np.nan, np.nan
+            run = True
+        elif stage in self._converged:
+            predicted, largest_step = 0.0, 0.0
+            run = False
+        elif not (self.propagated or stage in self._ran):
+            predicted, largest_step = np.nan, np.nan
+            run = True
+        else:
+            predicted, largest_step = self.predict(params, names)
+            run = predicted >= self.tolerance or largest_step > self.step_tolerance
+        self.stages.append(
+            {
+                "stage": stage,
+                "iteration": self._iteration,
+                "run": run,
+                "predicted-reduction": predicted,
+                "predicted-step": largest_step,
+            }
+        )
+        if run:
+            self._ran.add(stage)
+            self._before = (names, params.copy(), self.chi_squared(params)[0])
+        else:
+            self._skipped[stage] = {name: params[name].value for name in names}
+            logger.effusive(
+                " ".join(
+                    map(
+                        str,
+                        [
+                            (
+                                "Skipping %s: predicted reduction in chi-squared %.2g, largest step %.2g"
+                                % (stage, predicted, largest_step)
+                            )
+                        ],
+                    )
+                )
+            )
+        return run
+
+    def max_f_eval(self, stage, default):
+        """
+        :param stage: name of the stage
+        :param default: number of function evaluations normally used for the stage
+        :return: number of function evaluations for the stage
+        """
+        return self._max_f_eval.get(stage, default)
+
+    def record(self, stage, fout, max_f_eval):
+        """
+        Record the fit of a stage. If it did not converge the stage is given more
+        function evaluations next time. If it did not change the fit it is skipped
+        until another stage does.
+        :param stage: name of the stage
+        :param fout: result of the fit
+        :param max_f_eval: number of function evaluations the fit was given
+        """
+        names, before, chisqr = self._before
+        step = np.array(
+            [fout.params[name].value - before[name].value for name in names],
+            dtype=float,
+        )
+        reduction = 0.0
+        if chisqr > 0:
+            reduction = (chisqr - self.chi_squared(fout.params)[0]) / chisqr
+        largest_step = self._largest_step(before, names, step)
+        self.stages[-1].update(
+            {
+                "reduction": reduction,
+                "step": largest_step,
+                "function-evaluations": fout.nfev,
+            }
+        )
+        if not fout.success:
+            self._max_f_eval[stage] = self.escalate * max_f_eval
+        elif reduction < self.tolerance and largest_step <= self.step_tolerance:
+            self._converged.add(stage)
+            return
+        # the fit has changed, so the other stages may no longer be converged.
+        self._converged = set()
+        self._run_in_iteration = True
+
+    def recheck(self, params):
+        """
+        Check the skipped stages against the final fit. The stages that were skipped
+        without ever being run, and whose parameters the final fit did not change, are
+        run in the next refinement.
+        :param params: lmfit Parameter class of the final fit
+        :return: True if there are stages to run, so the refinement should be repeated
+        """
+        for stage, values in self._skipped.items():
+            if stage in self._ran:
+                continue
+            before = np.array(list(values.values()), dtype=float)
+            after = np.array([params[name].value for name in values], dtype=float)
+            if np.allclose(after, before, rtol=1e-8, atol=0):
+                self._force.add(stage)
+        if len(self._force) > 0:
+            logger.moreinfo(
+                " ".join(
+                    map(
+                        str,
+                        [
+                            (
+                                "The final fit did not change the skipped stages %s; refining them again."
+                                % ", ".join(sorted(self._force))
+                            )
+                        ],
+                    )
+                )
+            )
+        return len(self._force) > 0
+
+    def summary(self):
+        """
+        :return: dict of the number of stages run and skipped and the record of each.
+        """
+        return {
+            "run": sum(stage["run"] for stage in self.stages),
+            "skipped": sum(not stage["run"] for stage in self.stages),
+            "stages": self.stages,
+        }
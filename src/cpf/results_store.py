@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+"""
+Columnar store of the fits, as a single HDF5 file.
+
+By default the fits to each image are written as a JSON file for the image, which every
+output formatter then finds and reads again. For long series of images this is slow
+and makes many files. The results store instead keeps the fits to all the images in
+one HDF5 file, with a row for each image. The fits (the list of dicts made by
+fit_sub_pattern for each subpattern) are stored as a tree of groups that follows the
+dicts: each series of coefficients (and its errors), e.g.
+fits/0/peak/1/d-space, is a dataset of floats with a row for each image and a column
+for each coefficient, and each of the fit statistics in FitProperties is a column of
+its own. Text and values that do not fit in a column of numbers (e.g. the series
+types, the correlation coefficients or the profile of the fit) are stored as JSON
+strings. A value that does not fit what was stored before under its name (e.g. a
+number where there was a group) is stored as a JSON string alongside it (name@json),
+which is read in its place.
+
+The store is append-only: the fits to each image are added as a new row once the
+image is fitted, and an image that is fitted again is added again; the latest row for
+an image is the one that is read. The rows are found by the name of the image's JSON
+file, so the fits can be read, all at once, for any of the images, and written out as
+the JSON files (see export_json).
+"""
+
+__all__ = [
+    "ResultsStore",
+    "store_filename",
+    "fit_filename",
+    "load_fits",
+    "export_json",
+]
+
+import json
+import numbers
+import os
+
+import h5py
+import numpy as np
+
+from cpf.IO_functions import json_numpy_serializer, make_outfile_name
+
+# kinds of the groups and datasets in the tree.
+_DICT = "dict"
+_LIST = "list"
+_NUMBER = "number"
+_NUMBERS = "numbers"
+_JSON = "json"
+_NULL = "null"
+
+# number of rows added to a dataset at a time.
+_chunk_rows = 64
+
+
+def store_filename(setting_class):
+    """
+    Name of the results store of a settings class.
+    :param setting_class: settings class
+    :return: name of the file
+    """
+    base = setting_class.settings_file or "cpf"
+    return make_outfile_name(
+        str(base),
+        directory=setting_class.output_directory,
+        additional_text="results",
+        extension=".h5",
+        overwrite=True,
+    )
+
+
+def fit_filename(setting_class, image, additional_text=None, directory=None):
+    """
+    Name of the JSON file of the fits to an image.
+    :param setting_class: settings class
+    :param image: number of the image in the settings' image list
+    :param additional_text: additional text for the file name, or None
+    :param directory: directory of the file; the output directory if None
+    :return: name of the file
+    """
+    if directory is None:
+        directory = setting_class.output_directory
+    return make_outfile_name(
+        setting_class.image_list[image],
+        directory=directory,
+        additional_text=additional_text,
+        extension=".json",
+        overwrite=True,
+    )
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, bool)
+
+
+def _is_numbers(value):
+    return isinstance(value, list) and all(
+        value_ is None or _is_number(value_) for value_ in value
+    )
+
+
+def _kind(value, path):
+    """
+    How a value is stored.
+    """
+    if "FitProperties" in path[:-1]:
+        # the fit statistics are columns; anything else about the fit is text.
+        return _NUMBER if _is_number(value) else _JSON
+    if isinstance(value, dict):
+        return _DICT
+    if _is_number(value):
+        return _NUMBER
+    if _is_numbers(value):
+        return _NUMBERS
+    if (
+        isinstance(value, list)
+        and len(value) > 0
+        and all(isinstance(value_, (list, dict)) for value_ in value)
+    ):
+        return _LIST
+    return _JSON
+
+
+def _stores(kind, value):
+    """
+    True if a value can be stored in a group or dataset of kind.
+    """
+    if kind == _DICT:
+        return isinstance(value, dict)
+    if kind == _LIST:
+        return isinstance(value, list)
+    if kind == _NUMBER:
+        return value is None or _is_number(value)
+    if kind == _NUMBERS:
+        return _is_number(value) or _is_numbers(value)
+    return True
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ResultsStore:
+    """
+    HDF5 file of the fits to a series of images.
+    """
+
+    def __init__(self, filename, mode="r"):
+        """
+        :param filename: name of the file
+        :param mode: "r" to read, "a" to add to the file (or make it) or "w" to make a
+            new file
+        """
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+        if mode != "r" and "image" not in self.file:
+            self.file.create_dataset(
+                "image",
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(_chunk_rows,),
+                dtype=h5py.string_dtype(),
+            )
+            self.file.create_group("fits").attrs["kind"] = _LIST
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return self.file["image"].shape[0]
+
+    def images(self):
+        """
+        :return: list of the image (JSON file) names of the rows
+        """
+        return list(self.file["image"].asstr()[:])
+
+    def rows(self):
+        """
+        :return: dict of {image name: latest row of the image}
+        """
+        return {name: row for row, name in enumerate(self.images())}
+
+    def append(self, image, fits):
+        """
+        Add the fits to an image as a new row and write them to the file.
+        :param image: name of the image's JSON file
+        :param fits: list of the fits (new_params dicts) to each subpattern
+        :return: number of the row
+        """
+        row = len(self)
+        self.file["image"].resize((row + 1,))
+        self.file["image"][row] = os.path.basename(str(image))
+        self._write(self.file["fits"], fits, row, ("fits",))
+        self.file.flush()
+        return row
+
+    def _write(self, group, value, row, path):
+        """
+        Write the value of a group (a dict or list) into row.
+        """
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        for key, value_ in items:
+            name = str(key)
+            path_ = path + (name,)
+            if name in group:
+                node = group[name]
+                kind = node.attrs["kind"]
+                if not _stores(kind, value_):
+                    # stored as something else before, so kept as JSON alongside.
+                    name_ = name + "@json"
+                    self._write_leaf(group, name_, group.get(name_), _JSON, value_, row)
+                    continue
+            else:
+                kind = _kind(value_, path_)
+                node = None
+            if kind in [_DICT, _LIST]:
+                if node is None:
+                    node = group.create_group(name)
+                    node.attrs["kind"] = kind
+                self._write(node, value_, row, path_)
+            else:
+                self._write_leaf(group, name, node, kind, value_, row)
+
+    @staticmethod
+    def _create(group, name, kind, row, width=None, dtype=float):
+        """
+        Make a dataset with rows up to row, and width columns if width is not None.
+        """
+        if dtype is float:
+            fill = {"fillvalue": np.nan}
+        elif dtype is bool:
+            fill = {"fillvalue": False}
+        else:
+            fill = {}
+        if width is None:
+            shape, maxshape, chunks = (row + 1,), (None,), (_chunk_rows,)
+        else:
+            shape, maxshape = (row + 1, width), (None, None)
+            chunks = (_chunk_rows, max(width, 1))
+        dataset = group.create_dataset(
+            name, shape=shape, maxshape=maxshape, chunks=chunks, dtype=dtype, **fill
+        )
+        dataset.attrs["kind"] = kind
+        return dataset
+
+    def _write_leaf(self, group, name, dataset, kind, value, row):
+        """
+        Write a value into row of a dataset, making or enlarging the dataset if needed.
+        Numbers that are None are written as NaN and marked in a second dataset
+        (name@null), that is made when the first None is written.
+        """
+        if kind == _JSON:
+            if dataset is None:
+                dataset = self._create(
+                    group, name, kind, row, dtype=h5py.string_dtype()
+                )
+            if dataset.shape[0] <= row:
+                dataset.resize(row + 1, axis=0)
+            dataset[row] = json.dumps(value, default=json_numpy_serializer)
+            return
+
+        if kind == _NUMBER:
+            null = value is None
+            width = None
+        else:
+            if not _is_numbers(value):
+                value = [value] if _is_number(value) else []
+            null = np.array([value_ is None for value_ in value], dtype=bool)
+            width = len(value)
+        if dataset is None:
+            dataset = self._create(group, name, kind, row, width)
+            if kind == _NUMBER:
+                dataset.attrs["integer"] = isinstance(value, numbers.Integral)
+        mask = group.get(name + "@null")
+        if mask is None and np.any(null):
+            mask = self._create(group, name + "@null", _NULL, row, width, dtype=bool)
+
+        for dataset_ in [dataset, mask]:
+            if dataset_ is None:
+                continue
+            if dataset_.shape[0] <= row:
+                dataset_.resize(row + 1, axis=0)
+            if width is not None and dataset_.shape[1] < width:
+                dataset_.resize(width, axis=1)
+        if kind == _NUMBER:
+            if dataset.attrs["integer"] and not isinstance(value, numbers.Integral):
+                dataset.attrs["integer"] = False
+            dataset[row] = _as_float(value)
+            if mask is not None:
+                mask[row] = null
+        else:
+            dataset[row, :width] = [_as_float(value_) for value_ in value]
+            if mask is not None:
+                mask[row, :width] = null
+
+    def read(self, images=None):
+        """
+        Read the fits to images. Each dataset is read once, for all the images.
+        :param images: list of the image (JSON file) names, or None for every image
+        :return: list of the fits to each image, as they were written, or None for
+            images that are not in the store
+        """
+        if images is None:
+            images = self.images()
+        images = [os.path.basename(str(image)) for image in images]
+        latest = self.rows()
+        rows = np.array([latest[image] for image in images if image in latest])
+        if len(rows) == 0:
+            return [None for _ in images]
+        # read the slice of the rows from each dataset, then select the rows.
+        start, stop = rows.min(), rows.max() + 1
+        columns = self._read(self.file["fits"], start, stop)
+        fits = [self._select(columns, row - start) for row in rows]
+        fits = iter(fits)
+        return [next(fits) if image in latest else None for image in images]
+
+    def _read(self, group, start, stop):
+        """
+        Read rows start to stop of every dataset in a group.
+        :return: tree of (kind, dict of children) of the groups, with (kind, values,
+            number of rows written, if the values are integers, where they are None)
+            of the datasets
+        """
+        children = {}
+        for name, node in group.items():
+            kind = node.attrs["kind"]
+            if kind == _NULL:
+                continue
+            if kind in [_DICT, _LIST]:
+                children[name] = self._read(node, start, stop)
+                continue
+            if kind == _JSON:
+                values = node.asstr()[start:stop]
+            else:
+                values = node[start:stop]
+            integer = kind == _NUMBER and bool(node.attrs["integer"])
+            null = None
+            if name + "@null" in group:
+                mask = group[name + "@null"]
+                null = np.zeros(values.shape, dtype=bool)
+                null_ = mask[start : min(stop, mask.shape[0])]
+                null[: null_.shape[0], ...] = null_
+            # rows after the end of the dataset were not written.
+            children[name] = (kind, values, node.shape[0] - start, integer, null)
+        return (group.attrs["kind"], children)
+
+    def _select(self, node, row):
+        """
+        Value of a row from the tree made by _read. Datasets that do not reach the
+        row, and groups with none that do, were not written for the row and are left
+        out.
+        """
+        kind, children = node
+        value = {}
+        for name, child in children.items():
+            if child[0] in [_DICT, _LIST]:
+                value_ = self._select(child, row)
+                if len(value_) > 0:
+                    value[name] = value_
+                continue
+            kind_, values, written, integer, null = child
+            if row >= written:
+                continue
+            if kind_ == _JSON:
+                if values[row] != "":
+                    value[name] = json.loads(values[row])
+            elif kind_ == _NUMBER:
+                value_ = float(values[row])
+                if null is not None and null[row]:
+                    value_ = None
+                elif integer and np.isfinite(value_):
+                    value_ = int(value_)
+                value[name] = value_
+            else:
+                value_ = values[row].tolist()
+                if null is not None:
+                    value_ = [
+                        None if null_ else v for v, null_ in zip(value_, null[row])
+                    ]
+                value[name] = value_
+        # values stored as JSON, as they did not fit, replace those in the tree.
+        for name in [name for name in value if name.endswith("@json")]:
+            value[name[: -len("@json")]] = value.pop(name)
+        if kind == _LIST:
+            return [value[name] for name in sorted(value, key=int)]
+        return value
+
+
+def load_fits(setting_class, images=None):
+    """
+    Read the fits to the images of a settings class, from the results store if the
+    fits are stored in it and otherwise from the JSON file of each image.
+    :param setting_class: settings class
+    :param images: list of the numbers of the images, or None for every image
+    :return: list of the fits to each image, or None for images without fits
+    """
+    if images is None:
+        images = range(setting_class.image_number)
+    names = [fit_filename(setting_class, image) for image in images]
+    filename = store_filename(setting_class)
+    if setting_class.output_store == "hdf5" and os.path.isfile(filename):
+        with ResultsStore(filename) as store:
+            return store.read(names)
+    fits = []
+    for name in names:
+        if os.path.isfile(name):
+            with open(name) as json_data:
+                fits.append(json.load(json_data))
+        else:
+            fits.append(None)
+    return fits
+
+
+def export_json(setting_class, images=None, directory=None):
+    """
+    Write the fits in the results store as a JSON file for each image, as made by
+    execute without the store.
+    :param setting_class: settings class
+    :param images: list of the numbers of the images, or None for every image
+    :param directory: directory of the files; the output directory if None
+    :return: list of the names of the files written
+    """
+    if images is None:
+        images = range(setting_class.image_number)
+    images = list(images)
+    written = []
+    for image, fits in zip(images, load_fits(setting_class, images)):
+        if fits is None:
+            continue
+        filename = fit_filename(setting_class, image, directory=directory)
+        with open(filename, "w") as TempFile:
+            json.dump(
+                fits,
+                TempFile,
+                sort_keys=True,
+                indent=2,
+                default=json_numpy_serializer,
+            )
+        written.append(filename)
+    return written
@@ -16,11 +16,16 @@ __all__ = [
     "get_order_from_params",  # not needed?
     "fourier_order",  # same as get order from params?
     "coefficient_expand",
+    "coefficient_basis",
+    "basis_cache_info",
+    "basis_cache_clear",
     "spline_expand",
     "fourier_expand",
     "background_expansion",
 ]
 
+from collections import OrderedDict
+
 import numpy as np
 import numpy.ma as ma
 from scipy.interpolate import CubicSpline, make_interp_spline
@@ -393,6 +398,220 @@ def coefficient_expand(
     return out
 
 
+def coefficient_basis(
+    azimuth,
+    n_coeff,
+    coeff_type="fourier",
+    start_end=[0, 360],
+):
+    """
+    Make the design matrix of a coefficient series, such that
+    coefficient_expand(azimuth, param, coeff_type) == basis @ param.
+
+    All the series types are linear in their coefficients (the splines have fixed
+    tie points) so the columns of the matrix are also the derivatives of the
+    expanded series with respect to each coefficient.
+    The matrices are cached (see basis_cache_info) and so are read only.
+    :param azimuth: arr data array float
+    :param n_coeff: number of coefficients in the series
+    :param coeff_type: series type, as string or number
+    :param start_end: start and end of azimuths
+    :return: array of size (azimuth.size, n_coeff)
+    """
+    coeff_type = coefficient_type_as_number(coeff_type)
+
+    if coeff_type == 0:
+        # N.B. coefficient_expand does not pass start_end to fourier_expand, so the
+        # default is used here.
+        return _cached_basis(azimuth, n_coeff, ("fourier", (0, 360)), _fourier_basis)
+    elif coeff_type in _spline_series:
+        bc_type, kind = _spline_series[coeff_type]
+        return _cached_basis(
+            azimuth,
+            n_coeff,
+            ("spline", tuple(start_end), bc_type, kind),
+            lambda azm, n: _spline_basis(
+                azm, n, start_end=start_end, bc_type=bc_type, kind=kind
+            ),
+        )
+    else:
+        raise ValueError(
+            "Unrecognised coefficient series type, the valid options are "
+            "fourier"
+            ", etc..."
+        )
+
+
+# boundary conditions and kinds of the spline series types, as used by coefficient_expand.
+_spline_series = {
+    1: ("natural", "linear"),
+    2: ("natural", "quadratic"),
+    3: ("periodic", "cubic"),
+    4: ("natural", "cubic"),
+    5: ("natural", "independent"),
+}
+
+# Cache of the series design matrices, so that the sines, cosines and splines are not
+# remade each time the same azimuths are expanded. The entries are keyed on the memory
+# of the azimuth array and the sum of the azimuths, so that azimuths changed in place
+# are not matched. The arrays are held in the cache so that their memory cannot be
+# reused for other azimuths while the entry exists. The size of the cache is limited
+# by the memory (in bytes) of the matrices and the azimuths they hold.
+_basis_cache = OrderedDict()
+_basis_cache_stats = {"hits": 0, "misses": 0, "bytes": 0, "max_bytes": 256 * 2**20}
+
+
+def basis_cache_info():
+    """
+    Report on the cache of series design matrices.
+    :return: dict of the cache hits, misses, number of matrices, and current and
+        maximum memory (in bytes)
+    """
+    return {
+        "hits": _basis_cache_stats["hits"],
+        "misses": _basis_cache_stats["misses"],
+        "size": len(_basis_cache),
+        "bytes": _basis_cache_stats["bytes"],
+        "max_bytes": _basis_cache_stats["max_bytes"],
+    }
+
+
+def basis_cache_clear(max_bytes=None):
+    """
+    Empty the cache of series design matrices and reset its counters.
+    :param max_bytes: maximum memory (in bytes) of the design matrices and azimuths to
+        hold, 0 turns the cache off
+    :return: None
+    """
+    _basis_cache.clear()
+    _basis_cache_stats["hits"] = 0
+    _basis_cache_stats["misses"] = 0
+    _basis_cache_stats["bytes"] = 0
+    if max_bytes is not None:
+        _basis_cache_stats["max_bytes"] = int(max_bytes)
+
+
+def _cached_basis(azimuth, n_coeff, series, make_basis):
+    """
+    Get a design matrix from the cache, making it if it is not there.
+    The least recently used matrices are removed when the cache is full.
+    :param azimuth: arr data array float
+    :param n_coeff: number of coefficients in the series
+    :param series: hashable description of the series type and start_end
+    :param make_basis: function making the matrix from the flat azimuths and n_coeff
+    :return: array of size (azimuth.size, n_coeff)
+    """
+    azimuth = np.asarray(azimuth, dtype=float)
+    n_coeff = int(n_coeff)
+    key = (
+        azimuth.__array_interface__["data"][0],
+        azimuth.shape,
+        azimuth.strides,
+        # as bytes, so that NaN sums are equal.
+        np.sum(azimuth).tobytes(),
+        n_coeff,
+        series,
+    )
+    if key in _basis_cache:
+        _basis_cache.move_to_end(key)
+        _basis_cache_stats["hits"] += 1
+        return _basis_cache[key][1]
+
+    _basis_cache_stats["misses"] += 1
+    basis = make_basis(azimuth.flatten(), n_coeff)
+    basis.flags.writeable = False
+    nbytes = azimuth.nbytes + basis.nbytes
+    if nbytes <= _basis_cache_stats["max_bytes"]:
+        _basis_cache[key] = (azimuth, basis)
+        _basis_cache_stats["bytes"] += nbytes
+        while _basis_cache_stats["bytes"] > _basis_cache_stats["max_bytes"]:
+            _, (azimuth_, basis_) = _basis_cache.popitem(last=False)
+            _basis_cache_stats["bytes"] -= azimuth_.nbytes + basis_.nbytes
+    return basis
+
+
+def _fourier_basis(azimuth, n_coeff, start_end=[0, 360]):
+    """
+    Design matrix of a Fourier series: [1, sin(a), cos(a), sin(2a), cos(2a), ...]
+    :param azimuth: flat arr data array float
+    :param n_coeff: number of coefficients in the series
+    :param start_end: start and end of azimuths
+    :return: array of size (azimuth.size, n_coeff)
+    """
+    basis = np.zeros((azimuth.size, n_coeff))
+    basis[:, 0] = 1
+    # same arithmetic as fourier_expand so the values are identical.
+    azm_tmp = np.deg2rad(
+        (azimuth - start_end[0]) / (start_end[-1] - start_end[0]) * 360
+    )
+    for i in range(1, int((n_coeff - 1) / 2) + 1):
+        basis[:, 2 * i - 1] = np.sin(azm_tmp * i)
+        basis[:, 2 * i] = np.cos(azm_tmp * i)
+    return basis
+
+
+def _spline_basis(
+    azimuth, n_coeff, start_end=[0, 360], bc_type="periodic", kind="cubic"
+):
+    """
+    Design matrix of a spline series. The splines are linear in the values at the
+    tie points, so each column is the spline through a unit value at one tie point.
+    :param azimuth: flat arr data array float
+    :param n_coeff: number of coefficients in the series
+    :param start_end: start and end of azimuths
+    :param bc_type: spline boundary condition, or the tie points
+    :param kind: spline type
+    :return: array of size (azimuth.size, n_coeff)
+    """
+    basis = np.ones((azimuth.size, n_coeff))
+    if n_coeff > 1:
+        for i in range(n_coeff):
+            unit = np.zeros(n_coeff)
+            unit[i] = 1
+            basis[:, i] = _spline_interpolate(
+                azimuth, unit, start_end=start_end, bc_type=bc_type, kind=kind
+            )
+    return basis
+
+
+def _spline_interpolate(
+    azimuth, inp_param, start_end=[0, 360], bc_type="periodic", kind="cubic"
+):
+    """
+    Evaluate the spline through the values at the tie points.
+    :param azimuth: arr data array float
+    :param inp_param: array of values at spline tie points
+    :param start_end: start and end of azimuths
+    :param bc_type: spline boundary condition, or the tie points
+    :param kind: spline type
+    :return: spline value at each azimuth
+    """
+    if kind == "independent":
+        points = np.unique(azimuth)
+    elif isinstance(bc_type, (list, tuple, np.ndarray)):
+        points = bc_type
+    elif bc_type == "periodic":
+        points = np.linspace(start_end[0], start_end[1], np.size(inp_param) + 1)
+        inp_param = np.append(inp_param, inp_param[0])
+    else:
+        points = np.linspace(start_end[0], start_end[1], np.size(inp_param))
+
+    if kind == "cubic":  # and bc_type=='periodic':
+        k = 3
+    elif kind == "quadratic":
+        k = 2
+    elif kind == "linear" or kind == "independent":
+        k = 1
+    else:
+        raise ValueError("Unknown spline type.")
+
+    if k == 3:
+        spl = CubicSpline(points, inp_param, bc_type=bc_type, extrapolate="periodic")
+    else:
+        spl = make_interp_spline(points, inp_param, k=k)
+    return spl(azimuth)
+
+
 # spline expansion function
 def spline_expand(
     azimuth,
@@ -432,25 +651,6 @@ def spline_expand(
         for j in range(len(str_keys)):
             inp_param.append(params[comp_str + str(j)])
 
-    if kind == "independent":
-        points = np.unique(azimuth)
-    elif bc_type == "periodic":
-        points = np.linspace(start_end[0], start_end[1], np.size(inp_param) + 1)
-        inp_param = np.append(inp_param, inp_param[0])
-    elif isinstance(bc_type, (list, tuple, np.ndarray)):
-        points = bc_type
-    else:
-        points = np.linspace(start_end[0], start_end[1], np.size(inp_param))
-
-    if kind == "cubic":  # and bc_type=='periodic':
-        k = 3
-    elif kind == "quadratic":
-        k = 2
-    elif kind == "linear" or kind == "independent":
-        k = 1
-    else:
-        raise ValueError("Unknown spline type.")
-
     fout = np.ones(azimuth.shape)
 
     if (
@@ -464,14 +664,23 @@ def spline_expand(
         fout[:] = inp_param[0]
     # essentially d_0, h_0 or w_0
     if not isinstance(inp_param, np.float64) and np.size(inp_param) > 1:
-        if k == 3:
-            spl = CubicSpline(
-                points, inp_param, bc_type=bc_type, extrapolate="periodic"
+        if kind == "independent" or isinstance(bc_type, (list, tuple, np.ndarray)):
+            # the tie points depend on the azimuths or are given, so do not cache.
+            fout = _spline_interpolate(
+                azimuth, inp_param, start_end=start_end, bc_type=bc_type, kind=kind
             )
         else:
-            spl = make_interp_spline(points, inp_param, k=k)
-
-        fout = spl(azimuth)
+            basis = _cached_basis(
+                azimuth,
+                np.size(inp_param),
+                ("spline", tuple(start_end), bc_type, kind),
+                lambda azm, n: _spline_basis(
+                    azm, n, start_end=start_end, bc_type=bc_type, kind=kind
+                ),
+            )
+            fout = np.reshape(
+                basis @ np.asarray(inp_param, dtype=float), np.shape(azimuth)
+            )
 
     return np.squeeze(fout)
 
@@ -516,23 +725,31 @@ def fourier_expand(
         fout[:] = inp_param[0]
     # essentially d_0, h_0 or w_0
 
-    azm_tmp = np.deg2rad(
-        (azimuth - start_end[0]) / (start_end[-1] - start_end[0]) * 360
-    )
     if not isinstance(inp_param, np.float64) and np.size(inp_param) > 1:
+        # the sines and cosines are columns of the cached design matrix.
+        start_end = [start_end[0], start_end[-1]]
+        basis = _cached_basis(
+            azimuth,
+            len(inp_param),
+            ("fourier", tuple(start_end)),
+            lambda azm, n: _fourier_basis(azm, n, start_end=start_end),
+        )
+        shape = np.shape(azimuth)
         for i in range(1, int((len(inp_param) - 1) / 2) + 1):
             # len(param)-1 should never be odd because of initial a_0 parameter
             # try:
             # try/except is a ctch for expanding a fourier series that has failed and has nones as coefficient values.
-            # azm_tmp stretches the azimuths between the max and min of start_end. In XRD cases this should have no effect
+            # the basis stretches the azimuths between the max and min of start_end. In XRD cases this should have no effect
             # but is added for consistency with the spline functions
             fout = (
                 fout
-                + inp_param[(2 * i) - 1] * np.sin((azm_tmp) * i)
-                + inp_param[2 * i] * np.cos((azm_tmp) * i)
+                + inp_param[(2 * i) - 1] * basis[:, 2 * i - 1].reshape(shape)
+                + inp_param[2 * i] * basis[:, 2 * i].reshape(shape)
             )  # single col array
             # except:
             #    pass
+        if ma.isMaskedArray(azimuth) and len(inp_param) > 2:
+            fout = ma.array(fout, mask=ma.getmaskarray(azimuth))
     return np.squeeze(fout)
 
 
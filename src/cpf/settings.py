@@ -15,6 +15,7 @@ import numpy as np
 
 import cpf.input_types as input_types
 import cpf.output_formatters as output_formatters
+from cpf.image_index import ImageIndex
 from cpf.IO_functions import (
     file_list,
     image_list,
@@ -100,11 +101,18 @@ class settings:
 
         self.datafile_list: Optional[list[Union[str, Path]]] = None
         self.datafile_number: int = 0
-        self.image_list: Optional[list[Union[str, Path]]] = None
+        # for h5 files this is an ImageIndex, which is indexed and sliced as a list.
+        self.image_list: Optional[Union[list[Union[str, Path]], ImageIndex]] = None
         self.image_number: int = 0
         self.datafile_directory = Path(".")
 
         self.datafile_preprocess = None
+        # number of images to read ahead, in the background, while an image is fitted
+        # (0: none). Only data classes with a read_image function (Dioptas) read
+        # ahead.
+        self.datafile_prefetch = 0
+        # largest memory (in MB) for the images read ahead, or None for no limit
+        self.datafile_prefetch_memory = None
 
         self.file_label: Optional[str] = None
 
@@ -119,6 +127,9 @@ class settings:
         # FIXME: these are optional and should probalably be burried in an optional dictionary.
         self.calibration_detector = None
         self.calibration_pixel_size = None
+        # directory to cache the two theta and azimuth of the pixels, and the masks, in.
+        # True uses the default directory, False or None does not cache them.
+        self.calibration_cache = False
 
         self.fit_bin_type = None
         self.fit_per_bin = None
@@ -136,6 +147,27 @@ class settings:
 
         self.fit_track = False
         self.fit_propagate = True
+        # write the propagated fits to a checkpoint file every n images (None: never)
+        self.fit_checkpoint_interval = None
+        # reduction factors of the data for coarse-to-fine fitting (None: all data only)
+        self.fit_resolution_levels = None
+        # skip refinement stages predicted to reduce chi-squared by less than this
+        # fraction (None: run every stage)
+        self.fit_refine_tolerance = None
+        # record the time and function evaluations of each stage of the fits
+        self.fit_profile = False
+        # derivatives used by the fitting: "numerical" or "analytical"
+        self.fit_jacobian = "numerical"
+        # how the azimuthal chunks are fitted: "lmfit" (one at a time) or "batched"
+        self.fit_chunk_engine = "lmfit"
+        # solve the linear (background and height) coefficients by variable projection
+        self.fit_varpro = False
+        # how the series are fitted to the chunks: "lmfit" or "linear" (solved directly)
+        self.fit_series_solver = "lmfit"
+        # evaluate the peaks only within this many widths of their centres (None: all)
+        self.fit_peak_window = None
+        # what makes the fits of the model: "lmfit" or "least_squares" (scipy directly)
+        self.fit_backend = "lmfit"
 
         self.cascade_bin_type = 0  # set default type - number data per bin
         self.cascade_per_bin = 50  # set default value
@@ -149,6 +181,9 @@ class settings:
         self.output_types: Optional[list[str]] = None
         # output_settings is populated with additional requirements for each type (if any)
         self.output_settings: dict = {}
+        # where the fits are stored: "json" (a file for each image) or "hdf5" (a
+        # single results store for all the images)
+        self.output_store = "json"
 
         # initiate the subpattern settings.
         # set to save diggging through self.fit_orders and carring values around
@@ -285,6 +320,8 @@ class settings:
             self.output_directory = self.settings_from_file.Output_directory
             if isinstance(self.output_directory, str):
                 self.output_directory = Path(self.output_directory)
+        if "Output_store" in dir(self.settings_from_file):
+            self.output_store = self.settings_from_file.Output_store
 
         # Load the detector class here to access relevant functions and check required parameters are present
         if "Calib_type" in dir(self.settings_from_file):
@@ -300,6 +337,8 @@ class settings:
             self.calibration_detector = self.settings_from_file.Calib_detector
         if "Calib_pixels" in dir(self.settings_from_file):
             self.calibration_pixel_size = self.settings_from_file.Calib_pixels
+        if "Calib_cache" in dir(self.settings_from_file):
+            self.calibration_cache = self.settings_from_file.Calib_cache
 
         # load the data class.
         self.data_class = detector_factory(fit_settings=self)
@@ -314,6 +353,12 @@ class settings:
 
         if "image_preprocess" in dir(self.settings_from_file):
             self.datafile_preprocess = self.settings_from_file.Image_prepare
+        if "datafile_prefetch" in dir(self.settings_from_file):
+            self.datafile_prefetch = self.settings_from_file.datafile_prefetch
+        if "datafile_prefetch_memory" in dir(self.settings_from_file):
+            self.datafile_prefetch_memory = (
+                self.settings_from_file.datafile_prefetch_memory
+            )
 
         #     # FIX ME: This doesn't seem to be used, if it should be this needs moving to class structure.
         #     alternatives_list = [[["datafile_StartNum", "datafile_EndNum"], ["datafile_Files"]]]
@@ -359,6 +404,28 @@ class settings:
             self.fit_min_data_intensity = self.settings_from_file.fit_min_data_intensity
         if "fit_min_peak_intensity" in dir(self.settings_from_file):
             self.fit_min_peak_intensity = self.settings_from_file.fit_min_peak_intensity
+        if "fit_jacobian" in dir(self.settings_from_file):
+            self.fit_jacobian = self.settings_from_file.fit_jacobian
+        if "fit_chunk_engine" in dir(self.settings_from_file):
+            self.fit_chunk_engine = self.settings_from_file.fit_chunk_engine
+        if "fit_varpro" in dir(self.settings_from_file):
+            self.fit_varpro = self.settings_from_file.fit_varpro
+        if "fit_series_solver" in dir(self.settings_from_file):
+            self.fit_series_solver = self.settings_from_file.fit_series_solver
+        if "fit_peak_window" in dir(self.settings_from_file):
+            self.fit_peak_window = self.settings_from_file.fit_peak_window
+        if "fit_backend" in dir(self.settings_from_file):
+            self.fit_backend = self.settings_from_file.fit_backend
+        if "fit_resolution_levels" in dir(self.settings_from_file):
+            self.fit_resolution_levels = self.settings_from_file.fit_resolution_levels
+        if "fit_refine_tolerance" in dir(self.settings_from_file):
+            self.fit_refine_tolerance = self.settings_from_file.fit_refine_tolerance
+        if "fit_profile" in dir(self.settings_from_file):
+            self.fit_profile = self.settings_from_file.fit_profile
+        if "fit_checkpoint_interval" in dir(self.settings_from_file):
+            self.fit_checkpoint_interval = (
+                self.settings_from_file.fit_checkpoint_interval
+            )
 
         if "AziDataPerBin" in dir(self.settings_from_file):
             self.fit_per_bin = self.settings_from_file.AziDataPerBin
@@ -408,6 +475,76 @@ class settings:
             self.validate_fit_orders()
         if self.fit_bounds != None:
             self.validate_fit_bounds()
+        if self.fit_jacobian not in ["numerical", "analytical"]:
+            raise ValueError(
+                "'fit_jacobian' is not recognised. It must be 'numerical' or 'analytical'."
+            )
+        if self.fit_chunk_engine not in ["lmfit", "batched"]:
+            raise ValueError(
+                "'fit_chunk_engine' is not recognised. It must be 'lmfit' or 'batched'."
+            )
+        if not isinstance(self.fit_varpro, bool):
+            raise ValueError("'fit_varpro' must be True or False.")
+        if self.fit_series_solver not in ["linear", "lmfit"]:
+            raise ValueError(
+                "'fit_series_solver' is not recognised. It must be 'linear' or 'lmfit'."
+            )
+        if self.fit_peak_window is not None and (
+            isinstance(self.fit_peak_window, bool)
+            or not isinstance(self.fit_peak_window, (int, float))
+            or self.fit_peak_window <= 0
+        ):
+            raise ValueError("'fit_peak_window' must be None or a positive number.")
+        if self.fit_backend not in ["lmfit", "least_squares"]:
+            raise ValueError(
+                "'fit_backend' is not recognised. It must be 'lmfit' or 'least_squares'."
+            )
+        if self.fit_checkpoint_interval is not None and (
+            isinstance(self.fit_checkpoint_interval, bool)
+            or not isinstance(self.fit_checkpoint_interval, int)
+            or self.fit_checkpoint_interval < 1
+        ):
+            raise ValueError(
+                "'fit_checkpoint_interval' must be None or a positive integer."
+            )
+        if self.fit_resolution_levels is not None and (
+            not isinstance(self.fit_resolution_levels, list)
+            or not all(
+                isinstance(factor, int) and not isinstance(factor, bool) and factor > 1
+                for factor in self.fit_resolution_levels
+            )
+        ):
+            raise ValueError(
+                "'fit_resolution_levels' must be None or a list of integers greater than 1."
+            )
+        if self.fit_refine_tolerance is not None and (
+            isinstance(self.fit_refine_tolerance, bool)
+            or not isinstance(self.fit_refine_tolerance, (int, float))
+            or self.fit_refine_tolerance <= 0
+        ):
+            raise ValueError(
+                "'fit_refine_tolerance' must be None or a positive number."
+            )
+        if not isinstance(self.fit_profile, bool):
+            raise ValueError("'fit_profile' must be True or False.")
+        if (
+            isinstance(self.datafile_prefetch, bool)
+            or not isinstance(self.datafile_prefetch, int)
+            or self.datafile_prefetch < 0
+        ):
+            raise ValueError("'datafile_prefetch' must be 0 or a positive integer.")
+        if self.datafile_prefetch_memory is not None and (
+            isinstance(self.datafile_prefetch_memory, bool)
+            or not isinstance(self.datafile_prefetch_memory, (int, float))
+            or self.datafile_prefetch_memory <= 0
+        ):
+            raise ValueError(
+                "'datafile_prefetch_memory' must be None or a positive number."
+            )
+        if self.output_store not in ["json", "hdf5"]:
+            raise ValueError(
+                "'Output_store' is not recognised. It must be 'json' or 'hdf5'."
+            )
 
         # validate output types
         if self.output_types != None:
@@ -0,0 +1,85 @@
+import os
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# directory of the example data fitted by the example1 fixture.
+EXAMPLE1_DIRECTORY = Path(__file__).resolve().parents[1] / "Example1-Fe"
+EXAMPLE1_INPUT = "BCC1_input_Dioptas.py"
+
+# fits of the example data, so that the fits with the default settings are only made
+# once for all the tests comparing with them.
+_example1_fits = {}
+
+
+class LinearData:
+    """Minimal stand-in for a data class: two theta = 10 * d-spacing."""
+
+    def __init__(self, two_theta=None, azimuth=None, intensity=None):
+        self.tth = two_theta
+        self.azm = azimuth
+        self.intensity = intensity
+
+    def conversion(self, d_spacing, reverse=0):
+        return np.asarray(d_spacing) * 10.0
+
+
+def fit_example1(subpattern, images=1, **options):
+    """
+    Fit a subpattern of the first images of Example1, each propagated from the fit to
+    the previous image, as execute does.
+    :param subpattern: index of the subpattern in the input file
+    :param images: number of images to fit
+    :param options: settings changed from those in the input file
+    :return: list of the fits, one for each image
+    """
+    key = (subpattern, images, repr(sorted(options.items())))
+    if key not in _example1_fits:
+        import cpf.XRD_FitPattern as xfp
+        from cpf.XRD_FitSubpattern import fit_sub_pattern
+
+        cwd = os.getcwd()
+        os.chdir(EXAMPLE1_DIRECTORY)
+        try:
+            settings = xfp.initiate(EXAMPLE1_INPUT)
+            for name, value in options.items():
+                setattr(settings, name, value)
+            data = settings.data_class
+            fits = []
+            previous_fit = None
+            for image in range(images):
+                data.fill_data(settings.image_list[image], settings=settings)
+                settings.set_subpattern(image, subpattern)
+                sub_data = data.subpattern(
+                    data.limits_index(range_bounds=settings.subfit_orders["range"])
+                )
+                previous_fit = fit_sub_pattern(
+                    sub_data,
+                    settings,
+                    deepcopy(previous_fit),
+                    save_fit=False,
+                    debug=False,
+                    min_data_intensity=settings.fit_min_data_intensity,
+                    min_peak_intensity=settings.fit_min_peak_intensity,
+                )[0]
+                fits.append(previous_fit)
+        finally:
+            os.chdir(cwd)
+        _example1_fits[key] = fits
+    return deepcopy(_example1_fits[key])
+
+
+@pytest.fixture(scope="class")
+def linear_data(request):
+    """Give the test class the LinearData stand-in for a data class."""
+    request.cls.LinearData = LinearData
+
+
+@pytest.fixture(scope="class")
+def example1(request):
+    """Give the test class fit_example1, skipping it if the example data are missing."""
+    if not (EXAMPLE1_DIRECTORY / EXAMPLE1_INPUT).is_file():
+        pytest.skip("the Example1 data are not available")
+    request.cls.fit_example1 = staticmethod(fit_example1)
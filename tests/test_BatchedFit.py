@@ -0,0 +1,129 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import pytest
+from cpf import batched_fit as bf
+from cpf import lmfit_model as lmm
+from cpf.batched_fit import fit_chunks_batched
+from lmfit import Parameters
+
+
+@pytest.mark.usefixtures("linear_data")
+class TestBatchedFit(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.orders = {"range": [9, 11]}
+        self.chunks = []
+        self.params = []
+        for k, n in enumerate([60, 55, 48]):
+            two_theta = np.linspace(9, 11, n)
+            azimuth = np.full(n, 10.0 * k)
+            truth = {
+                "bg_c0_f0": 3.0 + k,
+                "bg_c1_f0": 0.5,
+                "peak_0_h0": 50.0 - 5 * k,
+                "peak_0_d0": 1.0 + 0.002 * k,
+                "peak_0_w0": 0.08,
+                "peak_0_p0": 0.4,
+            }
+            intensity = np.ravel(
+                lmm.peaks_model(
+                    two_theta,
+                    azimuth,
+                    data_class=self.LinearData(two_theta, azimuth),
+                    orders=self.orders,
+                    **truth,
+                )
+            ) + rng.normal(0, 0.5, n)
+            self.chunks.append(self.LinearData(two_theta, azimuth, intensity))
+
+            params = Parameters()
+            params.add("bg_c0_f0", 2.0, min=0, max=20)
+            params.add("bg_c1_f0", 0.0)
+            params.add("peak_0_h0", 40.0, min=0, max=100)
+            params.add("peak_0_d0", 1.003, min=0.98, max=1.02)
+            params.add("peak_0_w0", 0.1, min=0.01, max=0.5)
+            params.add("peak_0_p0", 0.5, min=0, max=1)
+            self.params.append(params)
+
+    def test_same_as_lmfit(self):
+        batched = fit_chunks_batched(self.chunks, self.params, self.orders)
+        self.assertEqual(len(batched), len(self.chunks))
+        for chunk, params, result in zip(self.chunks, self.params, batched):
+            expected = lmm.fit_model(chunk, self.orders, params).params
+            for name in params:
+                self.assertAlmostEqual(
+                    result[name].value, expected[name].value, delta=1e-4
+                )
+                self.assertAlmostEqual(
+                    result[name].stderr,
+                    expected[name].stderr,
+                    delta=0.01 * expected[name].stderr,
+                )
+            # the guesses are not changed.
+            self.assertEqual(params["peak_0_h0"].value, 40.0)
+
+    def test_parameters_must_match(self):
+        self.params[1].add("peak_0_h1", 0.0)
+        with self.assertRaises(ValueError):
+            fit_chunks_batched(self.chunks, self.params, self.orders)
+
+
+@pytest.mark.usefixtures("example1")
+class TestBatchedFitExample1(unittest.TestCase):
+    def test_chunks_same_as_lmfit(self):
+        # the chunks of the first image, as they are given to the batched engine.
+        batches = []
+
+        def record(chunk_data, chunk_params, orders, max_n_fev=400):
+            batches.append((chunk_data, chunk_params, orders, max_n_fev))
+            return fit_chunks_batched(chunk_data, chunk_params, orders, max_n_fev)
+
+        with mock.patch.object(bf, "fit_chunks_batched", side_effect=record):
+            self.fit_example1(1, fit_chunk_engine="batched")
+        self.assertGreater(len(batches), 0)
+
+        for chunk_data, chunk_params, orders, max_n_fev in batches:
+            fitted = fit_chunks_batched(chunk_data, chunk_params, orders, max_n_fev)
+            for data, params, result in zip(chunk_data, chunk_params, fitted):
+                expected = lmm.fit_model(data, orders, params, max_n_fev=max_n_fev)
+                if not expected.success:
+                    # fits stopped by the number of evaluations can end anywhere.
+                    continue
+                residual = np.asarray(data.intensity) - lmm.peaks_model(
+                    data.tth,
+                    data.azm,
+                    data_class=data,
+                    orders=orders,
+                    **result.valuesdict(),
+                )
+                self.assertAlmostEqual(
+                    np.sum(residual**2) / expected.chisqr, 1, delta=1e-3
+                )
+
+    def test_same_fits_as_lmfit(self):
+        # the fits to the first image and to the next image propagated from it.
+        for subpattern in [0, 1]:
+            default = self.fit_example1(subpattern, images=2)
+            batched = self.fit_example1(
+                subpattern, images=2, fit_chunk_engine="batched"
+            )
+            for fit, expected in zip(batched, default):
+                np.testing.assert_allclose(
+                    fit["FitProperties"]["ChiSq"],
+                    expected["FitProperties"]["ChiSq"],
+                    rtol=1e-5,
+                )
+                np.testing.assert_array_less(
+                    np.abs(
+                        np.array(fit["peak"][0]["d-space"])
+                        - expected["peak"][0]["d-space"]
+                    ),
+                    0.1 * np.array(expected["peak"][0]["d-space_err"]),
+                )
+                self.assertGreater(np.min(fit["peak"][0]["profile_err"]), 1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
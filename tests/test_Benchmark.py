@@ -0,0 +1,39 @@
+import unittest
+
+from cpf.benchmark import compare_to_baseline, default_cases
+
+
+def results(execute, error):
+    """Minimal results of run_benchmark for one case."""
+    return {
+        "cases": [
+            {
+                "case": {"name": "small"},
+                "times": {"fill_data": 0.01, "execute": execute},
+                "d-space-error": error,
+            }
+        ]
+    }
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_cases(self):
+        names = [case["name"] for case in default_cases()]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn("small", names)
+
+    def test_compare(self):
+        baseline = results(2.0, 1e-5)
+        self.assertEqual(compare_to_baseline(results(2.2, 1e-5), baseline), [])
+        regressions = compare_to_baseline(results(3.0, 1e-5), baseline)
+        self.assertEqual([r["stage"] for r in regressions], ["execute"])
+        self.assertAlmostEqual(regressions[0]["ratio"], 1.5)
+        regressions = compare_to_baseline(results(2.0, 1e-4), baseline)
+        self.assertEqual([r["stage"] for r in regressions], ["d-space-error"])
+        # the times of fill_data are too short to compare.
+        baseline["cases"][0]["times"]["fill_data"] = 0.001
+        self.assertEqual(compare_to_baseline(results(2.0, 1e-5), baseline), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
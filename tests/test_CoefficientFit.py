@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+from cpf import lmfit_model as lmm
+from lmfit import Parameters
+
+
+class TestCoefficientFit(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.azimuth = np.linspace(0, 355, 72)
+        self.values = (
+            20
+            + 3 * np.sin(np.deg2rad(self.azimuth))
+            - 2 * np.cos(np.deg2rad(self.azimuth))
+            + rng.normal(0, 0.3, self.azimuth.size)
+        )
+        self.errors = rng.uniform(0.5, 1.5, self.azimuth.size)
+
+    def make_params(self, n_coeff, coeff_type, minimum=-100):
+        params = Parameters()
+        for i in range(n_coeff):
+            params.add("peak_0_h" + str(i), value=1.0, min=minimum, max=100)
+        params.add("peak_0_h_tp", value=coeff_type, vary=False)
+        return params
+
+    def fit(self, params, solver):
+        return lmm.coefficient_fit(
+            ydata=self.values,
+            azimuth=self.azimuth,
+            inp_param=params,
+            param_str="peak_0_h",
+            errs=self.errors,
+            solver=solver,
+        )
+
+    def test_same_as_lmfit(self):
+        for coeff_type, n_coeff in [(0, 5), (3, 6), (1, 4)]:
+            params = self.make_params(n_coeff, coeff_type)
+            linear = self.fit(params, "linear")
+            iterative = self.fit(params, "lmfit")
+            self.assertEqual(linear.method, "linear")
+            for i in range(n_coeff):
+                name = "peak_0_h" + str(i)
+                self.assertAlmostEqual(
+                    linear.params[name].value, iterative.params[name].value, places=5
+                )
+                self.assertAlmostEqual(
+                    linear.params[name].stderr,
+                    iterative.params[name].stderr,
+                    delta=1e-3 * iterative.params[name].stderr,
+                )
+            self.assertEqual(linear.params["peak_0_h_tp"].stderr, 0)
+
+    def test_fixed_coefficient(self):
+        params = self.make_params(5, 0)
+        params["peak_0_h2"].set(value=-2.0, vary=False)
+        linear = self.fit(params, "linear")
+        iterative = self.fit(params, "lmfit")
+        self.assertEqual(linear.nvarys, 4)
+        self.assertEqual(linear.params["peak_0_h2"].value, -2.0)
+        self.assertAlmostEqual(
+            linear.params["peak_0_h1"].value,
+            iterative.params["peak_0_h1"].value,
+            places=5,
+        )
+
+    def test_outside_bounds_uses_lmfit(self):
+        params = self.make_params(5, 0, minimum=0)
+        out = self.fit(params, "linear")
+        self.assertNotEqual(getattr(out, "method", None), "linear")
+        self.assertGreaterEqual(out.params["peak_0_h2"].value, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
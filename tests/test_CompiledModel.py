@@ -0,0 +1,130 @@
+import unittest
+
+import numpy as np
+import pytest
+from cpf import lmfit_model as lmm
+from cpf.compiled_model import CompiledModel
+from lmfit import Parameters
+
+
+@pytest.mark.usefixtures("linear_data")
+class TestCompiledModel(unittest.TestCase):
+    def setUp(self):
+        tth, azm = np.meshgrid(np.linspace(9, 11, 40), np.linspace(0, 355, 24))
+        self.two_theta = tth.flatten()
+        self.azimuth = azm.flatten()
+        self.data_class = self.LinearData()
+        self.orders = {"range": [9, 11]}
+
+        self.params = Parameters()
+        self.params.add("bg_c0_f0", value=2.0)
+        self.params.add("bg_c0_f1", value=0.3)
+        self.params.add("bg_c0_f2", value=-0.2)
+        self.params.add("bg_c1_f0", value=0.5)
+        self.params.add("peak_0_h0", value=20.0)
+        self.params.add("peak_0_h1", value=5.0)
+        self.params.add("peak_0_h2", value=-1.0)
+        self.params.add("peak_0_h_tp", value=3, vary=False)
+        self.params.add("peak_0_s0", value=2, vary=False)
+        self.params.add("peak_0_d0", value=1.0)
+        self.params.add("peak_0_d1", value=0.002)
+        self.params.add("peak_0_d2", value=0.001)
+        self.params.add("peak_0_w0", value=0.05)
+        self.params.add("peak_0_p0", value=0.4)
+
+    def test_same_as_peaks_model(self):
+        model = CompiledModel(
+            self.params,
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+        )
+        expected = lmm.peaks_model(
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+            **self.params.valuesdict(),
+        )
+        compiled = lmm.peaks_model(
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+            compiled_model=model,
+            **self.params.valuesdict(),
+        )
+        np.testing.assert_allclose(compiled, expected, rtol=1e-12)
+        self.assertEqual(len(model.names), 12)
+
+    def test_linear_design(self):
+        model = CompiledModel(
+            self.params,
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+        )
+        vector = model.vector(self.params)
+        design = model.linear_design(vector)
+        self.assertEqual(
+            model.linear_names,
+            ["bg_c0_f0", "bg_c0_f1", "bg_c0_f2", "bg_c1_f0"]
+            + ["peak_0_h0", "peak_0_h1", "peak_0_h2"],
+        )
+        np.testing.assert_allclose(
+            design @ vector[model.linear_index],
+            model.evaluate(vector),
+            rtol=1e-10,
+        )
+
+    def test_window(self):
+        exact = CompiledModel(
+            self.params,
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+        )
+        windowed = CompiledModel(
+            self.params,
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+            window=5,
+        )
+        vector = exact.vector(self.params)
+        difference = np.abs(windowed.evaluate(vector) - exact.evaluate(vector))
+        self.assertGreater(np.max(difference), 0)
+        self.assertLessEqual(np.max(difference), windowed.truncation_error)
+        # heights are below 26, with a Gaussian fraction of 0.4
+        self.assertLess(windowed.truncation_error, 26 * (0.4 * 2.0**-25 + 0.6 / 26))
+        np.testing.assert_allclose(
+            windowed.derivatives(vector)[difference == 0],
+            exact.derivatives(vector)[difference == 0],
+            rtol=1e-12,
+        )
+
+    def test_positions_checked(self):
+        model = CompiledModel(
+            self.params,
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+        )
+        with self.assertRaises(ValueError):
+            lmm.peaks_model(
+                self.two_theta[:10],
+                self.azimuth[:10],
+                data_class=self.data_class,
+                orders=self.orders,
+                compiled_model=model,
+                **self.params.valuesdict(),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.ma as ma
+import pyFAI
+from cpf.input_types.DioptasFunctions import DioptasDetector
+from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+
+
+class CacheSettings:
+    """Minimal stand-in for the settings class."""
+
+    def __init__(self, calibration_cache):
+        self.calibration_cache = calibration_cache
+
+
+class TestGeometryCache(unittest.TestCase):
+    def setUp(self):
+        self.data = DioptasDetector()
+        self.data.detector = AzimuthalIntegrator(
+            detector=pyFAI.detectors.Detector(
+                pixel1=1e-4, pixel2=1e-4, max_shape=(50, 60)
+            ),
+            dist=0.1,
+            poni1=0.002,
+            poni2=0.003,
+            wavelength=4e-11,
+        )
+
+    def test_cached_same_as_calculated(self):
+        with tempfile.TemporaryDirectory() as cache:
+            tth, azm = self.data.get_geometry(settings=CacheSettings(cache))
+            self.assertEqual(len(os.listdir(cache)), 1)
+            cached_tth, cached_azm = self.data.get_geometry(
+                settings=CacheSettings(cache)
+            )
+            np.testing.assert_array_equal(cached_tth, tth)
+            np.testing.assert_array_equal(cached_azm, azm)
+            np.testing.assert_array_equal(
+                tth, np.rad2deg(self.data.detector.twoThetaArray((50, 60)))
+            )
+
+            # a different calibration is cached separately.
+            self.data.detector.dist = 0.2
+            self.data.get_geometry(settings=CacheSettings(cache))
+            self.assertEqual(len(os.listdir(cache)), 2)
+
+    def test_no_cache(self):
+        tth, azm = self.data.get_geometry(settings=CacheSettings(False))
+        self.assertEqual(tth.shape, (50, 60))
+
+
+class TestSubpattern(unittest.TestCase):
+    def test_same_as_set_limits(self):
+        data = DioptasDetector()
+        tth, azm = np.meshgrid(np.linspace(5, 15, 30), np.linspace(-180, 180, 20))
+        data.tth = ma.array(tth)
+        data.azm = ma.array(azm)
+        data.intensity = ma.array(np.arange(tth.size, dtype=float).reshape(tth.shape))
+        data.mask_apply(data.intensity > 500)
+
+        index = data.limits_index(range_bounds=[8, 10])
+        sub_data = data.subpattern(index)
+        expected = data.duplicate()
+        expected.set_limits(range_bounds=[8, 10])
+
+        for name in ["intensity", "tth", "azm"]:
+            np.testing.assert_array_equal(
+                getattr(sub_data, name), getattr(expected, name)
+            )
+            np.testing.assert_array_equal(
+                ma.getmaskarray(getattr(sub_data, name)),
+                ma.getmaskarray(getattr(expected, name)),
+            )
+        # the original data are unchanged.
+        self.assertEqual(data.tth.shape, tth.shape)
+
+
+class BinSettings:
+    """Minimal stand-in for the settings class."""
+
+    fit_bin_type = 1
+    fit_number_bins = 36
+    cascade_per_bin = 50
+
+
+class TestBins(unittest.TestCase):
+    def test_same_as_loop(self):
+        rng = np.random.default_rng(0)
+        data = DioptasDetector()
+        data.azm = ma.array(
+            rng.uniform(-180, 180, 5000), mask=rng.uniform(size=5000) > 0.9
+        )
+        chunks, means = data.bins(BinSettings())
+
+        edges = np.linspace(-180, 180, 37)
+        self.assertEqual(len(chunks), 36)
+        for i in range(36):
+            expected = np.where((data.azm > edges[i]) & (data.azm <= edges[i + 1]))
+            np.testing.assert_array_equal(chunks[i], expected[0])
+            self.assertEqual(means[i], np.mean(data.azm[expected]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+import fabio
+import numpy as np
+from cpf.input_types.ESRFlvpFunctions import ESRFlvpDetector
+
+
+class TestESRFlvpFrames(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(5)
+        # frames of an image, named by the detector position.
+        self.angles = [170, -10, 20, -100, 65]
+        self.frames = {}
+        for angle in self.angles:
+            data = rng.integers(0, 1000, size=(6, 4)).astype(np.int32)
+            filename = os.path.join(self.directory.name, "image_001_%i.edf" % angle)
+            fabio.edfimage.EdfImage(data=data).write(filename)
+            self.frames[angle] = data
+        self.image = os.path.join(self.directory.name, "image_001_*.edf")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sorted_files(self):
+        detector = ESRFlvpDetector()
+        files, positions = detector._get_sorted_files(self.image)
+        self.assertEqual(positions, sorted(a + 0.5 for a in self.angles))
+        # a new frame is not listed: the sorted files are kept for each image.
+        fabio.edfimage.EdfImage(data=self.frames[20]).write(
+            os.path.join(self.directory.name, "image_001_30.edf")
+        )
+        self.assertEqual(detector._get_sorted_files(self.image), (files, positions))
+
+    def test_read_frames(self):
+        detector = ESRFlvpDetector()
+        files, _ = detector._get_sorted_files(self.image)
+        im = detector._read_frames(files)
+        self.assertEqual(im.shape, (5, 6, 4))
+        self.assertEqual(im.dtype, np.int32)
+        for frame, angle in zip(im, sorted(self.angles)):
+            np.testing.assert_array_equal(frame, np.flipud(self.frames[angle]))
+        with self.assertRaises(FileNotFoundError):
+            detector._read_frames(files + ["missing_0.edf"])
+
+
+if __name__ == "__main__":
+    unittest.main()
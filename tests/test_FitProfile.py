@@ -0,0 +1,59 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+from cpf.fit_profile import FitProfile, profile_rows, write_profile_report
+
+
+class FitResult:
+    """Minimal stand-in for the result of a fit."""
+
+    nfev = 25
+    ndata = 1000
+    nvarys = 5
+
+
+class TestFitProfile(unittest.TestCase):
+    def setUp(self):
+        profile = FitProfile()
+        stage = profile.start("chunks")
+        profile.stop(stage, n_data=1000)
+        for component in ["peak_0_h", "peak_0_d"]:
+            stage = profile.start("refine", component)
+            profile.stop(stage, FitResult())
+        self.fits = [
+            {"FitProperties": {"profile": profile.stages}},
+            {"FitProperties": {"profile": profile.stages[:1]}},
+        ]
+
+    def test_stages(self):
+        stages = self.fits[0]["FitProperties"]["profile"]
+        self.assertEqual([s["stage"] for s in stages], ["chunks", "refine", "refine"])
+        self.assertNotIn("function-evaluations", stages[0])
+        self.assertEqual(stages[2]["component"], "peak_0_d")
+        self.assertEqual(stages[2]["function-evaluations"], 25)
+        for stage in stages:
+            self.assertGreaterEqual(stage["wall-time"], 0)
+            self.assertNotIn(None, stage.values())
+
+    def test_report(self):
+        rows = profile_rows(self.fits, 0) + profile_rows(self.fits, 1)
+        self.assertEqual(len(rows), 8)
+        with tempfile.TemporaryDirectory() as directory:
+            csv_file = os.path.join(directory, "profile.csv")
+            json_file = os.path.join(directory, "profile.json")
+            write_profile_report(rows, csv_file, json_file)
+            with open(csv_file) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 8)
+            with open(json_file) as f:
+                totals = json.load(f)["totals"]
+        refine = [t for t in totals if t["stage"] == "refine"]
+        self.assertEqual(len(refine), 1)
+        self.assertEqual(refine[0]["count"], 4)
+        self.assertEqual(refine[0]["function-evaluations"], 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
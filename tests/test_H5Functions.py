@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import hdf5plugin
+import numpy as np
+from cpf import h5_functions
+
+
+class TestH5Images(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "images.h5")
+        rng = np.random.default_rng(3)
+        self.images = rng.integers(0, 5000, size=(10, 24, 32)).astype(np.uint32)
+        with h5py.File(self.filename, "w") as f:
+            f.create_dataset("contiguous", data=self.images)
+            f.create_dataset(
+                "deflate",
+                data=self.images,
+                chunks=(1, 24, 32),
+                compression="gzip",
+                shuffle=True,
+            )
+            f.create_dataset(
+                "deflate_4", data=self.images, chunks=(4, 24, 32), compression="gzip"
+            )
+            f.create_dataset(
+                "tiles", data=self.images, chunks=(1, 12, 16), compression="gzip"
+            )
+            f.create_dataset(
+                "bitshuffle", data=self.images, chunks=(1, 24, 32), **hdf5plugin.LZ4()
+            )
+
+    def tearDown(self):
+        h5_functions.close_h5_files()
+        self.directory.cleanup()
+
+    def test_images(self):
+        positions = [7, 0, 3, 5, 4, -1]
+        for key in ["contiguous", "deflate", "deflate_4", "tiles", "bitshuffle"]:
+            image_list = [[self.filename, [key, p, str(p)]] for p in positions]
+            np.testing.assert_array_equal(
+                h5_functions.get_images(image_list[0]), self.images[7]
+            )
+            data = h5_functions.get_images(image_list)
+            self.assertEqual(data.shape, (24, 32, len(positions)))
+            np.testing.assert_array_equal(
+                data, np.moveaxis(self.images[positions], 0, -1)
+            )
+
+    def test_decoder(self):
+        datafile = h5_functions.open_h5(self.filename)
+        if h5_functions.bitshuffle is not None:
+            self.assertIsNotNone(h5_functions._chunk_decoder(datafile["bitshuffle"]))
+        # hdf5 decodes the other filters.
+        self.assertIsNone(h5_functions._chunk_decoder(datafile["deflate"]))
+        self.assertIsNone(h5_functions._chunk_decoder(datafile["contiguous"]))
+
+    def test_open_files(self):
+        datafile = h5_functions.open_h5(self.filename)
+        self.assertIs(h5_functions.open_h5(self.filename), datafile)
+        self.assertEqual(datafile.mode, "r")
+        # a changed file is opened again.
+        datafile.close()
+        with h5py.File(self.filename, "a") as f:
+            f["contiguous"][0] = 0
+        os.utime(self.filename, ns=(0, 0))
+        datafile = h5_functions.open_h5(self.filename)
+        self.assertTrue(datafile.id.valid)
+        self.assertEqual(datafile["contiguous"][0].max(), 0)
+
+    def test_open_files_per_thread(self):
+        datafile = h5_functions.open_h5(self.filename)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other = executor.submit(h5_functions.open_h5, self.filename).result()
+            self.assertIsNot(other, datafile)
+            # the file is changed, so this thread opens it again, but the other
+            # thread's file is still open.
+            os.utime(self.filename, ns=(0, 0))
+            h5_functions.open_h5(self.filename)
+            self.assertFalse(datafile.id.valid)
+            self.assertTrue(other.id.valid)
+
+
+if __name__ == "__main__":
+    unittest.main()
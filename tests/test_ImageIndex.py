@@ -0,0 +1,70 @@
+import os
+import pickle
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+from cpf import h5_functions
+from cpf.image_index import ImageIndex
+from cpf.IO_functions import image_list
+
+
+class TestImageIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with h5py.File(os.path.join(self.directory.name, "scan.h5"), "w") as f:
+            for scan, number in [("1.1", 5), ("2.1", 7)]:
+                f.create_dataset(
+                    scan + "/measurement/eiger", shape=(number, 4, 6), dtype=np.uint16
+                )
+        # minimal settings, for the frames of all the scans in the file.
+        self.settings = SimpleNamespace(
+            datafile_directory=self.directory.name,
+            datafile_Basename="scan",
+            datafile_Ending=".h5",
+            h5_key_list=["/", "measurement/eiger"],
+            h5_key_names=["/", ""],
+            h5_key_start=[0, 0],
+            h5_key_end=[-1, -1],
+            h5_key_step=[1, 1],
+            h5_data="iterate",
+        )
+
+    def tearDown(self):
+        h5_functions.close_h5_files()
+        self.directory.cleanup()
+
+    def test_images(self):
+        images = image_list(dir(self.settings), self.settings)[2]
+        self.assertIsInstance(images, ImageIndex)
+        self.assertEqual(len(images), 12)
+        filename = os.path.join(self.directory.name, "scan.h5")
+        keys = h5_functions.get_image_keys(
+            filename,
+            ["/", "measurement/eiger"],
+            ["/", ""],
+            key_start=[0, 0],
+            key_end=[-1, -1],
+            key_step=[1, 1],
+        )
+        # the same entries as the listed keys.
+        self.assertEqual(list(images), [[filename, key] for key in keys])
+        self.assertEqual(images[5], [filename, ["2.1/measurement/eiger", 0, "2pt1_0"]])
+        self.assertEqual(images[-1][1][1], 6)
+
+    def test_slices(self):
+        images = image_list(dir(self.settings), self.settings)[2]
+        selected = images[3:11:2]
+        self.assertEqual(len(selected), 4)
+        self.assertEqual(list(selected), [images[n] for n in range(3, 11, 2)])
+        self.assertEqual(selected[1:][0], images[5])
+        with self.assertRaises(IndexError):
+            selected[4]
+        # the index can be sent to other processes.
+        self.assertEqual(list(pickle.loads(pickle.dumps(selected))), list(selected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+import numpy as np
+import pytest
+from cpf import lmfit_model as lmm
+from lmfit import Parameters
+
+
+@pytest.mark.usefixtures("linear_data")
+class TestPeaksJacobian(unittest.TestCase):
+    def setUp(self):
+        tth, azm = np.meshgrid(np.linspace(9, 11, 60), np.linspace(0, 355, 24))
+        self.two_theta = tth.flatten()
+        self.azimuth = azm.flatten()
+        self.data_class = self.LinearData()
+        self.orders = {"range": [9, 11]}
+
+        self.params = Parameters()
+        self.params.add("bg_c0_f0", value=2.0)
+        self.params.add("bg_c0_f1", value=0.3)
+        self.params.add("bg_c0_f2", value=-0.2)
+        self.params.add("bg_c1_f0", value=0.5)
+        self.params.add("peak_0_h0", value=20.0)
+        self.params.add("peak_0_h1", value=2.0)
+        self.params.add("peak_0_h2", value=-1.0)
+        self.params.add("peak_0_d0", value=1.0)
+        self.params.add("peak_0_d1", value=0.002)
+        self.params.add("peak_0_d2", value=0.001)
+        self.params.add("peak_0_w0", value=0.05)
+        self.params.add("peak_0_p0", value=0.4)
+
+    def model(self, values):
+        return lmm.peaks_model(
+            self.two_theta,
+            self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+            **values,
+        )
+
+    def test_against_finite_differences(self):
+        jac = lmm.peaks_jacobian(
+            self.params,
+            None,
+            None,
+            two_theta=self.two_theta,
+            azimuth=self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+        )
+        values = self.params.valuesdict()
+        self.assertEqual(jac.shape, (self.two_theta.size, len(values)))
+        for j, name in enumerate(values):
+            step = 1e-6 * max(abs(values[name]), 1e-3)
+            plus = dict(values)
+            plus[name] += step
+            minus = dict(values)
+            minus[name] -= step
+            numerical = -(self.model(plus) - self.model(minus)) / (2 * step)
+            np.testing.assert_allclose(
+                jac[:, j], numerical, rtol=1e-4, atol=1e-6 * np.abs(numerical).max()
+            )
+
+    def test_fixed_parameters_excluded(self):
+        self.params["peak_0_p0"].set(vary=False)
+        jac = lmm.peaks_jacobian(
+            self.params,
+            None,
+            None,
+            two_theta=self.two_theta,
+            azimuth=self.azimuth,
+            data_class=self.data_class,
+            orders=self.orders,
+        )
+        self.assertEqual(jac.shape[1], len(self.params) - 1)
+
+
+@pytest.mark.usefixtures("example1")
+class TestJacobianExample1(unittest.TestCase):
+    def test_analytical_matches_numerical(self):
+        # the fits to the first image and to the next image propagated from it.
+        for subpattern in [0, 1]:
+            numerical = self.fit_example1(subpattern, images=2)
+            analytical = self.fit_example1(
+                subpattern, images=2, fit_jacobian="analytical"
+            )
+            for fit, expected in zip(analytical, numerical):
+                np.testing.assert_allclose(
+                    fit["FitProperties"]["ChiSq"],
+                    expected["FitProperties"]["ChiSq"],
+                    rtol=1e-5,
+                )
+                # the d-spacings agree to well within their errors.
+                np.testing.assert_array_less(
+                    np.abs(
+                        np.array(fit["peak"][0]["d-space"])
+                        - expected["peak"][0]["d-space"]
+                    ),
+                    0.1 * np.array(expected["peak"][0]["d-space_err"]),
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+
+import numpy as np
+import pytest
+from cpf import lmfit_model as lmm
+from lmfit import Parameters
+
+
+@pytest.mark.usefixtures("linear_data")
+class TestLeastSquares(unittest.TestCase):
+    def setUp(self):
+        tth, azm = np.meshgrid(np.linspace(9, 11, 60), np.linspace(0, 355, 36))
+        self.data = self.LinearData(tth.flatten(), azm.flatten())
+        self.orders = {"range": [9, 11]}
+
+        truth = {
+            "bg_c0_f0": 2.0,
+            "bg_c1_f0": 0.5,
+            "peak_0_h0": 20.0,
+            "peak_0_h1": 2.0,
+            "peak_0_h2": -1.0,
+            "peak_0_d0": 1.0,
+            "peak_0_d1": 0.002,
+            "peak_0_d2": 0.001,
+            "peak_0_w0": 0.05,
+            "peak_0_p0": 0.4,
+        }
+        rng = np.random.default_rng(7)
+        self.data.intensity = lmm.peaks_model(
+            self.data.tth,
+            self.data.azm,
+            data_class=self.data,
+            orders=self.orders,
+            **truth,
+        ) + rng.normal(0, 0.2, self.data.tth.size)
+
+        self.params = Parameters()
+        for name, value in truth.items():
+            self.params.add(name, value=value)
+        self.params["bg_c0_f0"].set(value=3.0)
+        self.params["peak_0_h0"].set(value=15.0, min=0)
+        self.params["peak_0_d0"].set(value=1.001, min=0.99, max=1.01)
+        self.params["peak_0_w0"].set(value=0.06, min=0.01, max=0.2)
+        self.params["peak_0_p0"].set(value=0.5, min=0, max=1)
+
+    def test_same_as_lmfit(self):
+        for jacobian in ["numerical", "analytical"]:
+            expected = lmm.fit_model(
+                self.data, self.orders, self.params, jacobian=jacobian
+            )
+            fit = lmm.fit_model(
+                self.data,
+                self.orders,
+                self.params,
+                jacobian=jacobian,
+                backend="least_squares",
+            )
+            self.assertTrue(fit.success)
+            self.assertEqual(fit.method, "least_squares")
+            self.assertLessEqual(fit.chisqr, expected.chisqr * (1 + 1e-6))
+            for name in self.params:
+                self.assertAlmostEqual(
+                    fit.params[name].value,
+                    expected.params[name].value,
+                    delta=0.1 * expected.params[name].stderr,
+                )
+                self.assertAlmostEqual(
+                    fit.params[name].stderr,
+                    expected.params[name].stderr,
+                    delta=0.01 * expected.params[name].stderr,
+                )
+            self.assertEqual(fit.nfree, expected.nfree)
+            self.assertAlmostEqual(fit.aic, expected.aic, places=2)
+            self.assertIn("peak_0_d0", fit.fit_report())
+
+    def test_bounds(self):
+        self.params["peak_0_w0"].set(value=0.07, min=0.06, max=0.2)
+        fit = lmm.fit_model_least_squares(self.data, self.orders, self.params)
+        self.assertAlmostEqual(fit.params["peak_0_w0"].value, 0.06, places=6)
+        self.assertEqual(self.params["peak_0_w0"].value, 0.07)
+
+    def test_poorly_determined_covariance(self):
+        rng = np.random.default_rng(3)
+        jac = rng.normal(size=(50, 3))
+        np.testing.assert_allclose(
+            lmm._pseudo_inverse_covariance(jac), np.linalg.inv(jac.T @ jac)
+        )
+        # a direction that is not determined does not lose the other errors.
+        jac[:, 2] = 2 * jac[:, 1]
+        covar = lmm._pseudo_inverse_covariance(jac)
+        self.assertTrue(np.all(np.isfinite(covar)))
+        self.assertGreater(covar[0, 0], 0)
+
+
+@pytest.mark.usefixtures("example1")
+class TestLeastSquaresExample1(unittest.TestCase):
+    def test_same_as_lmfit(self):
+        for subpattern in [0, 1]:
+            expected = self.fit_example1(subpattern)[0]
+            fit = self.fit_example1(subpattern, fit_backend="least_squares")[0]
+            # the fit is at least as good, and has errors for all the properties.
+            self.assertLessEqual(
+                fit["FitProperties"]["ChiSq"],
+                expected["FitProperties"]["ChiSq"] * (1 + 1e-5),
+            )
+            self.assertTrue(np.all(np.array(fit["background_err"][0]) > 0))
+            for prop in ["d-space", "height", "width", "profile"]:
+                errors = np.array(fit["peak"][0][prop + "_err"])
+                self.assertTrue(np.all(np.isfinite(errors) & (errors > 0)), prop)
+
+
+if __name__ == "__main__":
+    unittest.main()
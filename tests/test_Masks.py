@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.ma as ma
+from cpf.input_types import _Masks
+from PIL import Image
+
+
+class Detector(_Masks._masks):
+    """Minimal stand-in for a detector class, with the mask functions."""
+
+    def __init__(self, intensity, cache):
+        self.intensity = ma.array(intensity)
+        self.calibration_cache = cache
+
+
+class TestMasks(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.directory.name, "cache")
+        self.image = os.path.join(self.directory.name, "mask.tif")
+        self.mask_image = np.zeros((20, 30), dtype=np.uint8)
+        self.mask_image[2:5, 3:9] = 1
+        Image.fromarray(self.mask_image).save(self.image)
+        self.intensity = np.random.default_rng(2).normal(100, 50, (20, 30))
+        _Masks._static_masks.clear()
+
+    def tearDown(self):
+        _Masks._static_masks.clear()
+        self.directory.cleanup()
+
+    def test_mask(self):
+        detector = Detector(self.intensity, self.cache)
+        spec = {"image": self.image, "threshold": [0, 150], "detector": [20]}
+        # settings are the detector itself, which has calibration_cache.
+        mask = detector.get_mask(spec, settings=detector)
+        expected = (
+            (self.mask_image != 0) | (self.intensity < 0) | (self.intensity > 150)
+        )
+        expected[19] = True
+        np.testing.assert_array_equal(mask, expected)
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+
+        # read from the cache file.
+        _Masks._static_masks.clear()
+        detector.intensity[0, 0] = 1000
+        expected[0, 0] = True
+        np.testing.assert_array_equal(
+            detector.get_mask(spec, settings=detector), expected
+        )
+
+    def test_changed_image(self):
+        mask = _Masks.static_mask({"image": self.image}, (20, 30), cache=self.cache)
+        self.assertEqual(mask.sum(), 18)
+        self.mask_image[10] = 1
+        Image.fromarray(self.mask_image).save(self.image)
+        os.utime(self.image, ns=(0, 0))
+        mask = _Masks.static_mask({"image": self.image}, (20, 30), cache=self.cache)
+        self.assertEqual(mask.sum(), 48)
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
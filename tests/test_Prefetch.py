@@ -0,0 +1,53 @@
+import threading
+import unittest
+
+import numpy as np
+from cpf.prefetch import ImagePrefetcher
+
+
+class Reader:
+    """Minimal stand-in for read_image, that records the images read."""
+
+    def __init__(self, size=10):
+        self.size = size
+        self.read = []
+        self.lock = threading.Lock()
+
+    def __call__(self, image_name):
+        if image_name == "missing":
+            raise FileNotFoundError(image_name)
+        with self.lock:
+            self.read.append(image_name)
+        return np.full(self.size, float(image_name))
+
+
+class TestImagePrefetcher(unittest.TestCase):
+    def test_images(self):
+        reader = Reader()
+        images = list(range(6))
+        with ImagePrefetcher(reader, images, depth=2) as prefetch:
+            for j in images:
+                self.assertEqual(prefetch.get(j)[0], j)
+                # no more than depth images are read ahead.
+                self.assertLessEqual(len(prefetch._futures), 2)
+        self.assertEqual(sorted(reader.read), images)
+
+    def test_memory(self):
+        reader = Reader(size=100)  # 800 bytes each
+        with ImagePrefetcher(
+            reader, list(range(6)), depth=4, max_memory=2500
+        ) as prefetch:
+            prefetch.get(0)
+            # the image being fitted and two read ahead.
+            self.assertEqual(len(prefetch._futures), 2)
+
+    def test_error(self):
+        with ImagePrefetcher(Reader(), [0, "missing", 2], depth=2) as prefetch:
+            prefetch.get(0)
+            with self.assertRaises(FileNotFoundError):
+                prefetch.get(1)
+            self.assertEqual(prefetch.get(2)[0], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
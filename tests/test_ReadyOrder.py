@@ -0,0 +1,35 @@
+import unittest
+
+from cpf.XRD_FitPattern import _ready_order
+
+
+class Result:
+    """Stand-in for a result of the pool, which finishes when it is waited for."""
+
+    def __init__(self, finished=False):
+        self.finished = finished
+        self.waits = 0
+
+    def ready(self):
+        return self.finished
+
+    def wait(self):
+        self.waits += 1
+        self.finished = True
+
+
+class TestReadyOrder(unittest.TestCase):
+    def test_ready_first(self):
+        chain = [Result(), Result(finished=True), None]
+        self.assertEqual(list(_ready_order(chain, wait=True)), [1, 2, 0])
+        self.assertEqual(chain[0].waits, 1)
+        self.assertEqual(chain[1].waits, 0)
+
+    def test_no_wait(self):
+        chain = [Result(), Result()]
+        self.assertEqual(list(_ready_order(chain)), [0, 1])
+        self.assertEqual(chain[0].waits + chain[1].waits, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
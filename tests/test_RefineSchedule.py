@@ -0,0 +1,104 @@
+import unittest
+
+import numpy as np
+import pytest
+from cpf.compiled_model import CompiledModel
+from cpf.refine_schedule import RefineSchedule
+from lmfit import Parameters
+
+
+class FitResult:
+    """Minimal stand-in for the result of a fit."""
+
+    def __init__(self, params, success=True):
+        self.params = params
+        self.success = success
+        self.nfev = 10
+
+
+@pytest.mark.usefixtures("linear_data")
+class TestRefineSchedule(unittest.TestCase):
+    def setUp(self):
+        tth, azm = np.meshgrid(np.linspace(9, 11, 40), np.linspace(0, 355, 24))
+        self.params = Parameters()
+        self.params.add("bg_c0_f0", value=2.0)
+        self.params.add("peak_0_h0", value=20.0, min=0)
+        self.params.add("peak_0_d0", value=1.0, min=0.99, max=1.01)
+        self.params.add("peak_0_w0", value=0.05, min=0.01)
+        self.params.add("peak_0_p0", value=0.4, min=0, max=1)
+        self.model = CompiledModel(
+            self.params,
+            tth.flatten(),
+            azm.flatten(),
+            data_class=self.LinearData(),
+            orders={"range": [9, 11]},
+        )
+        self.intensity = self.model.evaluate(self.model.vector(self.params))
+
+    def stage(self, params, comp):
+        params = params.copy()
+        for name in params:
+            params[name].vary = name == "peak_0_" + comp + "0"
+        return params
+
+    def test_skips_converged(self):
+        schedule = RefineSchedule(self.model, self.intensity, propagated=True)
+        self.assertFalse(schedule.run("peak_0_d", self.stage(self.params, "d")))
+        moved = self.params.copy()
+        moved["peak_0_d0"].value = 1.002
+        self.assertTrue(schedule.run("peak_0_d", self.stage(moved, "d")))
+        self.assertGreater(schedule.stages[-1]["predicted-reduction"], 0.5)
+
+    def test_first_iteration_runs(self):
+        schedule = RefineSchedule(self.model, self.intensity)
+        schedule.start_iteration(0)
+        params = self.stage(self.params, "w")
+        self.assertTrue(schedule.run("peak_0_w", params))
+        # the fit made no change, so the stage is converged.
+        schedule.record("peak_0_w", FitResult(params), 400)
+        self.assertTrue(schedule.converged())
+        schedule.start_iteration(1)
+        self.assertFalse(schedule.run("peak_0_w", params))
+        self.assertEqual(schedule.summary()["skipped"], 1)
+
+    def test_escalates(self):
+        schedule = RefineSchedule(self.model, self.intensity)
+        params = self.stage(self.params, "h")
+        schedule.run("peak_0_h", params)
+        schedule.record("peak_0_h", FitResult(params, success=False), 400)
+        self.assertEqual(schedule.max_f_eval("peak_0_h", 400), 800)
+        self.assertFalse(schedule.converged())
+
+    def test_recheck(self):
+        schedule = RefineSchedule(self.model, self.intensity, propagated=True)
+        schedule.start_iteration(0)
+        self.assertFalse(schedule.run("peak_0_d", self.stage(self.params, "d")))
+        self.assertFalse(schedule.run("peak_0_w", self.stage(self.params, "w")))
+        # the final fit changed the width but left the d-spacing as propagated, so
+        # the d-spacing is run in the next refinement whatever its prediction.
+        fitted = self.params.copy()
+        fitted["peak_0_w0"].value = 0.051
+        self.assertTrue(schedule.recheck(fitted))
+        schedule.start_iteration(0)
+        self.assertTrue(schedule.run("peak_0_d", self.stage(fitted, "d")))
+        self.assertTrue(np.isnan(schedule.stages[-1]["predicted-reduction"]))
+        self.assertFalse(schedule.recheck(fitted))
+
+
+@pytest.mark.usefixtures("example1")
+class TestRefineScheduleExample1(unittest.TestCase):
+    def test_no_parameters_pinned(self):
+        expected = self.fit_example1(0, images=2)
+        fits = self.fit_example1(0, images=2, fit_refine_tolerance=0.01)
+        # the background of the second image is fitted, not kept from the first.
+        self.assertNotEqual(fits[0]["background"][0][0], fits[1]["background"][0][0])
+        for fit, default in zip(fits, expected):
+            np.testing.assert_allclose(
+                fit["FitProperties"]["ChiSq"],
+                default["FitProperties"]["ChiSq"],
+                rtol=1e-5,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.usefixtures("example1")
+class TestResolutionLevelsExample1(unittest.TestCase):
+    def test_no_worse_than_default(self):
+        expected = self.fit_example1(0)[0]
+        fit = self.fit_example1(0, fit_resolution_levels=[4])[0]
+        levels = fit["FitProperties"]["resolution-levels"]
+        self.assertEqual([level["factor"] for level in levels], [4, 1])
+        # the coarse fit has at most the default number of evaluations, and the fit
+        # to all the data is no worse than without it.
+        self.assertLessEqual(levels[0]["function-evaluations"], 400)
+        self.assertTrue(levels[1]["used"])
+        np.testing.assert_allclose(
+            fit["FitProperties"]["ChiSq"],
+            expected["FitProperties"]["ChiSq"],
+            rtol=1e-5,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+
+from cpf.results_store import ResultsStore
+
+
+def fit(d0, n_peaks=1):
+    """Minimal fit to an image, with one subpattern."""
+    return [
+        {
+            "DataProperties": {"max": 100.0, "min": 1.0},
+            "FitProperties": {
+                "ChiSq": 12.5,
+                "function-evaluations": 31,
+                "profile": [{"stage": "final", "wall-time": 0.5}],
+            },
+            "PeakLabel": "Fe (110)",
+            "background": [[2.0, 0.1], [0.5]],
+            "background_err": [[0.1, None], [0.05]],
+            "background_type": "fourier",
+            "peak": [
+                {
+                    "d-space": [d0 + k, 0.001, 0.002],
+                    "d-space_err": [1e-4, 1e-4, None],
+                    "d-space_type": "fourier",
+                    "hkl": 110,
+                    "phase": "Fe",
+                }
+                for k in range(n_peaks)
+            ],
+            "range": [[10.0, 11.0]],
+        }
+    ]
+
+
+class TestResultsStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "results.h5")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        with ResultsStore(self.filename, mode="a") as store:
+            for j in range(3):
+                store.append("image_%i.json" % j, fit(2.0 + j))
+        with ResultsStore(self.filename) as store:
+            self.assertEqual(len(store), 3)
+            fits = store.read(["image_2.json", "missing.json", "image_0.json"])
+            self.assertEqual(store.file["fits/0/peak/0/d-space"].shape, (3, 3))
+        self.assertIsNone(fits[1])
+        self.assertEqual(fits[0], fit(4.0))
+        self.assertEqual(fits[2][0]["peak"][0]["d-space"][0], 2.0)
+        self.assertIsInstance(fits[0][0]["peak"][0]["hkl"], int)
+        self.assertIsInstance(fits[0][0]["FitProperties"]["function-evaluations"], int)
+
+    def test_latest_row(self):
+        with ResultsStore(self.filename, mode="a") as store:
+            store.append("image_0.json", fit(2.0, n_peaks=2))
+            store.append("image_1.json", fit(2.1, n_peaks=2))
+        # fitted again, with one peak.
+        with ResultsStore(self.filename, mode="a") as store:
+            store.append("image_0.json", fit(2.2))
+            fits = store.read()
+        self.assertEqual(len(fits), 3)
+        with ResultsStore(self.filename) as store:
+            fits = store.read(["image_0.json", "image_1.json"])
+        self.assertEqual(len(fits[0][0]["peak"]), 1)
+        self.assertEqual(fits[0][0]["peak"][0]["d-space"][0], 2.2)
+        self.assertEqual(len(fits[1][0]["peak"]), 2)
+
+    def test_changed_kind(self):
+        changed = fit(2.1)
+        # a number where there was a group, and text where there was a number.
+        changed[0]["DataProperties"] = 5.0
+        changed[0]["peak"][0]["hkl"] = "110a"
+        with ResultsStore(self.filename, mode="a") as store:
+            store.append("image_0.json", fit(2.0))
+            store.append("image_1.json", changed)
+            store.append("image_2.json", fit(2.2))
+            fits = store.read()
+        self.assertEqual(fits[1], changed)
+        self.assertEqual(fits[0], fit(2.0))
+        self.assertEqual(fits[2], fit(2.2))
+
+
+if __name__ == "__main__":
+    unittest.main()
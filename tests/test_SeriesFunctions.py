@@ -0,0 +1,65 @@
+import unittest
+
+import numpy as np
+from cpf import series_functions as sf
+
+
+class TestBasisCache(unittest.TestCase):
+    def setUp(self):
+        self.max_bytes = sf.basis_cache_info()["max_bytes"]
+        self.azimuth = np.linspace(0, 355, 72)
+        # room for the matrices of 5 and 7 coefficients, and their azimuths.
+        sf.basis_cache_clear(max_bytes=(5 + 7 + 2) * self.azimuth.nbytes)
+
+    def tearDown(self):
+        sf.basis_cache_clear(max_bytes=self.max_bytes)
+
+    def test_fourier_hits(self):
+        coeffs = [1.0, 0.5, -0.2, 0.1, 0.3]
+        first = sf.fourier_expand(self.azimuth, inp_param=coeffs)
+        second = sf.fourier_expand(self.azimuth, inp_param=coeffs)
+        info = sf.basis_cache_info()
+        self.assertEqual((info["hits"], info["misses"]), (1, 1))
+        np.testing.assert_array_equal(first, second)
+        expected = (
+            1.0
+            + 0.5 * np.sin(np.deg2rad(self.azimuth))
+            - 0.2 * np.cos(np.deg2rad(self.azimuth))
+            + 0.1 * np.sin(2 * np.deg2rad(self.azimuth))
+            + 0.3 * np.cos(2 * np.deg2rad(self.azimuth))
+        )
+        np.testing.assert_allclose(first, expected, rtol=1e-12)
+
+    def test_spline_matches_basis(self):
+        coeffs = np.array([1.0, 2.0, 0.5, 1.5])
+        out = sf.coefficient_expand(self.azimuth, coeffs, coeff_type="spline_cubic")
+        basis = sf.coefficient_basis(self.azimuth, 4, coeff_type="spline_cubic")
+        np.testing.assert_allclose(out, basis @ coeffs, rtol=1e-12)
+        self.assertEqual(sf.basis_cache_info()["hits"], 1)
+
+    def test_eviction(self):
+        for n in [3, 5, 7]:
+            sf.coefficient_basis(self.azimuth, n)
+        self.assertEqual(sf.basis_cache_info()["size"], 2)
+        sf.coefficient_basis(self.azimuth, 3)
+        self.assertEqual(sf.basis_cache_info()["misses"], 4)
+        self.assertLessEqual(
+            sf.basis_cache_info()["bytes"], sf.basis_cache_info()["max_bytes"]
+        )
+
+    def test_changed_in_place(self):
+        coeffs = [1.0, 0.5, -0.2]
+        sf.fourier_expand(self.azimuth, inp_param=coeffs)
+        self.azimuth += 1
+        out = sf.fourier_expand(self.azimuth, inp_param=coeffs)
+        self.assertEqual(sf.basis_cache_info()["misses"], 2)
+        expected = (
+            1.0
+            + 0.5 * np.sin(np.deg2rad(self.azimuth))
+            - 0.2 * np.cos(np.deg2rad(self.azimuth))
+        )
+        np.testing.assert_allclose(out, expected, rtol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+import pytest
+from cpf import lmfit_model as lmm
+from lmfit import Parameters
+
+
+@pytest.mark.usefixtures("linear_data")
+class TestVarPro(unittest.TestCase):
+    def setUp(self):
+        tth, azm = np.meshgrid(np.linspace(9, 11, 60), np.linspace(0, 355, 36))
+        self.data = self.LinearData(tth.flatten(), azm.flatten())
+        self.orders = {"range": [9, 11]}
+
+        self.truth = {
+            "bg_c0_f0": 2.0,
+            "bg_c0_f1": 0.3,
+            "bg_c0_f2": -0.2,
+            "bg_c1_f0": 0.5,
+            "peak_0_h0": 20.0,
+            "peak_0_h1": 2.0,
+            "peak_0_h2": -1.0,
+            "peak_0_d0": 1.0,
+            "peak_0_d1": 0.002,
+            "peak_0_d2": 0.001,
+            "peak_0_w0": 0.05,
+            "peak_0_p0": 0.4,
+        }
+        self.data.intensity = lmm.peaks_model(
+            self.data.tth,
+            self.data.azm,
+            data_class=self.data,
+            orders=self.orders,
+            **self.truth,
+        )
+
+        # a poor guess for every coefficient
+        self.params = Parameters()
+        for name, value in self.truth.items():
+            self.params.add(name, value=value)
+        self.params["bg_c0_f0"].set(value=5.0)
+        self.params["bg_c1_f0"].set(value=0.0)
+        self.params["peak_0_h0"].set(value=10.0, min=0)
+        self.params["peak_0_h1"].set(value=0.0)
+        self.params["peak_0_d0"].set(value=1.002, min=0.99, max=1.01)
+        self.params["peak_0_d1"].set(value=0.0)
+        self.params["peak_0_w0"].set(value=0.07, min=0.01, max=0.2)
+        self.params["peak_0_p0"].set(value=0.5, min=0, max=1)
+
+    def test_recovers_model(self):
+        fit = lmm.fit_model_varpro(self.data, self.orders, self.params)
+        for name, value in self.truth.items():
+            self.assertAlmostEqual(fit.params[name].value, value, places=5)
+        self.assertIsNotNone(fit.params["peak_0_h0"].stderr)
+
+    def test_fixed_linear_coefficient(self):
+        self.params["bg_c1_f0"].set(value=0.5, vary=False)
+        fit = lmm.fit_model_varpro(self.data, self.orders, self.params)
+        self.assertEqual(fit.params["bg_c1_f0"].value, 0.5)
+        self.assertAlmostEqual(fit.params["peak_0_w0"].value, 0.05, places=5)
+
+    def test_errors_without_covariance(self):
+        # lmfit has no covariance matrix when a parameter is on a bound.
+        fit_model = lmm.fit_model
+
+        def no_covariance(*args, **kwargs):
+            out = fit_model(*args, **kwargs)
+            out.errorbars = False
+            out.covar = None
+            for par in out.params.values():
+                par.stderr, par.correl = None, None
+            return out
+
+        with mock.patch.object(lmm, "fit_model", side_effect=no_covariance):
+            fit = lmm.fit_model_varpro(self.data, self.orders, self.params)
+        self.assertTrue(fit.errorbars)
+        for name in fit.var_names:
+            self.assertGreater(fit.params[name].stderr, 0)
+            self.assertIsNotNone(fit.params[name].correl)
+
+
+@pytest.mark.usefixtures("example1")
+class TestVarProExample1(unittest.TestCase):
+    def test_same_as_lmfit(self):
+        for subpattern in [0, 1]:
+            expected = self.fit_example1(subpattern)[0]
+            fit = self.fit_example1(subpattern, fit_varpro=True)[0]
+            self.assertGreater(fit["FitProperties"]["status"], 0)
+            self.assertLessEqual(
+                fit["FitProperties"]["ChiSq"],
+                expected["FitProperties"]["ChiSq"] * (1 + 1e-5),
+            )
+            self.assertTrue(np.all(np.array(fit["background_err"][0]) > 0))
+            for prop in ["d-space", "height", "width", "profile"]:
+                errors = np.array(fit["peak"][0][prop + "_err"])
+                self.assertTrue(np.all(np.isfinite(errors) & (errors > 0)), prop)
+            self.assertIn("correlation_coeffs", fit)
+
+
+if __name__ == "__main__":
+    unittest.main()